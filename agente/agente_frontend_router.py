@@ -49,15 +49,24 @@ def pagina_novo_agente(sessao_id: int, request: Request, db: Session = Depends(g
             "titulo": "Erro"
         })
     
-    # Buscar configurações padrão
+    # Buscar configurações padrão (uma consulta)
+    valores = ConfiguracaoService.obter_valores(db, {
+        "agente_papel_padrao": "assistente pessoal",
+        "agente_objetivo_padrao": "ajudar o usuário",
+        "agente_politicas_padrao": "ser educado e prestativo",
+        "agente_tarefa_padrao": "responder perguntas",
+        "agente_objetivo_explicito_padrao": "fornecer informações úteis",
+        "agente_publico_padrao": "usuários em geral",
+        "agente_restricoes_padrao": "responder em português"
+    })
     config_agente = {
-        "papel": ConfiguracaoService.obter_valor(db, "agente_papel_padrao", "assistente pessoal"),
-        "objetivo": ConfiguracaoService.obter_valor(db, "agente_objetivo_padrao", "ajudar o usuário"),
-        "politicas": ConfiguracaoService.obter_valor(db, "agente_politicas_padrao", "ser educado e prestativo"),
-        "tarefa": ConfiguracaoService.obter_valor(db, "agente_tarefa_padrao", "responder perguntas"),
-        "objetivo_explicito": ConfiguracaoService.obter_valor(db, "agente_objetivo_explicito_padrao", "fornecer informações úteis"),
-        "publico": ConfiguracaoService.obter_valor(db, "agente_publico_padrao", "usuários em geral"),
-        "restricoes": ConfiguracaoService.obter_valor(db, "agente_restricoes_padrao", "responder em português")
+        "papel": valores["agente_papel_padrao"],
+        "objetivo": valores["agente_objetivo_padrao"],
+        "politicas": valores["agente_politicas_padrao"],
+        "tarefa": valores["agente_tarefa_padrao"],
+        "objetivo_explicito": valores["agente_objetivo_explicito_padrao"],
+        "publico": valores["agente_publico_padrao"],
+        "restricoes": valores["agente_restricoes_padrao"]
     }
     
     # Sugerir próximo código
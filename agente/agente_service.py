@@ -5,7 +5,6 @@ from sqlalchemy.orm import Session
 from typing import List, Dict, Any, Optional
 import httpx
 import json
-import base64
 import time
 from datetime import datetime
 from config.config_service import ConfiguracaoService
@@ -14,6 +13,7 @@ from agente.agente_schema import AgenteCriar, AgenteAtualizar
 from ferramenta.ferramenta_model import Ferramenta
 from ferramenta.ferramenta_service import FerramentaService
 from llm_providers.llm_integration_service import LLMIntegrationService
+from mensagem.mensagem_service import MensagemService
 
 
 class AgenteService:
@@ -160,32 +160,28 @@ class AgenteService:
         """
         from config.config_service import ConfiguracaoService
         
+        padroes = ConfiguracaoService.obter_valores(db, {
+            "agente_papel_padrao": "assistente pessoal",
+            "agente_objetivo_padrao": "ajudar o usuário com suas dúvidas e tarefas",
+            "agente_politicas_padrao": "ser educado, respeitoso e prestativo",
+            "agente_tarefa_padrao": "responder perguntas de forma clara e objetiva",
+            "agente_objetivo_explicito_padrao": "fornecer informações úteis e precisas",
+            "agente_publico_padrao": "usuários em geral",
+            "agente_restricoes_padrao": "responder em português brasileiro, ser conciso"
+        })
+        
         agente_data = AgenteCriar(
             sessao_id=sessao_id,
             codigo="01",
             nome="Assistente Padrão",
             descricao="Agente de atendimento geral",
-            agente_papel=ConfiguracaoService.obter_valor(
-                db, "agente_papel_padrao", "assistente pessoal"
-            ),
-            agente_objetivo=ConfiguracaoService.obter_valor(
-                db, "agente_objetivo_padrao", "ajudar o usuário com suas dúvidas e tarefas"
-            ),
-            agente_politicas=ConfiguracaoService.obter_valor(
-                db, "agente_politicas_padrao", "ser educado, respeitoso e prestativo"
-            ),
-            agente_tarefa=ConfiguracaoService.obter_valor(
-                db, "agente_tarefa_padrao", "responder perguntas de forma clara e objetiva"
-            ),
-            agente_objetivo_explicito=ConfiguracaoService.obter_valor(
-                db, "agente_objetivo_explicito_padrao", "fornecer informações úteis e precisas"
-            ),
-            agente_publico=ConfiguracaoService.obter_valor(
-                db, "agente_publico_padrao", "usuários em geral"
-            ),
-            agente_restricoes=ConfiguracaoService.obter_valor(
-                db, "agente_restricoes_padrao", "responder em português brasileiro, ser conciso"
-            ),
+            agente_papel=padroes["agente_papel_padrao"],
+            agente_objetivo=padroes["agente_objetivo_padrao"],
+            agente_politicas=padroes["agente_politicas_padrao"],
+            agente_tarefa=padroes["agente_tarefa_padrao"],
+            agente_objetivo_explicito=padroes["agente_objetivo_explicito_padrao"],
+            agente_publico=padroes["agente_publico_padrao"],
+            agente_restricoes=padroes["agente_restricoes_padrao"],
             ativo=True
         )
         
@@ -242,9 +238,8 @@ class AgenteService:
                     })
                 
                 # Adicionar imagem se houver
-                if msg.tipo == "imagem" and msg.conteudo_imagem_base64:
-                    mime_type = msg.conteudo_mime_type or "image/jpeg"
-                    data_url = f"data:{mime_type};base64,{msg.conteudo_imagem_base64}"
+                data_url = MensagemService.obter_imagem_data_url(msg) if msg.tipo == "imagem" else None
+                if data_url:
                     conteudo.append({
                         "type": "image_url",
                         "image_url": {
@@ -334,9 +329,8 @@ class AgenteService:
             })
         
         # Adicionar imagem se houver
-        if mensagem.tipo == "imagem" and mensagem.conteudo_imagem_base64:
-            mime_type = mensagem.conteudo_mime_type or "image/jpeg"
-            data_url = f"data:{mime_type};base64,{mensagem.conteudo_imagem_base64}"
+        data_url = MensagemService.obter_imagem_data_url(mensagem) if mensagem.tipo == "imagem" else None
+        if data_url:
             conteudo_atual.append({
                 "type": "image_url",
                 "image_url": {
@@ -516,7 +510,6 @@ class AgenteService:
                                 
                                 # Registrar métrica
                                 RAGMetricaService.registrar_busca(
-                                    db=db,
                                     rag_id=agente.rag_id,
                                     query=query,
                                     resultados=resultados_busca,
@@ -5,6 +5,8 @@ from sqlalchemy.orm import Session
 from typing import Optional, List, Dict, Any
 import httpx
 import json
+import threading
+import time
 from config.config_model import Configuracao
 from config.config_schema import (
     ConfiguracaoCriar,
@@ -13,6 +15,12 @@ from config.config_schema import (
     TestarConexaoResposta
 )
 
+# Cache de obter_valores (padrões de formulários, quase constantes):
+# chave (chaves e padrões pedidos) -> (expira_em, valores). Limpo a cada escrita.
+CACHE_VALORES_TTL = 60  # segundos
+_cache_valores: Dict[tuple, tuple] = {}
+_cache_valores_lock = threading.Lock()
+
 
 class ConfiguracaoService:
     """Serviço para gerenciar configurações do sistema."""
@@ -29,6 +37,44 @@ class ConfiguracaoService:
         Retorna o valor padrão se não encontrar.
         """
         config = ConfiguracaoService.obter_por_chave(db, chave)
+        return ConfiguracaoService._converter_valor(config, padrao)
+
+    @staticmethod
+    def obter_valores(db: Session, padroes: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Obtém várias configurações em uma única consulta (WHERE chave IN ...).
+        padroes mapeia cada chave ao seu valor padrão; o retorno tem as mesmas chaves,
+        com os valores convertidos como em obter_valor. Em cache por CACHE_VALORES_TTL
+        segundos (as escritas deste serviço limpam o cache).
+        """
+        chave_cache = tuple(padroes.items())
+        agora = time.monotonic()
+        with _cache_valores_lock:
+            item = _cache_valores.get(chave_cache)
+        if item and item[0] > agora:
+            return dict(item[1])
+        
+        configs = {
+            config.chave: config
+            for config in db.query(Configuracao).filter(Configuracao.chave.in_(list(padroes)))
+        }
+        valores = {
+            chave: ConfiguracaoService._converter_valor(configs.get(chave), padrao)
+            for chave, padrao in padroes.items()
+        }
+        with _cache_valores_lock:
+            _cache_valores[chave_cache] = (agora + CACHE_VALORES_TTL, valores)
+        return dict(valores)
+
+    @staticmethod
+    def invalidar_cache():
+        """Descarta os valores em cache de obter_valores."""
+        with _cache_valores_lock:
+            _cache_valores.clear()
+
+    @staticmethod
+    def _converter_valor(config: Optional[Configuracao], padrao: Any) -> Any:
+        """Converte o valor da configuração para o seu tipo (ou retorna o padrão)."""
         if not config or config.valor is None:
             return padrao
 
@@ -63,6 +109,7 @@ class ConfiguracaoService:
         db_config = Configuracao(**config.model_dump())
         db.add(db_config)
         db.commit()
+        ConfiguracaoService.invalidar_cache()
         db.refresh(db_config)
         return db_config
 
@@ -81,6 +128,7 @@ class ConfiguracaoService:
             setattr(db_config, campo, valor)
 
         db.commit()
+        ConfiguracaoService.invalidar_cache()
         db.refresh(db_config)
         return db_config
 
@@ -101,6 +149,7 @@ class ConfiguracaoService:
 
             db_config.valor = valor_str
             db.commit()
+            ConfiguracaoService.invalidar_cache()
             db.refresh(db_config)
             return db_config
         elif criar_se_nao_existir:
@@ -137,6 +186,7 @@ class ConfiguracaoService:
 
         db.delete(db_config)
         db.commit()
+        ConfiguracaoService.invalidar_cache()
         return True
 
     @staticmethod
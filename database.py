@@ -4,16 +4,41 @@ Configuração do banco de dados SQLAlchemy.
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from contextlib import contextmanager
+import logging
 import os
+import threading
+import time
+import orjson
+
+logger = logging.getLogger(__name__)
 
 # URL do banco de dados
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./fluxi.db")
 
+
+def _json_serializer(valor) -> str:
+    """Serializa colunas JSON com orjson (chaves não-str aceitas, como no json padrão)."""
+    return orjson.dumps(valor, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+
+# Pool de conexões para bancos servidor (o SQLite usa o pool padrão do SQLAlchemy);
+# pre_ping/recycle descartam conexões derrubadas pelo servidor
+_pool_kwargs = {} if "sqlite" in DATABASE_URL else {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_pre_ping": True,
+    "pool_recycle": 1800,
+}
+
 # Criar engine
 engine = create_engine(
     DATABASE_URL,
     connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {},
-    echo=False
+    json_serializer=_json_serializer,
+    json_deserializer=orjson.loads,
+    echo=False,
+    **_pool_kwargs
 )
 
 # Session local
@@ -34,6 +59,45 @@ def get_db():
         db.close()
 
 
+@contextmanager
+def session_scope():
+    """
+    Sessão de curta duração para código fora das requisições (threads e callbacks):
+    commit ao final, rollback em caso de erro e sempre close.
+    """
+    db = SessionLocal()
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def iniciar_tarefa_periodica(nome: str, intervalo: int, *tarefas) -> threading.Thread:
+    """
+    Inicia uma thread daemon que executa cada tarefa(db) a cada `intervalo` segundos,
+    cada uma em seu próprio session_scope: um erro numa tarefa é registrado no log
+    e não impede as demais nem as próximas execuções.
+    """
+    def executar():
+        while True:
+            for tarefa in tarefas:
+                try:
+                    with session_scope() as db:
+                        resultado = tarefa(db)
+                    logger.debug("%s: %s concluída (%s)", nome, tarefa.__name__, resultado)
+                except Exception:
+                    logger.exception("%s: erro em %s", nome, tarefa.__name__)
+            time.sleep(intervalo)
+    
+    thread = threading.Thread(target=executar, name=nome, daemon=True)
+    thread.start()
+    return thread
+
+
 def criar_tabelas():
     """
     Cria todas as tabelas no banco de dados.
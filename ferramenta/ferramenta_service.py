@@ -353,7 +353,7 @@ class FerramentaService:
         Suporta diferentes tipos de canal (text, image, audio, video, document).
         """
         from sessao.sessao_service import gerenciador_sessoes
-        from neonize.utils import build_jid
+        from mensagem.mensagem_service import build_jid
         from ferramenta.ferramenta_model import ChannelType
         
         # Obter cliente WhatsApp
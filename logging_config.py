@@ -1,16 +1,30 @@
 """
 Configuração de logging para o sistema RAG.
 """
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
 import sys
 from datetime import datetime
 
+# Listener que grava os logs em background (console + arquivo)
+_queue_listener = None
+
 def setup_logging():
-    """Configura o sistema de logging."""
+    """
+    Configura o sistema de logging.
+    
+    Os handlers de console e arquivo rodam em uma thread (QueueHandler +
+    QueueListener): quem loga só enfileira o registro, sem esperar o write().
+    O nível vem de LOG_LEVEL (padrão INFO; use WARNING em produção).
+    """
+    global _queue_listener
     
     # Criar logger principal
     logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
     
     # Remover handlers existentes
     for handler in logger.handlers[:]:
@@ -26,13 +40,21 @@ def setup_logging():
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
     
     # Handler para arquivo (logs específicos do RAG)
     file_handler = logging.FileHandler('rag_processing.log', encoding='utf-8')
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    
+    # Escrita assíncrona: os handlers reais ficam no listener
+    if _queue_listener is not None:
+        _queue_listener.stop()
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _queue_listener = logging.handlers.QueueListener(
+        log_queue, console_handler, file_handler, respect_handler_level=True
+    )
+    _queue_listener.start()
     
     # Configurar loggers específicos
     rag_logger = logging.getLogger('rag')
@@ -46,5 +68,14 @@ def setup_logging():
     
     return logger
 
+
+def _parar_listener():
+    """Descarrega a fila de logs no encerramento."""
+    if _queue_listener is not None:
+        _queue_listener.stop()
+
+
+atexit.register(_parar_listener)
+
 # Configurar logging ao importar
 setup_logging()
@@ -43,6 +43,7 @@ from llm_providers.llm_providers_frontend_router import router as llm_providers_
 from config.config_service import ConfiguracaoService
 from ferramenta.ferramenta_service import FerramentaService
 from metrica.metrica_service import MetricaService
+from rag.rag_metrica_service import RAGMetricaService
 from sessao.sessao_service import SessaoService
 
 # Criar aplicação FastAPI
@@ -69,6 +70,9 @@ os.makedirs("uploads", exist_ok=True)
 os.makedirs("sessoes", exist_ok=True)
 os.makedirs("rags", exist_ok=True)
 
+# Servir imagens recebidas (Mensagem.conteudo_imagem_url aponta para /uploads/...)
+app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+
 
 # Evento de inicialização
 @app.on_event("startup")
@@ -78,6 +82,7 @@ def startup_event():
     
     # Criar tabelas
     criar_tabelas()
+    RAGMetricaService.migrar_query_hash()
     print("✅ Tabelas criadas")
     
     # Obter sessão do banco
@@ -93,6 +98,15 @@ def startup_event():
         FerramentaService.criar_ferramentas_padrao(db)
         print("✅ Ferramentas padrão criadas")
         
+        # Preencher a contagem de mensagens por cliente (top clientes), se ainda vazia
+        MetricaService.inicializar_contagem_clientes(db)
+        
+        # Consolidar métricas diárias (mensagens_por_dia) em segundo plano
+        MetricaService.iniciar_consolidacao_periodica()
+        
+        # Limpar QR Codes expirados em segundo plano
+        SessaoService.iniciar_expiracao_qr_codes()
+        
         # Reconectar sessões que estavam conectadas
         print("🔄 Reconectando sessões ativas...")
         sessoes_ativas = SessaoService.listar_todas(db, apenas_ativas=True)
@@ -112,6 +126,9 @@ def startup_event():
         if sessoes_reconectadas > 0:
             print(f"✅ {sessoes_reconectadas} sessão(ões) reconectada(s)")
         
+        # Gerar o schema OpenAPI uma única vez (fica em cache em app.openapi_schema)
+        app.openapi()
+        
         print("✅ Fluxi iniciado com sucesso!")
         print("📱 Acesse: http://localhost:8000")
     finally:
@@ -21,15 +21,13 @@ def mcp_index(request: Request, db: Session = Depends(get_db)):
     """Página inicial MCP - lista sessões com agentes."""
     from sessao.sessao_service import SessaoService
     
-    sessoes = SessaoService.listar_todas(db, apenas_ativas=True)
+    sessoes = SessaoService.listar_todas(db, apenas_ativas=True, com_agentes=True)
     
-    # Contar MCP clients por sessão
+    # Contar MCP clients por sessão (agentes e clientes já carregados)
     for sessao in sessoes:
-        total_mcp = 0
-        for agente in sessao.agentes:
-            if agente.ativo:
-                total_mcp += len(MCPService.listar_por_agente(db, agente.id))
-        sessao.total_mcp_clients = total_mcp
+        sessao.total_mcp_clients = sum(
+            len(agente.mcp_clients) for agente in sessao.agentes if agente.ativo
+        )
     
     return templates.TemplateResponse("mcp/index.html", {
         "request": request,
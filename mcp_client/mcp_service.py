@@ -8,6 +8,7 @@ import time
 import json
 from datetime import datetime
 
+import anyio
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 from mcp.client.streamable_http import streamablehttp_client
@@ -25,6 +26,26 @@ from mcp_client.mcp_schema import (
 from mcp_client.mcp_presets import listar_presets, obter_preset
 
 
+
+def _converter_embedded_resource(content_item: types.EmbeddedResource) -> Optional[Dict[str, Any]]:
+    """Converte um recurso incorporado (apenas recursos de texto)."""
+    resource = content_item.resource
+    if isinstance(resource, types.TextResourceContents):
+        return {
+            "type": "resource",
+            "uri": str(resource.uri),
+            "text": resource.text
+        }
+    return None
+
+
+# Conversores de conteúdo de resultado de tool MCP, indexados pelo tipo
+_CONTENT_HANDLERS = {
+    types.TextContent: lambda c: {"type": "text", "text": c.text},
+    types.ImageContent: lambda c: {"type": "image", "data": c.data, "mimeType": c.mimeType},
+    types.EmbeddedResource: _converter_embedded_resource,
+}
+
 class MCPService:
     """Serviço para gerenciar clientes MCP."""
     
@@ -32,6 +53,12 @@ class MCPService:
     _active_sessions: Dict[int, ClientSession] = {}
     _session_contexts: Dict[int, Any] = {}  # Context managers
     _session_locks: Dict[int, asyncio.Lock] = {}
+    # Processos STDIO reaproveitados entre reconexões: id -> (context, read_stream, write_stream)
+    _stdio_processes: Dict[int, Any] = {}
+    # Event loop onde as sessões foram criadas (usado para agendar desconexões)
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    # Desconexões em andamento (o loop só guarda referência fraca às tasks)
+    _tarefas_desconexao: set = set()
     
     @staticmethod
     def listar_por_agente(db: Session, agente_id: int) -> List[MCPClient]:
@@ -88,30 +115,57 @@ class MCPService:
 
     @staticmethod
     def deletar(db: Session, mcp_client_id: int) -> bool:
-        """Deleta um cliente MCP."""
+        """
+        Deleta um cliente MCP.
+        O fechamento da sessão MCP é agendado em segundo plano, sem bloquear o chamador.
+        """
         db_mcp = MCPService.obter_por_id(db, mcp_client_id)
         if not db_mcp:
             return False
         
-        # Desconectar se estiver conectado (remover da memória)
-        if mcp_client_id in MCPService._active_sessions:
-            try:
-                # Remover da memória (as sessões serão fechadas automaticamente)
-                del MCPService._active_sessions[mcp_client_id]
-            except KeyError:
-                pass
-        
-        if mcp_client_id in MCPService._session_contexts:
-            try:
-                del MCPService._session_contexts[mcp_client_id]
-            except KeyError:
-                pass
-        
         # Deletar do banco (cascade vai deletar as tools)
         db.delete(db_mcp)
         db.commit()
+        
+        # Desconectar se estiver conectado (fecha sessão e processo/conexão)
+        MCPService._agendar_desconexao(mcp_client_id)
         return True
 
+    @staticmethod
+    def _agendar_desconexao(mcp_client_id: int):
+        """
+        Agenda desconectar_cliente no event loop onde as sessões MCP vivem.
+        Funciona tanto a partir de código async quanto de rotas síncronas (threadpool).
+        """
+        if mcp_client_id not in MCPService._active_sessions:
+            return
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        
+        if loop is not None:
+            MCPService._criar_tarefa_desconexao(mcp_client_id)
+        elif MCPService._loop is not None and MCPService._loop.is_running():
+            MCPService._loop.call_soon_threadsafe(MCPService._criar_tarefa_desconexao, mcp_client_id)
+        else:
+            # Sem event loop em execução: desconectar de forma síncrona, no loop (parado)
+            # onde as sessões foram criadas ou, se ele já foi fechado, num loop novo.
+            # Assim o processo STDIO é encerrado, e não só removido da memória.
+            desconexao = MCPService.desconectar_cliente(mcp_client_id)
+            if MCPService._loop is not None and not MCPService._loop.is_closed():
+                MCPService._loop.run_until_complete(desconexao)
+            else:
+                asyncio.run(desconexao)
+
+    @staticmethod
+    def _criar_tarefa_desconexao(mcp_client_id: int):
+        """Cria a task de desconexão no loop atual e mantém a referência até ela terminar."""
+        tarefa = asyncio.get_running_loop().create_task(MCPService.desconectar_cliente(mcp_client_id))
+        MCPService._tarefas_desconexao.add(tarefa)
+        tarefa.add_done_callback(MCPService._tarefas_desconexao.discard)
+
     # Presets -----------------------------------------------------------------
 
     @staticmethod
@@ -286,17 +340,11 @@ class MCPService:
         try:
                 # Conectar baseado no tipo de transporte
                 if db_mcp.transport_type == TransportType.STDIO:
-                    # Conexão STDIO
-                    server_params = StdioServerParameters(
-                        command=db_mcp.command,
-                        args=db_mcp.args or [],
-                        env=db_mcp.env_vars or {}
+                    # Conexão STDIO (reaproveita o processo se ainda estiver vivo)
+                    context, read_stream, write_stream = await MCPService._obter_processo_stdio(
+                        mcp_client_id, db_mcp
                     )
                     
-                    context = stdio_client(server_params)
-                    streams = await context.__aenter__()
-                    read_stream, write_stream = streams
-                    
                 elif db_mcp.transport_type == TransportType.STREAMABLE_HTTP:
                     # Conexão HTTP
                     context = streamablehttp_client(db_mcp.url)
@@ -323,6 +371,7 @@ class MCPService:
                 # Armazenar sessão ativa
                 MCPService._active_sessions[mcp_client_id] = session
                 MCPService._session_contexts[mcp_client_id] = context
+                MCPService._loop = asyncio.get_running_loop()
                 
                 # Atualizar banco de dados
                 db_mcp.conectado = True
@@ -340,10 +389,10 @@ class MCPService:
                         db_mcp.capabilities = init_result.capabilities
                 else:
                     db_mcp.capabilities = None
-                db.commit()
                 
-                # Sincronizar tools
-                await MCPService.sincronizar_tools(db, mcp_client_id)
+                # Sincronizar tools (mesma transação: um único commit no final)
+                await MCPService.sincronizar_tools(db, mcp_client_id, commit=False)
+                db.commit()
                 
                 return {
                     "sucesso": True,
@@ -353,7 +402,8 @@ class MCPService:
                 }
         
         except Exception as e:
-            # Registrar erro
+            # Descartar alterações parciais e registrar erro em transação própria
+            db.rollback()
             db_mcp.conectado = False
             db_mcp.ultimo_erro = str(e)
             db.commit()
@@ -364,6 +414,49 @@ class MCPService:
                 "erro": str(e)
             }
     
+    @staticmethod
+    def _processo_stdio_ativo(mcp_client_id: int) -> bool:
+        """Verifica se o processo STDIO em cache ainda está se comunicando."""
+        processo = MCPService._stdio_processes.get(mcp_client_id)
+        if not processo:
+            return False
+        
+        _, read_stream, write_stream = processo
+        # Quando o processo termina, o stdio_client fecha as pontas internas dos streams
+        return (
+            read_stream.statistics().open_send_streams > 0
+            and write_stream.statistics().open_receive_streams > 0
+        )
+    
+    @staticmethod
+    async def _obter_processo_stdio(mcp_client_id: int, db_mcp) -> tuple:
+        """
+        Retorna (context, read_stream, write_stream) para um cliente STDIO.
+        Reaproveita o processo já iniciado e só cria um novo se o anterior terminou.
+        A ClientSession recebe clones dos streams, para que fechá-la não feche o processo.
+        """
+        if MCPService._processo_stdio_ativo(mcp_client_id):
+            context, read_stream, write_stream = MCPService._stdio_processes[mcp_client_id]
+        else:
+            processo_antigo = MCPService._stdio_processes.pop(mcp_client_id, None)
+            if processo_antigo:
+                try:
+                    await processo_antigo[0].__aexit__(None, None, None)
+                except Exception as e:
+                    print(f"Erro ao encerrar processo MCP {mcp_client_id}: {e}")
+            
+            server_params = StdioServerParameters(
+                command=db_mcp.command,
+                args=db_mcp.args or [],
+                env=db_mcp.env_vars or {}
+            )
+            
+            context = stdio_client(server_params)
+            read_stream, write_stream = await context.__aenter__()
+            MCPService._stdio_processes[mcp_client_id] = (context, read_stream, write_stream)
+        
+        return context, read_stream.clone(), write_stream.clone()
+    
     @staticmethod
     async def conectar_cliente(db: Session, mcp_client_id: int) -> Dict[str, Any]:
         """
@@ -394,8 +487,14 @@ class MCPService:
             return await MCPService._conectar_cliente_interno(db, mcp_client_id, db_mcp)
     
     @staticmethod
-    async def desconectar_cliente(mcp_client_id: int):
-        """Desconecta um cliente MCP."""
+    async def desconectar_cliente(mcp_client_id: int, manter_processo: bool = False):
+        """
+        Desconecta um cliente MCP.
+        
+        Args:
+            manter_processo: Para STDIO, fecha apenas a sessão e mantém o processo
+                vivo para ser reaproveitado na próxima conexão.
+        """
         if mcp_client_id in MCPService._active_sessions:
             try:
                 session = MCPService._active_sessions[mcp_client_id]
@@ -404,23 +503,28 @@ class MCPService:
                 # Fechar sessão
                 await session.__aexit__(None, None, None)
                 
-                # Fechar context
+                # Fechar context (processo STDIO só é encerrado se não for mantido)
+                if manter_processo and mcp_client_id in MCPService._stdio_processes:
+                    context = None
                 if context:
+                    MCPService._stdio_processes.pop(mcp_client_id, None)
                     await context.__aexit__(None, None, None)
                 
             except Exception as e:
                 print(f"Erro ao desconectar cliente MCP {mcp_client_id}: {e}")
             finally:
                 # Remover da memória
-                del MCPService._active_sessions[mcp_client_id]
-                if mcp_client_id in MCPService._session_contexts:
-                    del MCPService._session_contexts[mcp_client_id]
+                MCPService._active_sessions.pop(mcp_client_id, None)
+                MCPService._session_contexts.pop(mcp_client_id, None)
     
     @staticmethod
-    async def sincronizar_tools(db: Session, mcp_client_id: int) -> int:
+    async def sincronizar_tools(db: Session, mcp_client_id: int, commit: bool = True) -> int:
         """
         Sincroniza tools do servidor MCP com o banco de dados.
         
+        Args:
+            commit: Se False, apenas faz flush e deixa o commit para o chamador.
+        
         Returns:
             Número de tools sincronizadas
         """
@@ -495,7 +599,10 @@ class MCPService:
             if db_mcp:
                 db_mcp.ultima_sincronizacao = datetime.now()
             
-            db.commit()
+            if commit:
+                db.commit()
+            else:
+                db.flush()
             
             return len(tools_names_novas)
         
@@ -593,10 +700,8 @@ class MCPService:
             try:
                 # Executar tool com timeout de 60 segundos
                 print(f"🚀 [MCP] Chamando session.call_tool('{tool_name}', {arguments})...")
-                result = await asyncio.wait_for(
-                    session.call_tool(tool_name, arguments),
-                    timeout=60.0
-                )
+                async with asyncio.timeout(60.0):
+                    result = await session.call_tool(tool_name, arguments)
                 print(f"✅ [MCP] session.call_tool retornou com sucesso")
                 print(f"📦 [MCP] Resultado RAW: {result}")
                 
@@ -604,26 +709,11 @@ class MCPService:
                 print(f"🔍 [MCP] Parsing resultado...")
                 content_list = []
                 for content_item in result.content:
-                    if isinstance(content_item, types.TextContent):
-                        content_list.append({
-                            "type": "text",
-                            "text": content_item.text
-                        })
-                    elif isinstance(content_item, types.ImageContent):
-                        content_list.append({
-                            "type": "image",
-                            "data": content_item.data,
-                            "mimeType": content_item.mimeType
-                        })
-                    elif isinstance(content_item, types.EmbeddedResource):
-                        # Recurso incorporado
-                        resource = content_item.resource
-                        if isinstance(resource, types.TextResourceContents):
-                            content_list.append({
-                                "type": "resource",
-                                "uri": str(resource.uri),
-                                "text": resource.text
-                            })
+                    handler = _CONTENT_HANDLERS.get(type(content_item))
+                    if handler:
+                        item = handler(content_item)
+                        if item is not None:
+                            content_list.append(item)
                 
                 # Extrair structured content se houver
                 structured_content = None
@@ -656,7 +746,7 @@ class MCPService:
                     "tempo_ms": tempo_ms
                 }
             
-            except asyncio.TimeoutError:
+            except TimeoutError:
                 print(f"⏱️  [MCP] TIMEOUT: Tool '{tool_name}' demorou mais de 60 segundos")
                 tempo_ms = int((time.time() - inicio) * 1000)
                 return {
@@ -665,6 +755,18 @@ class MCPService:
                     "enviado_usuario": False,
                     "tempo_ms": tempo_ms
                 }
+            except (anyio.ClosedResourceError, anyio.BrokenResourceError) as e:
+                # Sessão quebrada: descartar para reconectar na próxima chamada
+                # (o processo STDIO é mantido se ainda estiver vivo)
+                print(f"❌ [MCP] Sessão encerrada durante execução: {type(e).__name__}")
+                await MCPService.desconectar_cliente(mcp_client_id, manter_processo=True)
+                tempo_ms = int((time.time() - inicio) * 1000)
+                return {
+                    "resultado": {"erro": "Conexão com o servidor MCP foi encerrada, tente novamente"},
+                    "output": "llm",
+                    "enviado_usuario": False,
+                    "tempo_ms": tempo_ms
+                }
             except Exception as e:
                 print(f"❌ [MCP] EXCEÇÃO durante execução: {type(e).__name__}: {str(e)}")
                 import traceback
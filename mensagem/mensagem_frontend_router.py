@@ -1,16 +1,17 @@
 """
 Rotas do frontend para mensagens.
 """
+import hashlib
 from fastapi import APIRouter, Depends, Request, Query
-from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, StreamingResponse, Response
 from sqlalchemy.orm import Session
 from database import get_db
+from templating import criar_templates
 from mensagem.mensagem_service import MensagemService
 from sessao.sessao_service import SessaoService
 
 router = APIRouter(prefix="/mensagens", tags=["Frontend - Mensagens"])
-templates = Jinja2Templates(directory="templates")
+templates = criar_templates("mensagens.html", "conversa.html", "shared/erro.html")
 
 
 @router.get("/sessao/{sessao_id}", response_class=HTMLResponse)
@@ -21,24 +22,32 @@ def pagina_mensagens_sessao(
     db: Session = Depends(get_db)
 ):
     """Página de mensagens de uma sessão."""
-    sessao = SessaoService.obter_por_id(db, sessao_id)
+    sessao = SessaoService.obter_nome(db, sessao_id)
     if not sessao:
-        return templates.TemplateResponse("shared/erro.html", {
+        return HTMLResponse(templates.get_template("shared/erro.html").render({
             "request": request,
             "mensagem": "Sessão não encontrada",
             "titulo": "Erro"
-        })
+        }))
+    
+    # ETag a partir da versão das mensagens: se nada mudou, evita queries e renderização
+    versao = MensagemService.obter_versao_sessao(db, sessao_id, limite)
+    etag = '"' + hashlib.blake2b(
+        f"{sessao.nome}:{limite}:{versao}".encode(), digest_size=8
+    ).hexdigest() + '"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
     
     mensagens = MensagemService.listar_por_sessao(db, sessao_id, limite)
     clientes = MensagemService.obter_clientes_unicos(db, sessao_id)
     
-    return templates.TemplateResponse("mensagens.html", {
+    return HTMLResponse(templates.get_template("mensagens.html").render({
         "request": request,
         "sessao": sessao,
         "mensagens": mensagens,
         "clientes": clientes,
         "titulo": f"Mensagens - {sessao.nome}"
-    })
+    }), headers={"ETag": etag})
 
 
 @router.get("/sessao/{sessao_id}/cliente/{telefone}", response_class=HTMLResponse)
@@ -49,20 +58,23 @@ def pagina_conversa_cliente(
     db: Session = Depends(get_db)
 ):
     """Página de conversa com um cliente específico."""
-    sessao = SessaoService.obter_por_id(db, sessao_id)
+    sessao = SessaoService.obter_nome(db, sessao_id)
     if not sessao:
-        return templates.TemplateResponse("shared/erro.html", {
+        return HTMLResponse(templates.get_template("shared/erro.html").render({
             "request": request,
             "mensagem": "Sessão não encontrada",
             "titulo": "Erro"
-        })
+        }))
     
     mensagens = MensagemService.listar_por_cliente(db, sessao_id, telefone, limite=100)
     
-    return templates.TemplateResponse("conversa.html", {
+    # Renderização em stream: envia o HTML em blocos enquanto o loop de mensagens é renderizado
+    stream = templates.get_template("conversa.html").stream({
         "request": request,
         "sessao": sessao,
         "telefone_cliente": telefone,
         "mensagens": mensagens,
         "titulo": f"Conversa com {telefone}"
     })
+    stream.enable_buffering(8)
+    return StreamingResponse(stream, media_type="text/html")
@@ -1,10 +1,42 @@
 """
 Modelo de dados para mensagens.
 """
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, JSON, Index, desc, Enum as SQLEnum
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
+from enum import Enum
+
+
+class TipoMensagem(str, Enum):
+    """Tipos de conteúdo de mensagem."""
+    TEXTO = "texto"
+    IMAGEM = "imagem"
+    DOCUMENTO = "documento"
+    AUDIO = "audio"
+    VIDEO = "video"
+
+    def __str__(self):
+        return self.value
+
+
+class DirecaoMensagem(str, Enum):
+    """Direção da mensagem."""
+    RECEBIDA = "recebida"
+    ENVIADA = "enviada"
+
+    def __str__(self):
+        return self.value
+
+
+# JSON binário (JSONB) no PostgreSQL; JSON comum nos demais bancos (ex: SQLite)
+JSONVariante = JSON().with_variant(JSONB(), "postgresql")
+
+
+def _valores_enum(enum_cls):
+    """Persiste o valor (ex: "texto") em vez do nome do membro, mantendo compatibilidade com os dados existentes."""
+    return [membro.value for membro in enum_cls]
 
 
 class Mensagem(Base):
@@ -13,9 +45,21 @@ class Mensagem(Base):
     Armazena todas as mensagens recebidas e enviadas.
     """
     __tablename__ = "mensagens"
+    __table_args__ = (
+        # Índices compostos para os filtros/ordenações mais usados
+        Index("ix_mensagens_sessao_criado", "sessao_id", "criado_em"),
+        Index("ix_mensagens_sessao_id_keyset", "sessao_id", "id"),
+        # Histórico por cliente (listar_por_cliente, #status, #limpar): mesma ordem do ORDER BY
+        Index(
+            "ix_mensagens_sessao_telefone_criado_desc",
+            "sessao_id", "telefone_cliente", desc("criado_em"), desc("id")
+        ),
+        # GIN para consultas dentro do JSONB (apenas PostgreSQL)
+        Index("ix_mensagens_ferramentas_gin", "ferramentas_usadas", postgresql_using="gin").ddl_if(dialect="postgresql"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    sessao_id = Column(Integer, ForeignKey("sessoes.id"), nullable=False, index=True)
+    sessao_id = Column(Integer, ForeignKey("sessoes.id"), nullable=False)  # indexado pelos índices compostos
     
     # Identificação
     telefone_cliente = Column(String(20), nullable=False, index=True)
@@ -23,18 +67,25 @@ class Mensagem(Base):
     mensagem_id_whatsapp = Column(String(100), nullable=True, index=True)
     
     # Tipo e direção
-    tipo = Column(String(20), nullable=False, default="texto")  # texto, imagem, documento, audio, video
-    direcao = Column(String(10), nullable=False)  # recebida, enviada
+    tipo = Column(
+        SQLEnum(TipoMensagem, name="tipo_mensagem", values_callable=_valores_enum),
+        nullable=False,
+        default=TipoMensagem.TEXTO
+    )
+    direcao = Column(
+        SQLEnum(DirecaoMensagem, name="direcao_mensagem", values_callable=_valores_enum),
+        nullable=False
+    )
     
     # Conteúdo
     conteudo_texto = Column(Text, nullable=True)
     conteudo_imagem_path = Column(String(500), nullable=True)  # Caminho local da imagem
-    conteudo_imagem_base64 = Column(Text, nullable=True)  # Imagem em base64
+    conteudo_imagem_base64 = Column(Text, nullable=True)  # Legado: novas imagens ficam apenas em disco (path/url)
     conteudo_imagem_url = Column(String(500), nullable=True)  # URL da imagem
     conteudo_mime_type = Column(String(100), nullable=True)
     
     # Metadados da conversa
-    contexto = Column(JSON, nullable=True)  # Histórico de mensagens para contexto
+    contexto = Column(JSONVariante, nullable=True)  # Histórico de mensagens para contexto
     
     # Resposta do agente
     resposta_texto = Column(Text, nullable=True)
@@ -45,7 +96,7 @@ class Mensagem(Base):
     resposta_erro = Column(Text, nullable=True)
     
     # Ferramentas utilizadas
-    ferramentas_usadas = Column(JSON, nullable=True)  # Lista de ferramentas chamadas
+    ferramentas_usadas = Column(JSONVariante, nullable=True)  # Lista de ferramentas chamadas
     
     # Status
     processada = Column(Boolean, default=False)
@@ -57,7 +108,9 @@ class Mensagem(Base):
     respondido_em = Column(DateTime(timezone=True), nullable=True)
     
     # Relacionamentos
-    sessao = relationship("Sessao", back_populates="mensagens")
+    # lazy="raise": acesso sem carregamento explícito (selectinload/joinedload) falha
+    # em vez de disparar uma query por linha ao serializar listas de mensagens
+    sessao = relationship("Sessao", back_populates="mensagens", lazy="raise")
 
     def __repr__(self):
         return f"<Mensagem(id={self.id}, telefone='{self.telefone_cliente}', tipo='{self.tipo}', direcao='{self.direcao}')>"
@@ -2,25 +2,40 @@
 Rotas da API para mensagens.
 """
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 from database import get_db
 from mensagem.mensagem_schema import MensagemResposta, MensagemEnviar, HistoricoMensagens
 from mensagem.mensagem_service import MensagemService
 from sessao.sessao_service import SessaoService
 
-router = APIRouter(prefix="/api/mensagens", tags=["Mensagens"])
+router = APIRouter(
+    prefix="/api/mensagens",
+    tags=["Mensagens"],
+    default_response_class=ORJSONResponse  # serialização JSON mais rápida (datetime nativo)
+)
 
 
 @router.get("/sessao/{sessao_id}", response_model=List[MensagemResposta])
 def listar_mensagens_sessao(
     sessao_id: int,
     limite: int = Query(default=100, le=500),
-    offset: int = Query(default=0, ge=0),
+    antes_de_id: Optional[int] = Query(default=None, description="ID da última mensagem da página anterior"),
+    offset: int = Query(default=0, ge=0, deprecated=True, description="Obsoleto: use antes_de_id"),
     db: Session = Depends(get_db)
 ):
-    """Lista mensagens de uma sessão."""
-    return MensagemService.listar_por_sessao(db, sessao_id, limite, offset)
+    """
+    Lista mensagens de uma sessão (paginação por cursor).
+    O cursor da próxima página vem no cabeçalho X-Proximo-Cursor (ausente na última página).
+    """
+    # Linhas já projetadas nas colunas de MensagemResposta: serializadas direto pelo orjson,
+    # sem objetos ORM nem validação por item
+    mensagens = MensagemService.listar_dados_por_sessao(db, sessao_id, limite, antes_de_id, offset)
+    resposta = ORJSONResponse(mensagens)
+    if len(mensagens) == limite:
+        resposta.headers["X-Proximo-Cursor"] = str(mensagens[-1]["id"])
+    return resposta
 
 
 @router.get("/sessao/{sessao_id}/cliente/{telefone}", response_model=HistoricoMensagens)
@@ -28,14 +43,19 @@ def listar_mensagens_cliente(
     sessao_id: int,
     telefone: str,
     limite: int = Query(default=50, le=200),
+    cursor: Optional[int] = Query(default=None, description="ID da última mensagem da página anterior"),
     db: Session = Depends(get_db)
 ):
-    """Lista mensagens de um cliente específico."""
-    mensagens = MensagemService.listar_por_cliente(db, sessao_id, telefone, limite)
+    """Lista mensagens de um cliente específico (paginação por cursor)."""
+    mensagens = MensagemService.listar_por_cliente(
+        db, sessao_id, telefone, limite, antes_de_id=cursor
+    )
+    total = MensagemService.contar_mensagens_por_cliente(db, sessao_id, telefone)
     return HistoricoMensagens(
         telefone_cliente=telefone,
         mensagens=mensagens,
-        total=len(mensagens)
+        total=total,
+        proximo_cursor=mensagens[-1].id if len(mensagens) == limite else None
     )
 
 
@@ -48,9 +68,20 @@ def obter_mensagem(mensagem_id: int, db: Session = Depends(get_db)):
     return mensagem
 
 
+def _registro_enviada(mensagem: MensagemEnviar) -> dict:
+    """Colunas da mensagem enviada, para gravação com MensagemService.criar_em_lote."""
+    return {
+        "sessao_id": mensagem.sessao_id,
+        "telefone_cliente": mensagem.telefone_destino,
+        "tipo": "texto",
+        "direcao": "enviada",
+        "conteudo_texto": mensagem.texto
+    }
+
+
 @router.post("/enviar")
 def enviar_mensagem(mensagem: MensagemEnviar, db: Session = Depends(get_db)):
-    """Envia uma mensagem através de uma sessão."""
+    """Envia uma mensagem através de uma sessão e a registra como enviada."""
     try:
         sucesso = SessaoService.enviar_mensagem(
             db,
@@ -60,6 +91,7 @@ def enviar_mensagem(mensagem: MensagemEnviar, db: Session = Depends(get_db)):
         )
         
         if sucesso:
+            MensagemService.criar_em_lote(db, [_registro_enviada(mensagem)])
             return {"mensagem": "Mensagem enviada com sucesso"}
         else:
             raise HTTPException(status_code=500, detail="Erro ao enviar mensagem")
@@ -67,15 +99,51 @@ def enviar_mensagem(mensagem: MensagemEnviar, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@router.get("/sessao/{sessao_id}/estatisticas")
+@router.post("/enviar_lote")
+def enviar_mensagens_lote(mensagens: List[MensagemEnviar], db: Session = Depends(get_db)):
+    """
+    Envia várias mensagens e registra as enviadas com um único INSERT em lote.
+    """
+    resultados = []
+    enviadas = []
+    try:
+        for mensagem in mensagens:
+            try:
+                SessaoService.enviar_mensagem(
+                    db,
+                    mensagem.sessao_id,
+                    mensagem.telefone_destino,
+                    mensagem.texto
+                )
+                enviadas.append(_registro_enviada(mensagem))
+                resultados.append({"telefone_destino": mensagem.telefone_destino, "sucesso": True})
+            except ValueError as e:
+                resultados.append({
+                    "telefone_destino": mensagem.telefone_destino,
+                    "sucesso": False,
+                    "erro": str(e)
+                })
+    finally:
+        # Registra as já entregues mesmo se o laço for interrompido por um erro inesperado
+        MensagemService.criar_em_lote(db, enviadas)
+    
+    return {
+        "total": len(mensagens),
+        "enviadas": len(enviadas),
+        "resultados": resultados
+    }
+
+
+@router.get("/sessao/{sessao_id}/estatisticas", include_in_schema=False)
 def obter_estatisticas_sessao(sessao_id: int, db: Session = Depends(get_db)):
     """Obtém estatísticas de mensagens de uma sessão."""
-    total = MensagemService.contar_mensagens_por_sessao(db, sessao_id)
-    ultimos_7_dias = MensagemService.contar_mensagens_por_periodo(db, sessao_id, 7)
-    clientes_unicos = len(MensagemService.obter_clientes_unicos(db, sessao_id))
+    estatisticas = MensagemService.obter_estatisticas_sessao(db, sessao_id, dias=7)
     
     return {
-        "total_mensagens": total,
-        "mensagens_7_dias": ultimos_7_dias,
-        "clientes_unicos": clientes_unicos
+        "total_mensagens": estatisticas["total_mensagens"],
+        "mensagens_7_dias": estatisticas["mensagens_periodo"],
+        "clientes_unicos": estatisticas["clientes_unicos"],
+        "tempo_medio_resposta_ms": estatisticas["tempo_medio_resposta_ms"],
+        "total_tokens_input": estatisticas["total_tokens_input"],
+        "total_tokens_output": estatisticas["total_tokens_output"]
     }
@@ -1,7 +1,7 @@
 """
 Schemas Pydantic para validação de mensagens.
 """
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 
@@ -23,6 +23,8 @@ class MensagemCriar(MensagemBase):
 
 class MensagemResposta(MensagemBase):
     """Schema de resposta com dados completos."""
+    model_config = ConfigDict(from_attributes=True)
+
     id: int
     mensagem_id_whatsapp: Optional[str] = None
     conteudo_imagem_path: Optional[str] = None
@@ -41,9 +43,6 @@ class MensagemResposta(MensagemBase):
     processado_em: Optional[datetime] = None
     respondido_em: Optional[datetime] = None
 
-    class Config:
-        from_attributes = True
-
 
 class MensagemEnviar(BaseModel):
     """Schema para enviar mensagem."""
@@ -57,3 +56,7 @@ class HistoricoMensagens(BaseModel):
     telefone_cliente: str
     mensagens: List[MensagemResposta]
     total: int
+    proximo_cursor: Optional[int] = Field(
+        default=None,
+        description="ID a ser enviado em 'cursor' para buscar a próxima página (None se não houver)"
+    )
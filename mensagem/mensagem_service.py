@@ -1,17 +1,68 @@
 """
 Serviço de lógica de negócio para mensagens.
 """
-from sqlalchemy.orm import Session
-from typing import Optional, List
+from sqlalchemy.orm import Session, defer
+from sqlalchemy import func, case, distinct, or_, and_, insert, select
+from typing import Optional, List, Dict, Any
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
 import os
+import threading
+import time
+import uuid
+import asyncio
+import logging
 import base64
 from pathlib import Path
 from PIL import Image
 import io
+import numpy as np
 from neonize.events import MessageEv
-from mensagem.mensagem_model import Mensagem
-from mensagem.mensagem_schema import MensagemCriar
+from neonize.utils import build_jid
+from mensagem.mensagem_model import Mensagem, TipoMensagem, DirecaoMensagem
+from mensagem.mensagem_schema import MensagemCriar, MensagemResposta
+from metrica.metrica_service import MetricaService
+
+logger = logging.getLogger(__name__)
+
+# Encoder JPEG opcional (libjpeg-turbo direto, sem o wrapper do PIL); usado sempre
+# que instalado
+try:
+    import simplejpeg
+    SIMPLEJPEG_AVAILABLE = True
+except ImportError:
+    SIMPLEJPEG_AVAILABLE = False
+
+# Otimização de Huffman + JPEG progressivo no encoder do PIL (arquivos ~3-5% menores,
+# um pouco mais de CPU); sem efeito quando o simplejpeg está instalado.
+JPEG_OPTIMIZE = os.getenv("JPEG_OPTIMIZE", "True").lower() == "true"
+
+# JPEGs RGB até este tamanho são gravados como chegaram (sem decodificar/recodificar)
+JPEG_MAX_BYTES_SEM_RECODIFICAR = 500_000
+
+# Maior dimensão (px) das imagens salvas; imagens maiores são reduzidas antes do encode
+MAX_IMAGE_DIM = int(os.getenv("MAX_IMAGE_DIM", "1600"))
+
+# Colunas grandes que não fazem parte de MensagemResposta (não carregadas em listagens).
+# Os defer() são criados por query: criá-los na importação forçaria a configuração
+# dos mappers antes de todos os modelos estarem registrados.
+_COLUNAS_PESADAS = (
+    Mensagem.conteudo_imagem_base64,
+    Mensagem.contexto,
+)
+
+# Colunas expostas por MensagemResposta (para listagens que não precisam de objetos ORM)
+_COLUNAS_RESPOSTA = tuple(getattr(Mensagem, campo) for campo in MensagemResposta.model_fields)
+
+# Cache em memória de clientes únicos por sessão: sessao_id -> (expira_em, telefones)
+_CLIENTES_UNICOS_TTL = 60  # segundos
+_clientes_unicos_cache: Dict[int, tuple] = {}
+
+# Cache LRU do base64 das imagens salvas: caminho -> base64 do JPEG gravado em disco
+# (evita reler e recodificar as imagens do histórico a cada mensagem processada)
+_IMAGENS_BASE64_MAX = 32
+_imagens_base64_cache: "OrderedDict[str, str]" = OrderedDict()
+_imagens_base64_lock = threading.Lock()  # usado pelas threads das sessões
 
 
 class MensagemService:
@@ -22,33 +73,105 @@ class MensagemService:
         db: Session,
         sessao_id: int,
         limite: int = 100,
-        offset: int = 0
+        antes_de_id: Optional[int] = None
     ) -> List[Mensagem]:
-        """Lista mensagens de uma sessão."""
-        return db.query(Mensagem)\
-            .filter(Mensagem.sessao_id == sessao_id)\
-            .order_by(Mensagem.criado_em.desc())\
+        """
+        Lista mensagens de uma sessão (sem as colunas pesadas), mais recentes primeiro.
+        
+        Args:
+            antes_de_id: Cursor de paginação (keyset) - retorna apenas mensagens com id menor
+        """
+        query = db.query(Mensagem)\
+            .options(*[defer(coluna) for coluna in _COLUNAS_PESADAS])\
+            .filter(Mensagem.sessao_id == sessao_id)
+        if antes_de_id is not None:
+            query = query.filter(Mensagem.id < antes_de_id)
+        return query\
+            .order_by(Mensagem.id.desc())\
             .limit(limite)\
-            .offset(offset)\
             .all()
 
+    @staticmethod
+    def listar_dados_por_sessao(
+        db: Session,
+        sessao_id: int,
+        limite: int = 100,
+        antes_de_id: Optional[int] = None,
+        offset: int = 0
+    ) -> List[Dict[str, Any]]:
+        """
+        Lista mensagens de uma sessão como dicts prontos para serialização JSON.
+        Seleciona apenas as colunas de MensagemResposta, sem criar objetos ORM; todos os
+        campos do schema são emitidos (None vira null). Paginação por keyset em id.
+        
+        Args:
+            offset: Paginação antiga por deslocamento (obsoleta); ignorada se antes_de_id
+                for informado
+        """
+        query = db.query(*_COLUNAS_RESPOSTA)\
+            .filter(Mensagem.sessao_id == sessao_id)
+        if antes_de_id is not None:
+            query = query.filter(Mensagem.id < antes_de_id)
+        query = query.order_by(Mensagem.id.desc()).limit(limite)
+        if antes_de_id is None and offset:
+            query = query.offset(offset)
+        linhas = query.all()
+        return [dict(linha._mapping) for linha in linhas]
+
     @staticmethod
     def listar_por_cliente(
         db: Session,
         sessao_id: int,
         telefone_cliente: str,
-        limite: int = 50
+        limite: int = 50,
+        com_imagens: bool = False,
+        antes_de_id: Optional[int] = None
     ) -> List[Mensagem]:
-        """Lista mensagens de um cliente específico."""
-        return db.query(Mensagem)\
-            .filter(
-                Mensagem.sessao_id == sessao_id,
-                Mensagem.telefone_cliente == telefone_cliente
-            )\
-            .order_by(Mensagem.criado_em.desc())\
+        """
+        Lista mensagens de um cliente específico (mais recentes primeiro).
+        As colunas pesadas só são carregadas se com_imagens=True (ex: histórico para o LLM).
+        
+        Args:
+            antes_de_id: Cursor de paginação (keyset) - retorna apenas mensagens
+                anteriores à mensagem com este ID, na ordem (criado_em, id)
+        """
+        query = db.query(Mensagem)
+        if not com_imagens:
+            query = query.options(*[defer(coluna) for coluna in _COLUNAS_PESADAS])
+        else:
+            query = query.options(defer(Mensagem.contexto))
+        
+        query = query.filter(
+            Mensagem.sessao_id == sessao_id,
+            Mensagem.telefone_cliente == telefone_cliente
+        )
+        
+        if antes_de_id is not None:
+            criado_em_cursor = db.query(Mensagem.criado_em)\
+                .filter(Mensagem.id == antes_de_id)\
+                .scalar_subquery()
+            query = query.filter(or_(
+                Mensagem.criado_em < criado_em_cursor,
+                and_(Mensagem.criado_em == criado_em_cursor, Mensagem.id < antes_de_id)
+            ))
+        
+        return query\
+            .order_by(Mensagem.criado_em.desc(), Mensagem.id.desc())\
             .limit(limite)\
             .all()
 
+    @staticmethod
+    def contar_mensagens_por_cliente(db: Session, sessao_id: int, telefone_cliente: str) -> int:
+        """Conta total de mensagens de um cliente."""
+        return db.scalar(
+            select(func.count())
+            .select_from(Mensagem)
+            .where(
+                Mensagem.sessao_id == sessao_id,
+                Mensagem.telefone_cliente == telefone_cliente
+            )
+        )
+
     @staticmethod
     def obter_por_id(db: Session, mensagem_id: int) -> Optional[Mensagem]:
         """Obtém uma mensagem pelo ID."""
@@ -59,45 +182,157 @@ class MensagemService:
         """Cria uma nova mensagem."""
         db_mensagem = Mensagem(**mensagem.model_dump())
         db.add(db_mensagem)
+        if db_mensagem.direcao == DirecaoMensagem.RECEBIDA:
+            MetricaService.incrementar_contagem_clientes(
+                db, {(db_mensagem.sessao_id, db_mensagem.telefone_cliente): 1}
+            )
         db.commit()
         db.refresh(db_mensagem)
+        MensagemService.mensagens_alteradas(db_mensagem.sessao_id)
         return db_mensagem
 
+    @staticmethod
+    def criar_em_lote(db: Session, mensagens: List[Dict[str, Any]]) -> int:
+        """
+        Cria várias mensagens de uma vez (executemany/insertmanyvalues, um único commit).
+        
+        Args:
+            mensagens: Lista de dicts com as colunas de Mensagem
+        
+        Returns:
+            Número de mensagens inseridas
+        """
+        if not mensagens:
+            return 0
+        
+        db.execute(insert(Mensagem), mensagens)
+        MetricaService.incrementar_contagem_clientes(db, Counter(
+            (m["sessao_id"], m["telefone_cliente"])
+            for m in mensagens
+            if m.get("direcao") == DirecaoMensagem.RECEBIDA
+        ))
+        db.commit()
+        
+        for sessao_id in {m["sessao_id"] for m in mensagens}:
+            MensagemService.mensagens_alteradas(sessao_id)
+        return len(mensagens)
+
+    @staticmethod
+    def _encode_jpeg(img: Image.Image, quality: int = 85) -> bytes:
+        """
+        Codifica uma imagem RGB em JPEG e retorna os bytes.
+        Usa o simplejpeg (libjpeg-turbo) quando disponível; senão o PIL, com
+        optimize/progressive se JPEG_OPTIMIZE.
+        """
+        if SIMPLEJPEG_AVAILABLE:
+            return simplejpeg.encode_jpeg(
+                np.asarray(img), quality=quality, colorspace='RGB', colorsubsampling='420'
+            )
+        
+        # kwargs explícitos (não repassar img.info ao encoder)
+        opcoes = {"quality": quality, "subsampling": 2}
+        if JPEG_OPTIMIZE:
+            opcoes.update(optimize=True, progressive=True)
+        
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', **opcoes)
+        return buffer.getvalue()
+
     @staticmethod
     def salvar_imagem(imagem_bytes: bytes, telefone: str, sessao_id: int) -> tuple[str, str]:
         """
-        Salva uma imagem localmente e retorna o caminho e base64.
+        Salva uma imagem em disco (uploads/) e retorna o caminho e a URL pública.
+        A imagem não é mais guardada em base64 no banco.
         
         Returns:
-            tuple: (caminho_arquivo, base64_string)
+            tuple: (caminho_arquivo, url)
         """
         # Criar diretório se não existir
-        upload_dir = Path("./uploads") / f"sessao_{sessao_id}" / telefone
+        upload_dir = Path("uploads") / f"sessao_{sessao_id}" / telefone
         upload_dir.mkdir(parents=True, exist_ok=True)
         
-        # Gerar nome único para arquivo
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"img_{timestamp}.jpg"
+        # Gerar nome único para arquivo (álbuns chegam várias imagens no mesmo
+        # segundo e são processados em paralelo; o arquivo é a única cópia)
+        filename = f"{uuid.uuid4().hex}.jpg"
         filepath = upload_dir / filename
         
         # Salvar imagem
         try:
-            # Abrir e converter para RGB (caso seja RGBA)
+            # Abrir (só lê o cabeçalho; os pixels são decodificados sob demanda)
             img = Image.open(io.BytesIO(imagem_bytes))
-            if img.mode in ('RGBA', 'LA', 'P'):
-                img = img.convert('RGB')
             
-            # Salvar
-            img.save(filepath, 'JPEG', quality=85)
+            limite = (MAX_IMAGE_DIM, MAX_IMAGE_DIM)
+            
+            if (
+                imagem_bytes[:3] == b"\xff\xd8\xff"
+                and len(imagem_bytes) <= JPEG_MAX_BYTES_SEM_RECODIFICAR
+                and img.mode == 'RGB'
+                and max(img.size) <= MAX_IMAGE_DIM
+            ):
+                # JPEG já utilizável (caso comum do WhatsApp): grava os bytes originais
+                jpeg_bytes = imagem_bytes
+            else:
+                if img.format == 'JPEG':
+                    # Reduzir antes de converter: para JPEG o thumbnail usa draft()
+                    # e decodifica já em escala menor (DCT scaling)
+                    img.thumbnail(limite, Image.Resampling.LANCZOS)
+                
+                # Converter para RGB (caso seja RGBA/P/CMYK...) e recodificar
+                if img.mode != 'RGB':
+                    img = img.convert('RGB')
+                img.thumbnail(limite, Image.Resampling.LANCZOS)
+                jpeg_bytes = MensagemService._encode_jpeg(img, quality=85)
             
-            # Converter para base64
-            base64_string = base64.b64encode(imagem_bytes).decode('utf-8')
+            # Usar os mesmos bytes para o arquivo e o base64
+            filepath.write_bytes(jpeg_bytes)
+            MensagemService._guardar_base64(
+                str(filepath), base64.b64encode(jpeg_bytes).decode('utf-8')
+            )
             
-            return str(filepath), base64_string
+            return str(filepath), f"/{filepath.as_posix()}"
         except Exception as e:
-            print(f"Erro ao salvar imagem: {e}")
+            logger.error("Erro ao salvar imagem: %s", e)
             return None, None
 
+    @staticmethod
+    def obter_imagem_data_url(mensagem: Mensagem) -> Optional[str]:
+        """
+        Retorna a imagem da mensagem como data URL (para envio ao LLM).
+        Lê o arquivo salvo em disco; mensagens antigas ainda usam o base64 do banco.
+        """
+        if mensagem.conteudo_imagem_base64:
+            mime_type = mensagem.conteudo_mime_type or "image/jpeg"
+            return f"data:{mime_type};base64,{mensagem.conteudo_imagem_base64}"
+        
+        caminho = mensagem.conteudo_imagem_path
+        if not caminho:
+            return None
+        
+        with _imagens_base64_lock:
+            base64_string = _imagens_base64_cache.get(caminho)
+            if base64_string is not None:
+                _imagens_base64_cache.move_to_end(caminho)
+        if base64_string is None:
+            try:
+                with open(caminho, "rb") as f:
+                    base64_string = base64.b64encode(f.read()).decode('utf-8')
+            except OSError as e:
+                logger.warning("Erro ao ler imagem %s: %s", caminho, e)
+                return None
+            MensagemService._guardar_base64(caminho, base64_string)
+        
+        # Arquivos em disco são sempre re-codificados como JPEG
+        return f"data:image/jpeg;base64,{base64_string}"
+
+    @staticmethod
+    def _guardar_base64(caminho: str, base64_string: str):
+        """Guarda o base64 de uma imagem no cache LRU, descartando a mais antiga."""
+        with _imagens_base64_lock:
+            _imagens_base64_cache[caminho] = base64_string
+            _imagens_base64_cache.move_to_end(caminho)
+            while len(_imagens_base64_cache) > _IMAGENS_BASE64_MAX:
+                _imagens_base64_cache.popitem(last=False)
+
     @staticmethod
     async def processar_mensagem_recebida(
         db: Session,
@@ -106,8 +341,13 @@ class MensagemService:
     ):
         """
         Processa uma mensagem recebida do WhatsApp.
+        
+        Roda no event loop de um worker do pool de mensagens (ver
+        sessao_service._processar_mensagem), com uma Session exclusiva: as queries
+        síncronas não bloqueiam o loop do FastAPI nem outras mensagens. Não mover
+        as chamadas de `db` para asyncio.to_thread - a Session não é thread-safe.
         """
-        from sessao.sessao_service import SessaoService
+        from sessao.sessao_service import SessaoService, gerenciador_sessoes
         from agente.agente_service import AgenteService
         
         # Obter informações da mensagem
@@ -127,13 +367,17 @@ class MensagemService:
         if not sessao or not sessao.ativa:
             return
         
+        # Cliente WhatsApp e JID do remetente (resolvidos uma única vez)
+        cliente = gerenciador_sessoes.obter_cliente(sessao_id)
+        jid = build_jid(telefone_cliente) if cliente else None
+        
         # Criar registro de mensagem
         db_mensagem = Mensagem(
             sessao_id=sessao_id,
             telefone_cliente=telefone_cliente,
             mensagem_id_whatsapp=info.ID,
-            tipo="texto",
-            direcao="recebida",
+            tipo=TipoMensagem.TEXTO,
+            direcao=DirecaoMensagem.RECEBIDA,
             processada=False,
             respondida=False
         )
@@ -142,205 +386,40 @@ class MensagemService:
         if hasattr(message, 'conversation') and message.conversation:
             # Mensagem de texto
             db_mensagem.conteudo_texto = message.conversation
-            db_mensagem.tipo = "texto"
-            print(f"📝 Mensagem de texto: {message.conversation[:50]}...")
-            
-            # Verificar comandos especiais
-            comando = message.conversation.strip().lower()
-            if comando == "#limpar":
-                print(f"🧹 Comando #limpar recebido de {telefone_cliente}")
-                
-                # Deletar histórico de mensagens deste cliente
-                mensagens_deletadas = db.query(Mensagem)\
-                    .filter(
-                        Mensagem.sessao_id == sessao_id,
-                        Mensagem.telefone_cliente == telefone_cliente
-                    )\
-                    .delete()
-                
-                db.commit()
-                print(f"✅ {mensagens_deletadas} mensagem(ns) deletada(s)")
-                
-                # Enviar confirmação
-                from sessao.sessao_service import gerenciador_sessoes
-                cliente = gerenciador_sessoes.obter_cliente(sessao_id)
-                
-                if cliente:
-                    from neonize.utils import build_jid
-                    jid = build_jid(telefone_cliente)
-                    cliente.send_message(
-                        jid, 
-                        message="🧹 *Histórico limpo!*\n\nSeu histórico de conversas foi apagado.\nVamos começar uma nova conversa! 🆕"
-                    )
-                    print(f"📤 Confirmação enviada ao usuário")
-                
-                return  # Não processar com agente
-
-            elif comando == "#ajuda" or comando == "#help":
-                print(f"ℹ️  Comando #ajuda recebido de {telefone_cliente}")
-                
-                from sessao.sessao_service import gerenciador_sessoes
-                cliente = gerenciador_sessoes.obter_cliente(sessao_id)
-                
-                if cliente:
-                    from neonize.utils import build_jid
-                    jid = build_jid(telefone_cliente)
-                    
-                    ajuda_texto = """📚 *Comandos Disponíveis:*
-
-🤖 *#listar* - Lista todos os agentes disponíveis
-🔄 *#01, #02...* - Ativa um agente específico
-🧹 *#limpar* - Apaga todo o histórico de conversas
-ℹ️ *#ajuda* - Mostra esta mensagem
-📊 *#status* - Mostra informações da sessão
-
-💬 Para conversar normalmente, basta enviar sua mensagem!"""
-                    
-                    cliente.send_message(jid, message=ajuda_texto)
-                    print(f"📤 Ajuda enviada ao usuário")
-                
-                return  # Não processar com agente
-            
-            elif comando == "#status":
-                print(f"📊 Comando #status recebido de {telefone_cliente}")
-                
-                # Contar mensagens do usuário
-                total_msgs = db.query(Mensagem)\
-                    .filter(
-                        Mensagem.sessao_id == sessao_id,
-                        Mensagem.telefone_cliente == telefone_cliente
-                    )\
-                    .count()
-                
-                from sessao.sessao_service import gerenciador_sessoes
-                cliente = gerenciador_sessoes.obter_cliente(sessao_id)
-                
-                if cliente:
-                    from neonize.utils import build_jid
-                    from agente.agente_service import AgenteService
-                    jid = build_jid(telefone_cliente)
-                    
-                    # Obter agente ativo
-                    agente_nome = "Nenhum"
-                    if sessao.agente_ativo_id:
-                        agente_ativo = AgenteService.obter_por_id(db, sessao.agente_ativo_id)
-                        if agente_ativo:
-                            agente_nome = f"#{agente_ativo.codigo} - {agente_ativo.nome}"
-                    
-                    status_texto = f"""📊 *Status da Sessão:*
-
-💬 Total de mensagens: {total_msgs}
-✅ Sessão ativa e conectada
-🤖 Agente ativo: {agente_nome}
-
-Digite *#ajuda* para ver comandos disponíveis."""
-                    
-                    cliente.send_message(jid, message=status_texto)
-                    print(f"📤 Status enviado ao usuário")
-                
-                return  # Não processar com agente    
-            # Comando para listar agentes
-            elif comando == "#listar":
-                print(f"📋 Comando #listar recebido de {telefone_cliente}")
-                
-                from agente.agente_service import AgenteService
-                agentes = AgenteService.listar_por_sessao_ativos(db, sessao_id)
-                
-                from sessao.sessao_service import gerenciador_sessoes
-                cliente = gerenciador_sessoes.obter_cliente(sessao_id)
-                
-                if cliente:
-                    from neonize.utils import build_jid
-                    jid = build_jid(telefone_cliente)
-                    
-                    if agentes:
-                        lista_texto = "🤖 *Agentes Disponíveis:*\n\n"
-                        for agente in agentes:
-                            # Marcar agente ativo
-                            marcador = "✅" if sessao.agente_ativo_id == agente.id else "⚪"
-                            lista_texto += f"{marcador} *#{agente.codigo}* - {agente.nome}\n"
-                            if agente.descricao:
-                                lista_texto += f"   _{agente.descricao}_\n"
-                            lista_texto += "\n"
-                        
-                        lista_texto += "\n💡 *Como usar:*\n"
-                        lista_texto += "Digite *#XX* para ativar um agente\n"
-                        lista_texto += "Exemplo: *#01* para ativar o agente 01"
-                    else:
-                        lista_texto = "⚠️ *Nenhum agente disponível*\n\n"
-                        lista_texto += "Entre em contato com o administrador para configurar agentes."
-                    
-                    cliente.send_message(jid, message=lista_texto)
-                    print(f"📤 Lista de agentes enviada ao usuário")
-                
-                return  # Não processar com agente
+            db_mensagem.tipo = TipoMensagem.TEXTO
+            logger.debug("📝 Mensagem de texto: %s...", message.conversation[:50])
             
-            # Comando para ativar agente (formato: #01, #02, etc.)
-            elif comando.startswith("#") and len(comando) >= 2:
-                codigo_agente = comando[1:]  # Remove o #
-                print(f"🔄 Comando de troca de agente recebido: {codigo_agente}")
-                
-                from agente.agente_service import AgenteService
-                agente = AgenteService.obter_por_codigo(db, sessao_id, codigo_agente)
-                
-                from sessao.sessao_service import gerenciador_sessoes
-                cliente = gerenciador_sessoes.obter_cliente(sessao_id)
-                
-                if agente and agente.ativo:
-                    # Ativar agente
-                    sessao.agente_ativo_id = agente.id
-                    db.commit()
-                    
-                    if cliente:
-                        from neonize.utils import build_jid
-                        jid = build_jid(telefone_cliente)
-                        
-                        confirmacao = f"✅ *Agente Ativado!*\n\n"
-                        confirmacao += f"🤖 *{agente.nome}*\n"
-                        if agente.descricao:
-                            confirmacao += f"_{agente.descricao}_\n\n"
-                        confirmacao += f"Agora estou pronto para ajudar como {agente.agente_papel}!"
-                        
-                        cliente.send_message(jid, message=confirmacao)
-                        print(f"✅ Agente {agente.codigo} ativado para sessão {sessao_id}")
-                    
+            # Verificar comandos especiais (só textos que começam com "#";
+            # a mensagem comum segue direto para o agente)
+            texto = message.conversation.lstrip()
+            if texto[:1] == "#":
+                comando = texto.rstrip().lower()
+                handler = _COMANDOS.get(comando)
+                if handler:
+                    handler(db, sessao, telefone_cliente, cliente, jid)
                     return  # Não processar com agente
-                elif cliente:
-                    # Agente não encontrado
-                    from neonize.utils import build_jid
-                    jid = build_jid(telefone_cliente)
-                    
-                    erro_msg = f"❌ *Agente não encontrado*\n\n"
-                    erro_msg += f"O código *#{codigo_agente}* não corresponde a nenhum agente ativo.\n\n"
-                    erro_msg += "Digite *#listar* para ver os agentes disponíveis."
-                    
-                    cliente.send_message(jid, message=erro_msg)
-                    print(f"⚠️ Agente {codigo_agente} não encontrado")
-                    
+                
+                # Comando para ativar agente (formato: #01, #02, etc.)
+                if len(comando) >= 2 and _cmd_ativar_agente(db, sessao, telefone_cliente, cliente, jid, comando[1:]):
                     return  # Não processar com agente
-            
-
-            
-            
         
         elif hasattr(message, 'imageMessage') and message.imageMessage:
             # Mensagem com imagem
-            db_mensagem.tipo = "imagem"
-            db_mensagem.conteudo_texto = message.imageMessage.caption if hasattr(message.imageMessage, 'caption') else ""
-            print(f"🖼️  Mensagem com imagem")
+            img_msg = message.imageMessage
+            db_mensagem.tipo = TipoMensagem.IMAGEM
+            db_mensagem.conteudo_texto = img_msg.caption or ""
+            logger.debug("🖼️  Mensagem com imagem")
             
             # Baixar imagem
             try:
-                from sessao.sessao_service import gerenciador_sessoes
-                cliente = gerenciador_sessoes.obter_cliente(sessao_id)
-                
                 if cliente:
                     # Download da imagem usando download_any
                     imagem_bytes = cliente.download_any(message)
                     
                     if imagem_bytes:
-                        # Salvar imagem
-                        caminho, base64_str = MensagemService.salvar_imagem(
+                        # Salvar imagem (decode/encode em thread, sem travar o event loop)
+                        caminho, url = await asyncio.to_thread(
+                            MensagemService.salvar_imagem,
                             imagem_bytes,
                             telefone_cliente,
                             sessao_id
@@ -348,15 +427,18 @@ Digite *#ajuda* para ver comandos disponíveis."""
                         
                         if caminho:
                             db_mensagem.conteudo_imagem_path = caminho
-                            db_mensagem.conteudo_imagem_base64 = base64_str
-                            db_mensagem.conteudo_mime_type = message.image_message.mime_type
+                            db_mensagem.conteudo_imagem_url = url
+                            db_mensagem.conteudo_mime_type = img_msg.mimetype or None
             except Exception as e:
-                print(f"Erro ao baixar imagem: {e}")
+                logger.error("Erro ao baixar imagem: %s", e)
         
-        # Salvar mensagem
+        # Salvar mensagem. O commit acontece antes da chamada ao LLM para não segurar
+        # a transação de escrita (lock do SQLite) durante a rede; a resposta é gravada
+        # depois, antes do envio. Sem refresh: recarregado sob demanda.
         db.add(db_mensagem)
+        MetricaService.incrementar_contagem_clientes(db, {(sessao_id, telefone_cliente): 1})
         db.commit()
-        db.refresh(db_mensagem)
+        MensagemService.mensagens_alteradas(sessao_id)
         
         # Se auto-responder está ativo, processar com agente
         if sessao.auto_responder:
@@ -366,7 +448,8 @@ Digite *#ajuda* para ver comandos disponíveis."""
                     db,
                     sessao_id,
                     telefone_cliente,
-                    limite=10
+                    limite=10,
+                    com_imagens=True
                 )
                 
                 # Processar com agente
@@ -387,24 +470,27 @@ Digite *#ajuda* para ver comandos disponíveis."""
                 db_mensagem.processada = True
                 db_mensagem.processado_em = datetime.now()
                 
-                # Enviar resposta
-                if resposta.get("texto"):
-                    from sessao.sessao_service import gerenciador_sessoes
-                    cliente = gerenciador_sessoes.obter_cliente(sessao_id)
-                    
-                    if cliente:
-                        from neonize.utils import build_jid
-                        jid = build_jid(telefone_cliente)
-                        # Parâmetro correto: message (str ou Message object)
-                        cliente.send_message(jid, message=resposta["texto"])
-                        
-                        db_mensagem.respondida = True
-                        db_mensagem.respondido_em = datetime.now()
-                
+                # Um único commit após o LLM, já marcando como respondida; o envio só
+                # acontece se o commit der certo (falha no envio desfaz a marca abaixo)
+                enviar = bool(resposta.get("texto") and cliente)
+                if enviar:
+                    db_mensagem.respondida = True
+                    db_mensagem.respondido_em = datetime.now()
                 db.commit()
                 
+                # Enviar resposta
+                if enviar:
+                    # Parâmetro correto: message (str ou Message object)
+                    cliente.send_message(jid, message=resposta["texto"])
+                
             except Exception as e:
-                print(f"Erro ao processar mensagem com agente: {e}")
+                logger.error("Erro ao processar mensagem com agente: %s", e)
+                
+                # Descartar alterações parciais (ex: falha no commit) antes de gravar o erro
+                db.rollback()
+                # Resposta não entregue (falha no envio ou no commit)
+                db_mensagem.respondida = False
+                db_mensagem.respondido_em = None
                 
                 # Salvar erro no banco
                 db_mensagem.resposta_erro = str(e)
@@ -413,13 +499,7 @@ Digite *#ajuda* para ver comandos disponíveis."""
                 
                 # Enviar mensagem de erro amigável para o usuário
                 try:
-                    from sessao.sessao_service import gerenciador_sessoes
-                    cliente = gerenciador_sessoes.obter_cliente(sessao_id)
-                    
                     if cliente:
-                        from neonize.utils import build_jid
-                        jid = build_jid(telefone_cliente)
-                        
                         # Mensagem de erro amigável
                         erro_msg = f"❌ *Erro ao processar sua mensagem*\n\n"
                         
@@ -439,21 +519,23 @@ Digite *#ajuda* para ver comandos disponíveis."""
                             erro_msg += "Por favor, tente novamente ou contate o suporte."
                         
                         cliente.send_message(jid, message=erro_msg)
-                        print(f"📤 Mensagem de erro enviada ao usuário")
+                        logger.info("📤 Mensagem de erro enviada ao usuário")
                         
                         db_mensagem.respondida = True
                         db_mensagem.respondido_em = datetime.now()
                 except Exception as send_error:
-                    print(f"❌ Erro ao enviar mensagem de erro: {send_error}")
+                    logger.error("❌ Erro ao enviar mensagem de erro: %s", send_error)
                 
                 db.commit()
 
     @staticmethod
     def contar_mensagens_por_sessao(db: Session, sessao_id: int) -> int:
         """Conta total de mensagens de uma sessão."""
-        return db.query(Mensagem)\
-            .filter(Mensagem.sessao_id == sessao_id)\
-            .count()
+        return db.scalar(
+            select(func.count())
+            .select_from(Mensagem)
+            .where(Mensagem.sessao_id == sessao_id)
+        )
 
     @staticmethod
     def contar_mensagens_por_periodo(
@@ -463,18 +545,269 @@ Digite *#ajuda* para ver comandos disponíveis."""
     ) -> int:
         """Conta mensagens dos últimos N dias."""
         data_inicio = datetime.now() - timedelta(days=dias)
-        return db.query(Mensagem)\
-            .filter(
+        return db.scalar(
+            select(func.count())
+            .select_from(Mensagem)
+            .where(
                 Mensagem.sessao_id == sessao_id,
                 Mensagem.criado_em >= data_inicio
-            )\
-            .count()
+            )
+        )
+
+    @staticmethod
+    def obter_estatisticas_sessao(db: Session, sessao_id: int, dias: int = 7) -> Dict[str, Any]:
+        """
+        Obtém estatísticas de mensagens de uma sessão em uma única query
+        (contagens, clientes únicos, tempo médio de resposta e tokens).
+        """
+        data_inicio = datetime.now() - timedelta(days=dias)
+        (
+            total,
+            ultimos_dias,
+            clientes_unicos,
+            tempo_medio_ms,
+            tokens_input,
+            tokens_output
+        ) = db.query(
+            func.count(Mensagem.id),
+            func.coalesce(func.sum(case((Mensagem.criado_em >= data_inicio, 1), else_=0)), 0),
+            func.count(distinct(Mensagem.telefone_cliente)),
+            func.avg(Mensagem.resposta_tempo_ms),
+            func.coalesce(func.sum(Mensagem.resposta_tokens_input), 0),
+            func.coalesce(func.sum(Mensagem.resposta_tokens_output), 0)
+        ).filter(Mensagem.sessao_id == sessao_id).one()
+        
+        return {
+            "total_mensagens": total,
+            "mensagens_periodo": ultimos_dias,
+            "clientes_unicos": clientes_unicos,
+            "tempo_medio_resposta_ms": round(float(tempo_medio_ms), 2) if tempo_medio_ms is not None else 0,
+            "total_tokens_input": tokens_input,
+            "total_tokens_output": tokens_output
+        }
+
+    @staticmethod
+    def obter_versao_sessao(db: Session, sessao_id: int, limite: int = 100) -> tuple:
+        """
+        Retorna uma "versão" barata das mensagens da sessão (para ETag), derivada dos
+        dados: MAX(id) e COUNT(id) da sessão, resolvidos pelo índice (sessao_id, id),
+        mudam com mensagens criadas ou apagadas; MAX(processado_em) das `limite`
+        mensagens exibidas muda quando uma delas é processada ou respondida.
+        """
+        janela = select(Mensagem.processado_em)\
+            .where(Mensagem.sessao_id == sessao_id)\
+            .order_by(Mensagem.id.desc())\
+            .limit(limite)\
+            .subquery()
+        return tuple(db.execute(
+            select(
+                func.max(Mensagem.id),
+                func.count(Mensagem.id),
+                select(func.max(janela.c.processado_em)).scalar_subquery()
+            ).where(Mensagem.sessao_id == sessao_id)
+        ).one())
 
     @staticmethod
     def obter_clientes_unicos(db: Session, sessao_id: int) -> List[str]:
-        """Obtém lista de telefones únicos que enviaram mensagens."""
-        result = db.query(Mensagem.telefone_cliente)\
-            .filter(Mensagem.sessao_id == sessao_id)\
-            .distinct()\
-            .all()
-        return [r[0] for r in result]
+        """
+        Obtém lista de telefones únicos que enviaram mensagens.
+        O resultado fica em cache por alguns segundos e é invalidado quando
+        mensagens da sessão são criadas ou apagadas.
+        """
+        agora = time.monotonic()
+        cache = _clientes_unicos_cache.get(sessao_id)
+        if cache and cache[0] > agora:
+            return list(cache[1])
+        
+        # scalars() devolve os telefones direto, sem montar uma Row por cliente
+        clientes = db.scalars(
+            select(Mensagem.telefone_cliente)
+            .where(Mensagem.sessao_id == sessao_id)
+            .distinct()
+        ).all()
+        _clientes_unicos_cache[sessao_id] = (agora + _CLIENTES_UNICOS_TTL, clientes)
+        return list(clientes)
+
+    @staticmethod
+    def invalidar_clientes_unicos(sessao_id: int):
+        """Remove do cache a lista de clientes únicos de uma sessão."""
+        _clientes_unicos_cache.pop(sessao_id, None)
+
+    @staticmethod
+    def mensagens_alteradas(sessao_id: int):
+        """Invalida os caches derivados das mensagens da sessão (clientes únicos e métricas)."""
+        MensagemService.invalidar_clientes_unicos(sessao_id)
+        MetricaService.invalidar(sessao_id)
+
+
+# ==================== COMANDOS (#) ====================
+
+# Textos fixos das respostas (montados uma vez na importação)
+_AJUDA_TEXTO = """📚 *Comandos Disponíveis:*
+
+🤖 *#listar* - Lista todos os agentes disponíveis
+🔄 *#01, #02...* - Ativa um agente específico
+🧹 *#limpar* - Apaga todo o histórico de conversas
+ℹ️ *#ajuda* - Mostra esta mensagem
+📊 *#status* - Mostra informações da sessão
+
+💬 Para conversar normalmente, basta enviar sua mensagem!"""
+
+_STATUS_TEXTO = """📊 *Status da Sessão:*
+
+💬 Total de mensagens: {total_msgs}
+✅ Sessão ativa e conectada
+🤖 Agente ativo: {agente_nome}
+
+Digite *#ajuda* para ver comandos disponíveis."""
+
+_LIMPAR_TEXTO = "🧹 *Histórico limpo!*\n\nSeu histórico de conversas foi apagado.\nVamos começar uma nova conversa! 🆕"
+
+_LISTAR_CABECALHO = "🤖 *Agentes Disponíveis:*\n\n"
+_LISTAR_RODAPE = (
+    "\n💡 *Como usar:*\n"
+    "Digite *#XX* para ativar um agente\n"
+    "Exemplo: *#01* para ativar o agente 01"
+)
+_LISTAR_VAZIO = (
+    "⚠️ *Nenhum agente disponível*\n\n"
+    "Entre em contato com o administrador para configurar agentes."
+)
+
+_AGENTE_NAO_ENCONTRADO_TEXTO = (
+    "❌ *Agente não encontrado*\n\n"
+    "O código *#{codigo}* não corresponde a nenhum agente ativo.\n\n"
+    "Digite *#listar* para ver os agentes disponíveis."
+)
+
+
+def _cmd_limpar(db: Session, sessao, telefone_cliente: str, cliente, jid):
+    """#limpar - apaga o histórico de mensagens do cliente."""
+    logger.info("🧹 Comando #limpar recebido de %s", telefone_cliente)
+    
+    # Deletar histórico de mensagens deste cliente (DELETE direto; nenhuma
+    # Mensagem está carregada na sessão, então não há o que sincronizar)
+    mensagens_deletadas = db.query(Mensagem)\
+        .filter(
+            Mensagem.sessao_id == sessao.id,
+            Mensagem.telefone_cliente == telefone_cliente
+        )\
+        .delete(synchronize_session=False)
+    MetricaService.remover_contagem_cliente(db, sessao.id, telefone_cliente)
+    
+    db.commit()
+    MensagemService.mensagens_alteradas(sessao.id)
+    logger.info("✅ %s mensagem(ns) deletada(s)", mensagens_deletadas)
+    
+    # Enviar confirmação
+    if cliente:
+        cliente.send_message(jid, message=_LIMPAR_TEXTO)
+        logger.debug("📤 Confirmação enviada ao usuário")
+
+
+def _cmd_ajuda(db: Session, sessao, telefone_cliente: str, cliente, jid):
+    """#ajuda / #help - lista os comandos disponíveis."""
+    logger.info("ℹ️  Comando #ajuda recebido de %s", telefone_cliente)
+    
+    if cliente:
+        cliente.send_message(jid, message=_AJUDA_TEXTO)
+        logger.debug("📤 Ajuda enviada ao usuário")
+
+
+def _cmd_status(db: Session, sessao, telefone_cliente: str, cliente, jid):
+    """#status - total de mensagens do cliente e agente ativo."""
+    from agente.agente_service import AgenteService
+    
+    logger.info("📊 Comando #status recebido de %s", telefone_cliente)
+    
+    if cliente:
+        # Contar mensagens do usuário
+        total_msgs = MensagemService.contar_mensagens_por_cliente(db, sessao.id, telefone_cliente)
+        
+        # Obter agente ativo
+        agente_nome = "Nenhum"
+        if sessao.agente_ativo_id:
+            agente_ativo = AgenteService.obter_por_id(db, sessao.agente_ativo_id)
+            if agente_ativo:
+                agente_nome = f"#{agente_ativo.codigo} - {agente_ativo.nome}"
+        
+        status_texto = _STATUS_TEXTO.format(total_msgs=total_msgs, agente_nome=agente_nome)
+        cliente.send_message(jid, message=status_texto)
+        logger.debug("📤 Status enviado ao usuário")
+
+
+def _cmd_listar(db: Session, sessao, telefone_cliente: str, cliente, jid):
+    """#listar - lista os agentes ativos da sessão."""
+    from agente.agente_service import AgenteService
+    
+    logger.info("📋 Comando #listar recebido de %s", telefone_cliente)
+    
+    agentes = AgenteService.listar_por_sessao_ativos(db, sessao.id)
+    
+    if cliente:
+        if agentes:
+            partes = [_LISTAR_CABECALHO]
+            for agente in agentes:
+                # Marcar agente ativo
+                marcador = "✅" if sessao.agente_ativo_id == agente.id else "⚪"
+                partes.append(f"{marcador} *#{agente.codigo}* - {agente.nome}\n")
+                if agente.descricao:
+                    partes.append(f"   _{agente.descricao}_\n")
+                partes.append("\n")
+            partes.append(_LISTAR_RODAPE)
+            lista_texto = "".join(partes)
+        else:
+            lista_texto = _LISTAR_VAZIO
+        
+        cliente.send_message(jid, message=lista_texto)
+        logger.debug("📤 Lista de agentes enviada ao usuário")
+
+
+def _cmd_ativar_agente(db: Session, sessao, telefone_cliente: str, cliente, jid, codigo_agente: str) -> bool:
+    """
+    #01, #02... - ativa o agente com o código informado.
+    
+    Returns:
+        True se o comando foi tratado (a mensagem não deve ir para o agente)
+    """
+    from agente.agente_service import AgenteService
+    
+    logger.info("🔄 Comando de troca de agente recebido: %s", codigo_agente)
+    
+    agente = AgenteService.obter_por_codigo(db, sessao.id, codigo_agente)
+    
+    if agente and agente.ativo:
+        # Ativar agente
+        sessao.agente_ativo_id = agente.id
+        db.commit()
+        
+        if cliente:
+            confirmacao = f"✅ *Agente Ativado!*\n\n"
+            confirmacao += f"🤖 *{agente.nome}*\n"
+            if agente.descricao:
+                confirmacao += f"_{agente.descricao}_\n\n"
+            confirmacao += f"Agora estou pronto para ajudar como {agente.agente_papel}!"
+            
+            cliente.send_message(jid, message=confirmacao)
+            logger.info("✅ Agente %s ativado para sessão %s", agente.codigo, sessao.id)
+        
+        return True
+    elif cliente:
+        # Agente não encontrado
+        erro_msg = _AGENTE_NAO_ENCONTRADO_TEXTO.format(codigo=codigo_agente)
+        cliente.send_message(jid, message=erro_msg)
+        logger.warning("⚠️ Agente %s não encontrado", codigo_agente)
+        
+        return True
+    
+    return False
+
+
+# Comandos fixos: texto normalizado (strip + lower) -> handler
+_COMANDOS = {
+    "#limpar": _cmd_limpar,
+    "#ajuda": _cmd_ajuda,
+    "#help": _cmd_ajuda,
+    "#status": _cmd_status,
+    "#listar": _cmd_listar,
+}
@@ -3,15 +3,15 @@ Rotas do frontend para métricas.
 """
 from fastapi import APIRouter, Depends, Request, Query
 from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 from typing import Optional
 from database import get_db
+from templating import criar_templates
 from metrica.metrica_service import MetricaService
 from sessao.sessao_service import SessaoService
 
 router = APIRouter(prefix="/metricas", tags=["Frontend - Métricas"])
-templates = Jinja2Templates(directory="templates")
+templates = criar_templates("metrica/geral.html", "metrica/sessao.html", "shared/erro.html")
 
 
 @router.get("/", response_class=HTMLResponse)
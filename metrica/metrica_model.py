@@ -0,0 +1,45 @@
+"""
+Modelo de dados para métricas consolidadas.
+"""
+from sqlalchemy import Column, Integer, String, Date, ForeignKey, Index, desc
+from database import Base
+
+
+class MensagemPorDia(Base):
+    """
+    Contagem diária de mensagens por sessão (roll-up de dias já encerrados).
+    Consolidada periodicamente (só os dias novos) por MetricaService.consolidar_mensagens_por_dia;
+    o dia corrente é sempre calculado ao vivo a partir da tabela de mensagens.
+    """
+    __tablename__ = "mensagens_por_dia"
+
+    sessao_id = Column(Integer, ForeignKey("sessoes.id", ondelete='CASCADE'), primary_key=True)
+    dia = Column(Date, primary_key=True)
+    
+    total = Column(Integer, nullable=False, default=0)
+    recebidas = Column(Integer, nullable=False, default=0)
+    respondidas = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<MensagemPorDia(sessao_id={self.sessao_id}, dia={self.dia}, total={self.total})>"
+
+
+class ContagemCliente(Base):
+    """
+    Total de mensagens recebidas por cliente em cada sessão (agregado incremental).
+    Atualizada junto com as gravações de mensagens por MetricaService.incrementar_contagem_clientes;
+    reconstruída a partir da tabela de mensagens na inicialização.
+    """
+    __tablename__ = "contagem_mensagens_cliente"
+    __table_args__ = (
+        # Top clientes: ORDER BY total DESC LIMIT k direto no índice
+        Index("ix_contagem_cliente_sessao_total", "sessao_id", desc("total")),
+    )
+
+    sessao_id = Column(Integer, ForeignKey("sessoes.id", ondelete='CASCADE'), primary_key=True)
+    telefone_cliente = Column(String(20), primary_key=True)
+    
+    total = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<ContagemCliente(sessao_id={self.sessao_id}, telefone='{self.telefone_cliente}', total={self.total})>"
@@ -1,18 +1,22 @@
 """
 Rotas da API para métricas.
 """
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Depends, Query, Response
 from sqlalchemy.orm import Session
 from typing import Optional
 from database import get_db
-from metrica.metrica_service import MetricaService
+from metrica.metrica_service import MetricaService, CACHE_TTL
 
 router = APIRouter(prefix="/api/metricas", tags=["Métricas"])
 
+# Métricas agregadas ficam em cache no serviço; o cliente/proxy também pode reaproveitar
+_CACHE_CONTROL = f"public, max-age={CACHE_TTL}"
+
 
 @router.get("/gerais")
-def obter_metricas_gerais(db: Session = Depends(get_db)):
-    """Obtém métricas gerais do sistema."""
+def obter_metricas_gerais(response: Response, db: Session = Depends(get_db)):
+    """Obtém métricas gerais do sistema (cache de 30s)."""
+    response.headers["Cache-Control"] = _CACHE_CONTROL
     return MetricaService.obter_metricas_gerais(db)
 
 
@@ -24,11 +28,13 @@ def obter_metricas_sessao(sessao_id: int, db: Session = Depends(get_db)):
 
 @router.get("/periodo")
 def obter_metricas_periodo(
+    response: Response,
     sessao_id: Optional[int] = Query(None),
     dias: int = Query(default=7, ge=1, le=365),
     db: Session = Depends(get_db)
 ):
-    """Obtém métricas de um período específico."""
+    """Obtém métricas de um período específico (cache de 30s)."""
+    response.headers["Cache-Control"] = _CACHE_CONTROL
     return MetricaService.obter_metricas_periodo(db, sessao_id, dias)
 
 
@@ -1,40 +1,125 @@
 """
 Serviço de métricas e estatísticas.
 """
+import inspect
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from functools import wraps
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
+from sqlalchemy import func, and_, case, select, delete, insert, text, true
 from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
 from mensagem.mensagem_model import Mensagem
+from metrica.metrica_model import MensagemPorDia, ContagemCliente
 from sessao.sessao_model import Sessao
 
+logger = logging.getLogger(__name__)
+
+# Intervalo (segundos) entre reconstruções da tabela mensagens_por_dia
+CONSOLIDACAO_INTERVALO = int(os.getenv("METRICAS_CONSOLIDACAO_INTERVALO", "600"))
+
+
+# Cache em memória das métricas: dashboards toleram alguns segundos de atraso.
+# chave (método, argumentos) -> (expira_em, sessao_id, resultado)
+CACHE_TTL = 30  # segundos
+_CACHE_MAX = 512
+_cache: Dict[tuple, tuple] = {}
+_cache_lock = threading.Lock()
+
+
+def _com_cache(funcao):
+    """
+    Guarda o resultado do método por CACHE_TTL segundos, por combinação de argumentos
+    (exceto a Session). Entradas de uma sessão são removidas por MetricaService.invalidar.
+    """
+    assinatura = inspect.signature(funcao)
+    
+    @wraps(funcao)
+    def wrapper(db: Session, *args, **kwargs):
+        argumentos = assinatura.bind(db, *args, **kwargs)
+        argumentos.apply_defaults()
+        parametros = {k: v for k, v in argumentos.arguments.items() if k != "db"}
+        chave = (funcao.__name__, tuple(parametros.items()))
+        
+        agora = time.monotonic()
+        with _cache_lock:
+            item = _cache.get(chave)
+        if item and item[0] > agora:
+            return item[2]
+        
+        resultado = funcao(db, *args, **kwargs)
+        with _cache_lock:
+            if len(_cache) >= _CACHE_MAX:
+                # Descartar entradas expiradas (ou tudo, se nenhuma expirou)
+                for k in [k for k, v in _cache.items() if v[0] <= agora] or list(_cache):
+                    del _cache[k]
+            _cache[chave] = (agora + CACHE_TTL, parametros.get("sessao_id"), resultado)
+        return resultado
+    
+    return wrapper
+
 
 class MetricaService:
     """Serviço para calcular métricas e estatísticas."""
 
     @staticmethod
+    def invalidar(sessao_id: Optional[int] = None):
+        """
+        Remove métricas do cache. Com sessao_id, remove as da sessão e as globais
+        (que também a incluem); sem sessao_id, limpa tudo.
+        """
+        with _cache_lock:
+            if sessao_id is None:
+                _cache.clear()
+                return
+            for chave in [k for k, v in _cache.items() if v[1] is None or v[1] == sessao_id]:
+                del _cache[chave]
+
+    @staticmethod
+    @_com_cache
     def obter_metricas_gerais(db: Session) -> Dict[str, Any]:
-        """Obtém métricas gerais do sistema."""
-        # Total de sessões
-        total_sessoes = db.query(Sessao).count()
-        sessoes_ativas = db.query(Sessao).filter(Sessao.ativa == True).count()
-        sessoes_conectadas = db.query(Sessao).filter(Sessao.status == "conectado").count()
+        """
+        Obtém métricas gerais do sistema.
+        Os agregados de sessões e de mensagens são subqueries de uma linha cada,
+        unidas em um único SELECT (uma ida ao banco).
+        """
+        # Sessões
+        sessoes = select(
+            func.count(Sessao.id).label("total"),
+            func.coalesce(func.sum(case((Sessao.ativa == True, 1), else_=0)), 0).label("ativas"),
+            func.coalesce(func.sum(case((Sessao.status == "conectado", 1), else_=0)), 0).label("conectadas")
+        ).subquery()
         
-        # Total de mensagens
-        total_mensagens = db.query(Mensagem).count()
-        mensagens_recebidas = db.query(Mensagem).filter(Mensagem.direcao == "recebida").count()
-        mensagens_enviadas = db.query(Mensagem).filter(Mensagem.direcao == "enviada").count()
+        # Mensagens (totais, processadas/respondidas e clientes únicos no mesmo scan)
+        mensagens = select(
+            func.count(Mensagem.id).label("total"),
+            func.coalesce(func.sum(case((Mensagem.direcao == "recebida", 1), else_=0)), 0).label("recebidas"),
+            func.coalesce(func.sum(case((Mensagem.direcao == "enviada", 1), else_=0)), 0).label("enviadas"),
+            func.coalesce(func.sum(case((Mensagem.processada == True, 1), else_=0)), 0).label("processadas"),
+            func.coalesce(func.sum(case((Mensagem.respondida == True, 1), else_=0)), 0).label("respondidas"),
+            func.count(func.distinct(Mensagem.telefone_cliente)).label("clientes_unicos")
+        ).subquery()
         
-        # Mensagens processadas
-        mensagens_processadas = db.query(Mensagem).filter(Mensagem.processada == True).count()
-        mensagens_respondidas = db.query(Mensagem).filter(Mensagem.respondida == True).count()
+        (
+            total_sessoes,
+            sessoes_ativas,
+            sessoes_conectadas,
+            total_mensagens,
+            mensagens_recebidas,
+            mensagens_enviadas,
+            mensagens_processadas,
+            mensagens_respondidas,
+            clientes_unicos
+        ) = db.execute(
+            select(sessoes, mensagens).select_from(sessoes.join(mensagens, true()))
+        ).one()
         
         # Taxa de sucesso
         taxa_sucesso = (mensagens_respondidas / mensagens_recebidas * 100) if mensagens_recebidas > 0 else 0
         
-        # Clientes únicos
-        clientes_unicos = db.query(Mensagem.telefone_cliente).distinct().count()
-        
         return {
             "sessoes": {
                 "total": total_sessoes,
@@ -55,68 +140,36 @@ class MetricaService:
         }
 
     @staticmethod
+    @_com_cache
     def obter_metricas_sessao(db: Session, sessao_id: int) -> Dict[str, Any]:
-        """Obtém métricas de uma sessão específica."""
-        # Mensagens da sessão
-        total_mensagens = db.query(Mensagem)\
-            .filter(Mensagem.sessao_id == sessao_id)\
-            .count()
-        
-        mensagens_recebidas = db.query(Mensagem)\
-            .filter(
-                Mensagem.sessao_id == sessao_id,
-                Mensagem.direcao == "recebida"
-            )\
-            .count()
-        
-        mensagens_respondidas = db.query(Mensagem)\
-            .filter(
-                Mensagem.sessao_id == sessao_id,
-                Mensagem.respondida == True
-            )\
-            .count()
+        """Obtém métricas de uma sessão específica (todas as agregações em um único SELECT)."""
+        (
+            total_mensagens,
+            mensagens_recebidas,
+            mensagens_respondidas,
+            mensagens_com_imagem,
+            mensagens_com_ferramentas,
+            tempo_medio,
+            tokens_input_total,
+            tokens_output_total,
+            clientes_unicos
+        ) = db.query(
+            func.count(Mensagem.id),
+            func.coalesce(func.sum(case((Mensagem.direcao == "recebida", 1), else_=0)), 0),
+            func.coalesce(func.sum(case((Mensagem.respondida == True, 1), else_=0)), 0),
+            func.coalesce(func.sum(case((Mensagem.tipo == "imagem", 1), else_=0)), 0),
+            func.coalesce(func.sum(case((Mensagem.ferramentas_usadas.isnot(None), 1), else_=0)), 0),
+            func.avg(Mensagem.resposta_tempo_ms),
+            func.coalesce(func.sum(Mensagem.resposta_tokens_input), 0),
+            func.coalesce(func.sum(Mensagem.resposta_tokens_output), 0),
+            func.count(func.distinct(Mensagem.telefone_cliente))
+        ).filter(Mensagem.sessao_id == sessao_id).one()
         
         # Taxa de resposta
         taxa_resposta = (mensagens_respondidas / mensagens_recebidas * 100) if mensagens_recebidas > 0 else 0
         
-        # Tempo médio de resposta
-        tempo_medio = db.query(func.avg(Mensagem.resposta_tempo_ms))\
-            .filter(
-                Mensagem.sessao_id == sessao_id,
-                Mensagem.resposta_tempo_ms.isnot(None)
-            )\
-            .scalar() or 0
-        
-        # Tokens utilizados
-        tokens_input_total = db.query(func.sum(Mensagem.resposta_tokens_input))\
-            .filter(Mensagem.sessao_id == sessao_id)\
-            .scalar() or 0
-        
-        tokens_output_total = db.query(func.sum(Mensagem.resposta_tokens_output))\
-            .filter(Mensagem.sessao_id == sessao_id)\
-            .scalar() or 0
-        
-        # Clientes únicos
-        clientes_unicos = db.query(Mensagem.telefone_cliente)\
-            .filter(Mensagem.sessao_id == sessao_id)\
-            .distinct()\
-            .count()
-        
-        # Mensagens com imagem
-        mensagens_com_imagem = db.query(Mensagem)\
-            .filter(
-                Mensagem.sessao_id == sessao_id,
-                Mensagem.tipo == "imagem"
-            )\
-            .count()
-        
-        # Mensagens com ferramentas
-        mensagens_com_ferramentas = db.query(Mensagem)\
-            .filter(
-                Mensagem.sessao_id == sessao_id,
-                Mensagem.ferramentas_usadas.isnot(None)
-            )\
-            .count()
+        # Tempo médio de resposta (AVG ignora as mensagens sem tempo registrado)
+        tempo_medio = float(tempo_medio or 0)
         
         return {
             "mensagens": {
@@ -139,62 +192,130 @@ class MetricaService:
         }
 
     @staticmethod
+    @_com_cache
     def obter_metricas_periodo(
         db: Session,
         sessao_id: Optional[int] = None,
         dias: int = 7
     ) -> Dict[str, Any]:
-        """Obtém métricas de um período específico."""
+        """
+        Obtém métricas de um período específico, agrupadas por dia.
+        Dias já consolidados vêm de mensagens_por_dia; os demais (hoje e o que
+        ainda não passou pela consolidação) são agregados ao vivo.
+        """
         data_inicio = datetime.now() - timedelta(days=dias)
+        dia_inicio = data_inicio.date()
+        
+        # Dias encerrados já consolidados
+        consolidado_ate = db.scalar(select(func.max(MensagemPorDia.dia)))
+        linhas = []
+        if consolidado_ate and consolidado_ate >= dia_inicio:
+            query = db.query(
+                MensagemPorDia.dia,
+                func.sum(MensagemPorDia.total),
+                func.sum(MensagemPorDia.recebidas),
+                func.sum(MensagemPorDia.respondidas)
+            ).filter(MensagemPorDia.dia >= dia_inicio)
+            if sessao_id:
+                query = query.filter(MensagemPorDia.sessao_id == sessao_id)
+            linhas.extend(query.group_by(MensagemPorDia.dia).all())
+            dia_inicio = consolidado_ate + timedelta(days=1)
         
-        query = db.query(Mensagem).filter(Mensagem.criado_em >= data_inicio)
+        # Restante do período ao vivo
+        dia = func.date(Mensagem.criado_em)
+        query = db.query(
+            dia,
+            func.count(Mensagem.id),
+            func.sum(case((Mensagem.direcao == "recebida", 1), else_=0)),
+            func.sum(case((Mensagem.respondida == True, 1), else_=0))
+        ).filter(Mensagem.criado_em >= datetime.combine(dia_inicio, datetime.min.time()))
         if sessao_id:
             query = query.filter(Mensagem.sessao_id == sessao_id)
+        linhas.extend(query.group_by(dia).all())
         
-        mensagens = query.all()
-        
-        # Agrupar por dia
-        mensagens_por_dia = {}
-        for msg in mensagens:
-            dia = msg.criado_em.strftime("%Y-%m-%d")
-            if dia not in mensagens_por_dia:
-                mensagens_por_dia[dia] = {
-                    "total": 0,
-                    "recebidas": 0,
-                    "respondidas": 0
-                }
-            
-            mensagens_por_dia[dia]["total"] += 1
-            if msg.direcao == "recebida":
-                mensagens_por_dia[dia]["recebidas"] += 1
-            if msg.respondida:
-                mensagens_por_dia[dia]["respondidas"] += 1
+        # Agrupar por dia (date() devolve str no SQLite e date no PostgreSQL)
+        mensagens_por_dia = {
+            str(d): {
+                "total": int(total),
+                "recebidas": int(recebidas),
+                "respondidas": int(respondidas)
+            }
+            for d, total, recebidas, respondidas in sorted(linhas, key=lambda linha: str(linha[0]))
+        }
+        total_periodo = sum(item["total"] for item in mensagens_por_dia.values())
         
         return {
             "periodo_dias": dias,
             "data_inicio": data_inicio.strftime("%Y-%m-%d"),
             "data_fim": datetime.now().strftime("%Y-%m-%d"),
             "mensagens_por_dia": mensagens_por_dia,
-            "total_periodo": len(mensagens)
+            "total_periodo": total_periodo
         }
 
     @staticmethod
+    def consolidar_mensagens_por_dia(db: Session) -> int:
+        """
+        Consolida em mensagens_por_dia os dias encerrados (anteriores a hoje) ainda não
+        consolidados. O último dia já consolidado é refeito, para incluir respostas
+        gravadas depois da meia-noite; os anteriores não são mais recalculados.
+        Retorna o número de linhas geradas.
+        """
+        dia = func.date(Mensagem.criado_em)
+        agregado = select(
+            Mensagem.sessao_id,
+            dia,
+            func.count(Mensagem.id),
+            func.sum(case((Mensagem.direcao == "recebida", 1), else_=0)),
+            func.sum(case((Mensagem.respondida == True, 1), else_=0))
+        ).where(dia < func.current_date()).group_by(Mensagem.sessao_id, dia)
+        
+        consolidado_ate = db.scalar(select(func.max(MensagemPorDia.dia)))
+        if consolidado_ate:
+            agregado = agregado.where(
+                Mensagem.criado_em >= datetime.combine(consolidado_ate, datetime.min.time())
+            )
+            db.execute(delete(MensagemPorDia).where(MensagemPorDia.dia >= consolidado_ate))
+        resultado = db.execute(
+            insert(MensagemPorDia).from_select(
+                ["sessao_id", "dia", "total", "recebidas", "respondidas"],
+                agregado
+            )
+        )
+        db.commit()
+        
+        MetricaService.invalidar()
+        return resultado.rowcount
+
+    @staticmethod
+    def iniciar_consolidacao_periodica(intervalo: int = CONSOLIDACAO_INTERVALO) -> threading.Thread:
+        """
+        Inicia uma thread daemon que consolida os roll-ups diários (mensagens_por_dia
+        e rag_metricas_dia) a cada `intervalo` segundos.
+        """
+        from database import iniciar_tarefa_periodica
+        from rag.rag_metrica_service import RAGMetricaService
+        
+        return iniciar_tarefa_periodica(
+            "consolidacao-metricas",
+            intervalo,
+            MetricaService.consolidar_mensagens_por_dia,
+            RAGMetricaService.consolidar_por_dia
+        )
+
+    @staticmethod
+    @_com_cache
     def obter_top_clientes(
         db: Session,
         sessao_id: int,
         limite: int = 10
     ) -> List[Dict[str, Any]]:
-        """Obtém os clientes que mais enviaram mensagens."""
+        """Obtém os clientes que mais enviaram mensagens (lidos de contagem_mensagens_cliente)."""
         result = db.query(
-            Mensagem.telefone_cliente,
-            func.count(Mensagem.id).label("total_mensagens")
-        )\
-        .filter(
-            Mensagem.sessao_id == sessao_id,
-            Mensagem.direcao == "recebida"
+            ContagemCliente.telefone_cliente,
+            ContagemCliente.total
         )\
-        .group_by(Mensagem.telefone_cliente)\
-        .order_by(func.count(Mensagem.id).desc())\
+        .filter(ContagemCliente.sessao_id == sessao_id)\
+        .order_by(ContagemCliente.total.desc())\
         .limit(limite)\
         .all()
         
@@ -207,30 +328,159 @@ class MetricaService:
         ]
 
     @staticmethod
+    def incrementar_contagem_clientes(db: Session, contagens: Dict[tuple, int]):
+        """
+        Soma mensagens recebidas em contagem_mensagens_cliente, na transação do chamador
+        (sem commit). contagens: {(sessao_id, telefone_cliente): quantidade}.
+        """
+        if not contagens:
+            return
+        linhas = [
+            {"sessao_id": sessao_id, "telefone_cliente": telefone, "total": total}
+            for (sessao_id, telefone), total in contagens.items()
+        ]
+        
+        dialeto = db.get_bind().dialect.name
+        if dialeto in ("sqlite", "postgresql"):
+            if dialeto == "sqlite":
+                from sqlalchemy.dialects.sqlite import insert as insert_upsert
+            else:
+                from sqlalchemy.dialects.postgresql import insert as insert_upsert
+            stmt = insert_upsert(ContagemCliente)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["sessao_id", "telefone_cliente"],
+                set_={"total": ContagemCliente.total + stmt.excluded.total}
+            )
+            db.execute(stmt, linhas)
+            return
+        
+        # Outros bancos: UPDATE e, se a linha ainda não existir, INSERT
+        for linha in linhas:
+            atualizadas = db.query(ContagemCliente).filter(
+                ContagemCliente.sessao_id == linha["sessao_id"],
+                ContagemCliente.telefone_cliente == linha["telefone_cliente"]
+            ).update({ContagemCliente.total: ContagemCliente.total + linha["total"]}, synchronize_session=False)
+            if not atualizadas:
+                db.execute(insert(ContagemCliente), [linha])
+
+    @staticmethod
+    def remover_contagem_cliente(db: Session, sessao_id: int, telefone_cliente: str):
+        """Zera a contagem de um cliente (histórico apagado), na transação do chamador."""
+        db.query(ContagemCliente).filter(
+            ContagemCliente.sessao_id == sessao_id,
+            ContagemCliente.telefone_cliente == telefone_cliente
+        ).delete(synchronize_session=False)
+
+    @staticmethod
+    def remover_sessao(db: Session, sessao_id: int):
+        """Remove os agregados de uma sessão excluída, na transação do chamador."""
+        db.query(ContagemCliente).filter(ContagemCliente.sessao_id == sessao_id)\
+            .delete(synchronize_session=False)
+        db.query(MensagemPorDia).filter(MensagemPorDia.sessao_id == sessao_id)\
+            .delete(synchronize_session=False)
+        MetricaService.invalidar(sessao_id)
+
+    @staticmethod
+    def inicializar_contagem_clientes(db: Session) -> int:
+        """
+        Preenche contagem_mensagens_cliente na inicialização apenas se ela estiver vazia
+        (banco anterior à tabela); depois disso a contagem é mantida de forma incremental.
+        Retorna o número de linhas geradas (0 se já havia contagem).
+        """
+        if db.query(ContagemCliente.sessao_id).first() is not None:
+            return 0
+        return MetricaService.reconstruir_contagem_clientes(db)
+
+    @staticmethod
+    def reconstruir_contagem_clientes(db: Session) -> int:
+        """
+        Recalcula contagem_mensagens_cliente a partir da tabela de mensagens
+        (bancos existentes ou contagens divergentes).
+        """
+        agregado = select(
+            Mensagem.sessao_id,
+            Mensagem.telefone_cliente,
+            func.count(Mensagem.id)
+        ).where(Mensagem.direcao == "recebida")\
+         .group_by(Mensagem.sessao_id, Mensagem.telefone_cliente)
+        
+        try:
+            db.execute(delete(ContagemCliente))
+            resultado = db.execute(
+                insert(ContagemCliente).from_select(
+                    ["sessao_id", "telefone_cliente", "total"],
+                    agregado
+                )
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        
+        MetricaService.invalidar()
+        return resultado.rowcount
+
+    @staticmethod
+    @_com_cache
     def obter_uso_ferramentas(db: Session, sessao_id: Optional[int] = None) -> List[Dict[str, Any]]:
-        """Obtém estatísticas de uso de ferramentas."""
-        query = db.query(Mensagem)\
+        """
+        Obtém estatísticas de uso de ferramentas.
+        No PostgreSQL e no SQLite a lista JSON é expandida e agregada no próprio banco;
+        nos demais bancos, a contagem é feita em Python.
+        """
+        dialeto = db.get_bind().dialect.name
+        sql = _USO_FERRAMENTAS_SQL.get(dialeto)
+        if sql:
+            filtro_sessao = "AND m.sessao_id = :sessao_id" if sessao_id else ""
+            linhas = db.execute(
+                text(sql.format(filtro_sessao=filtro_sessao)),
+                {"sessao_id": sessao_id} if sessao_id else {}
+            ).all()
+            return [{"nome": nome, "total_usos": total} for nome, total in linhas]
+        
+        query = db.query(Mensagem.ferramentas_usadas)\
             .filter(Mensagem.ferramentas_usadas.isnot(None))
         
         if sessao_id:
             query = query.filter(Mensagem.sessao_id == sessao_id)
         
-        mensagens = query.all()
-        
         # Contar uso de cada ferramenta
-        uso_ferramentas = {}
-        for msg in mensagens:
-            if msg.ferramentas_usadas:
-                for ferramenta in msg.ferramentas_usadas:
-                    nome = ferramenta.get("nome", "desconhecida")
-                    if nome not in uso_ferramentas:
-                        uso_ferramentas[nome] = 0
-                    uso_ferramentas[nome] += 1
+        uso_ferramentas = Counter()
+        for (ferramentas,) in query:
+            uso_ferramentas.update(f.get("nome", "desconhecida") for f in ferramentas or [])
         
         # Converter para lista ordenada
         resultado = [
             {"nome": nome, "total_usos": total}
-            for nome, total in sorted(uso_ferramentas.items(), key=lambda x: x[1], reverse=True)
+            for nome, total in uso_ferramentas.most_common()
         ]
         
         return resultado
+
+
+# Contagem de ferramentas por nome expandindo o array JSON no banco
+# (valores que não são array, como JSON null, contam como lista vazia)
+_USO_FERRAMENTAS_SQL = {
+    "postgresql": """
+        SELECT COALESCE(elem->>'nome', 'desconhecida') AS nome, count(*) AS total
+        FROM mensagens m,
+             jsonb_array_elements(
+                 CASE WHEN jsonb_typeof(m.ferramentas_usadas) = 'array'
+                      THEN m.ferramentas_usadas ELSE '[]'::jsonb END
+             ) AS elem
+        WHERE m.ferramentas_usadas IS NOT NULL {filtro_sessao}
+        GROUP BY 1
+        ORDER BY 2 DESC, 1
+    """,
+    "sqlite": """
+        SELECT COALESCE(json_extract(elem.value, '$.nome'), 'desconhecida') AS nome, count(*) AS total
+        FROM mensagens m,
+             json_each(
+                 CASE WHEN json_type(m.ferramentas_usadas) = 'array'
+                      THEN m.ferramentas_usadas ELSE '[]' END
+             ) AS elem
+        WHERE m.ferramentas_usadas IS NOT NULL {filtro_sessao}
+        GROUP BY 1
+        ORDER BY 2 DESC, 1
+    """,
+}
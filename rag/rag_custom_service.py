@@ -6,10 +6,16 @@ import os
 import json
 import logging
 import hashlib
+import sqlite3
+import threading
+import uuid
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 from pathlib import Path
 import re
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 # Dependências leves
 try:
@@ -33,6 +39,64 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Textos por requisição de embeddings (a API aceita até 2048 entradas)
+EMBEDDING_LOTE = 256
+# Requisições de embeddings simultâneas em add_text
+EMBEDDING_CONCORRENCIA = 8
+EMBEDDING_MODELO = "text-embedding-3-small"
+
+# Precisão das cópias locais dos embeddings, no cache em disco e no índice local
+# (float16 = metade dos bytes de float32); o ChromaDB recebe sempre float32
+EMBEDDING_DTYPE = os.getenv("FLUXI_EMBED_DTYPE", "float16").lower()
+if EMBEDDING_DTYPE not in ("float16", "float32"):
+    raise ValueError("FLUXI_EMBED_DTYPE deve ser 'float16' ou 'float32'")
+
+# Expressões usadas em _create_chunks
+_WS_RE = re.compile(r'\s+')
+_SPACE_RE = re.compile(' ')
+
+# Bases com até este número de chunks são buscadas em memória (NumPy) em vez do ChromaDB
+BUSCA_LOCAL_MAX_CHUNKS = 50_000
+# Chunks lidos do ChromaDB por página ao montar o índice local
+BUSCA_LOCAL_PAGINA = 5000
+
+# Cache semântico de buscas: uma query com similaridade de cosseno >= limiar com uma
+# query recente do mesmo RAG reaproveita os resultados dela (limiar > 1 desativa)
+CACHE_SEMANTICO_LIMIAR = float(os.getenv("FLUXI_RAG_CACHE_LIMIAR", "0.95"))
+CACHE_SEMANTICO_MAX = 256  # queries guardadas por RAG (as mais antigas saem primeiro)
+
+
+@lru_cache(maxsize=32)
+def _cliente_openai(api_key: str):
+    """
+    Cliente OpenAI compartilhado por API key. Reutilizar o cliente entre instâncias
+    (e RAGs com a mesma chave) mantém o pool de conexões HTTP (keep-alive) em vez de
+    refazer conexão e TLS.
+    O próprio cliente repete requisições com 429/5xx usando backoff exponencial.
+    """
+    import httpx
+    return openai.OpenAI(
+        api_key=api_key,
+        max_retries=5,
+        http_client=httpx.Client(
+            limits=httpx.Limits(max_connections=EMBEDDING_CONCORRENCIA * 2, max_keepalive_connections=16),
+            timeout=httpx.Timeout(60.0, connect=10.0)
+        )
+    )
+
+
+@lru_cache(maxsize=64)
+def _cliente_chroma(path: str):
+    """
+    Cliente ChromaDB compartilhado por diretório (caminho absoluto). Reinicializar um
+    RAG reaproveita o cliente já aberto em vez de reabrir o SQLite e recarregar os
+    metadados da coleção.
+    """
+    return chromadb.PersistentClient(
+        path=path,
+        settings=Settings(anonymized_telemetry=False)
+    )
+
 
 class RAGCustomService:
     """Serviço RAG customizado com implementação própria."""
@@ -44,8 +108,32 @@ class RAGCustomService:
         self.client = None
         self.collection = None
         
-        # Criar diretório se não existir
-        os.makedirs(storage_path, exist_ok=True)
+        # Cliente OpenAI compartilhado (pool de conexões reutilizado entre instâncias)
+        self._oai = _cliente_openai(api_key) if OPENAI_AVAILABLE and api_key else None
+        
+        # Criar diretório se não existir (na primeira inicialização do RAG)
+        if not os.path.isdir(storage_path):
+            os.makedirs(storage_path, exist_ok=True)
+        
+        # Índice local para busca em memória (cópia dos embeddings do ChromaDB)
+        self._indice_emb_path = os.path.join(storage_path, "emb.npy")
+        self._indice_ids_path = os.path.join(storage_path, "ids.json")
+        # Versão da base, trocada por toda escrita (add_text, delete_chunk, reset): o índice
+        # local vale enquanto foi montado na versão atual, inclusive entre processos
+        self._versao_path = os.path.join(storage_path, "versao")
+        self._indice = None  # (embeddings, ids, normas²) já carregado, reaproveitado entre buscas
+        self._indice_versao = None
+        
+        # Cache de embeddings por hash do texto, compartilhado entre os RAGs
+        self._emb_cache = None
+        self._emb_cache_lock = threading.Lock()
+        if NUMPY_AVAILABLE:
+            self._init_emb_cache(os.path.dirname(os.path.abspath(storage_path)))
+        
+        # Cache semântico: embeddings normalizados das queries recentes (buffer circular)
+        # e, na mesma posição, (top_k, resultados)
+        self._cache_semantico_lock = threading.Lock()
+        self._limpar_cache_semantico()
         
         # Inicializar ChromaDB
         self._init_chromadb()
@@ -56,10 +144,7 @@ class RAGCustomService:
             raise ValueError("ChromaDB não está instalado. Execute: pip install chromadb")
         
         try:
-            self.client = chromadb.PersistentClient(
-                path=self.storage_path,
-                settings=Settings(anonymized_telemetry=False)
-            )
+            self.client = _cliente_chroma(os.path.abspath(self.storage_path))
             
             # Criar ou obter coleção
             collection_name = f"rag_{self.rag_id}"
@@ -68,38 +153,102 @@ class RAGCustomService:
                 metadata={"rag_id": self.rag_id}
             )
             
-            logger.info(f"ChromaDB inicializado para RAG {self.rag_id}")
+            logger.info("ChromaDB inicializado para RAG %s", self.rag_id)
             
         except Exception as e:
-            logger.error(f"Erro ao inicializar ChromaDB: {str(e)}")
+            logger.error("Erro ao inicializar ChromaDB: %s", e)
             raise ValueError(f"Erro ao inicializar ChromaDB: {str(e)}")
     
-    def _generate_embedding(self, text: str) -> List[float]:
-        """Gera embedding para um texto."""
+    def _init_emb_cache(self, path: str):
+        """Abre (ou cria) o cache de embeddings em disco. Falhas apenas desativam o cache."""
+        try:
+            self._emb_cache = sqlite3.connect(
+                os.path.join(path, "emb_cache.db"),
+                timeout=30,
+                check_same_thread=False
+            )
+            self._emb_cache.execute("CREATE TABLE IF NOT EXISTS emb(h BLOB PRIMARY KEY, v BLOB)")
+            self._emb_cache.commit()
+        except sqlite3.Error as e:
+            logger.warning("Cache de embeddings desativado: %s", e)
+            self._emb_cache = None
+    
+    @staticmethod
+    def _hash(text: str) -> bytes:
+        """Chave do cache: SHA-256 do modelo + precisão + texto."""
+        return hashlib.sha256(f"{EMBEDDING_MODELO}\0{EMBEDDING_DTYPE}\0{text}".encode("utf-8")).digest()
+    
+    def _generate_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        Gera embeddings para uma lista de textos em uma única requisição.
+        Textos já vistos (mesmo hash) vêm do cache em disco e não são reenviados.
+        """
         if not OPENAI_AVAILABLE:
             raise ValueError("OpenAI não está instalado. Execute: pip install openai")
         
-        if not self.api_key:
+        if not self._oai:
             raise ValueError("API key do OpenAI não fornecida")
         
-        try:
-            client = openai.OpenAI(api_key=self.api_key)
-            response = client.embeddings.create(
-                model="text-embedding-3-small",
-                input=text
-            )
-            return response.data[0].embedding
+        hashes = [self._hash(t) for t in texts]
+        encontrados = {}
+        if self._emb_cache is not None:
+            with self._emb_cache_lock:
+                unicos = list(set(hashes))
+                linhas = self._emb_cache.execute(
+                    f"SELECT h, v FROM emb WHERE h IN ({','.join('?' * len(unicos))})",
+                    unicos
+                ).fetchall()
+            encontrados = {h: np.frombuffer(v, dtype=EMBEDDING_DTYPE).astype(np.float32).tolist() for h, v in linhas}
+        
+        # Enviar à API apenas os textos ausentes do cache (sem repetir duplicados)
+        faltantes = {}
+        for h, t in zip(hashes, texts):
+            if h not in encontrados:
+                faltantes.setdefault(h, t)
+        
+        if faltantes:
+            try:
+                response = self._oai.embeddings.create(
+                    model=EMBEDDING_MODELO,
+                    input=list(faltantes.values())
+                )
+                novos = [d.embedding for d in response.data]
+                
+            except Exception as e:
+                logger.error("Erro ao gerar embedding: %s", e)
+                raise ValueError(f"Erro ao gerar embedding: {str(e)}")
             
-        except Exception as e:
-            logger.error(f"Erro ao gerar embedding: {str(e)}")
-            raise ValueError(f"Erro ao gerar embedding: {str(e)}")
+            # Só a cópia do cache é quantizada em EMBEDDING_DTYPE; o ChromaDB recebe os
+            # vetores float32 originais da API
+            encontrados.update(zip(faltantes.keys(), novos))
+            if self._emb_cache is not None:
+                quantizados = np.asarray(novos, dtype=EMBEDDING_DTYPE)
+                try:
+                    with self._emb_cache_lock:
+                        self._emb_cache.executemany(
+                            "INSERT OR IGNORE INTO emb(h, v) VALUES (?, ?)",
+                            [(h, q.tobytes()) for h, q in zip(faltantes.keys(), quantizados)]
+                        )
+                        self._emb_cache.commit()
+                except sqlite3.Error as e:
+                    logger.warning("Erro ao gravar cache de embeddings: %s", e)
+        
+        logger.debug("Embeddings: %s do cache, %s gerados", len(texts) - len(faltantes), len(faltantes))
+        return [encontrados[h] for h in hashes]
+    
+    def _generate_embedding(self, text: str) -> List[float]:
+        """Gera embedding para um texto."""
+        return self._generate_embeddings([text])[0]
     
     def _create_chunks(self, text: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> List[Dict[str, Any]]:
         """Cria chunks do texto."""
-        logger.info(f"Criando chunks: tamanho={chunk_size}, overlap={chunk_overlap}")
+        logger.info("Criando chunks: tamanho=%s, overlap=%s", chunk_size, chunk_overlap)
         
         # Limpar texto
-        text = re.sub(r'\s+', ' ', text.strip())
+        text = _WS_RE.sub(' ', text.strip())
+        
+        # Posições dos espaços, calculadas uma vez (busca binária por chunk)
+        spaces = [m.start() for m in _SPACE_RE.finditer(text)]
         
         chunks = []
         start = 0
@@ -111,15 +260,16 @@ class RAGCustomService:
             # Tentar quebrar em palavra completa
             if end < len(text):
                 # Procurar último espaço antes do limite
-                last_space = text.rfind(' ', start, end)
-                if last_space > start:
-                    end = last_space
+                idx = bisect_left(spaces, end)
+                if idx > 0 and spaces[idx - 1] > start:
+                    end = spaces[idx - 1]
             
             chunk_text = text[start:end].strip()
             
             if chunk_text:
                 chunk = {
                     "id": f"chunk_{chunk_id}",
+                    "seq": chunk_id,
                     "text": chunk_text,
                     "start": start,
                     "end": end,
@@ -132,48 +282,64 @@ class RAGCustomService:
             # Mover para próximo chunk com overlap
             start = end - chunk_overlap if end < len(text) else end
         
-        logger.info(f"Criados {len(chunks)} chunks")
+        logger.info("Criados %s chunks", len(chunks))
         return chunks
     
     def add_text(self, text: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> Dict[str, Any]:
         """Adiciona texto à base de conhecimento."""
-        logger.info(f"Adicionando texto ao RAG {self.rag_id}")
+        logger.info("Adicionando texto ao RAG %s", self.rag_id)
         
         try:
-            # Criar chunks
-            chunks = self._create_chunks(text, chunk_size, chunk_overlap)
+            # Criar chunks, descartando repetições exatas (cabeçalhos, rodapés, trechos
+            # padronizados): um vetor por conteúdo, sem resultados duplicados na busca
+            todos = self._create_chunks(text, chunk_size, chunk_overlap)
+            vistos = set()
+            chunks = []
+            for chunk in todos:
+                h = hashlib.sha1(chunk["text"].encode("utf-8")).digest()
+                if h not in vistos:
+                    vistos.add(h)
+                    chunks.append(chunk)
+            if len(chunks) < len(todos):
+                logger.info("%s chunks duplicados ignorados", len(todos) - len(chunks))
             
-            # Gerar embeddings e adicionar ao ChromaDB
-            documents = []
-            embeddings = []
-            metadatas = []
-            ids = []
+            # O índice local é remontado a partir do ChromaDB na próxima busca
+            self._invalidar_indice()
             
-            for chunk in chunks:
-                # Gerar embedding
-                embedding = self._generate_embedding(chunk["text"])
-                
-                # Preparar dados para ChromaDB
-                documents.append(chunk["text"])
-                embeddings.append(embedding)
-                metadatas.append({
-                    "chunk_id": chunk["id"],
-                    "start": chunk["start"],
-                    "end": chunk["end"],
-                    "length": chunk["length"],
-                    "created_at": chunk["created_at"]
-                })
-                ids.append(chunk["id"])
+            # Processar em lotes (uma requisição de embeddings por lote, não por chunk),
+            # com até EMBEDDING_CONCORRENCIA lotes em paralelo por rodada. Cada rodada é
+            # gravada no ChromaDB antes da próxima: a memória não cresce com o documento.
+            lotes = [chunks[i:i + EMBEDDING_LOTE] for i in range(0, len(chunks), EMBEDDING_LOTE)]
+            with ThreadPoolExecutor(max_workers=max(1, min(EMBEDDING_CONCORRENCIA, len(lotes)))) as executor:
+                for i in range(0, len(lotes), EMBEDDING_CONCORRENCIA):
+                    rodada = lotes[i:i + EMBEDDING_CONCORRENCIA]
+                    textos_rodada = [[chunk["text"] for chunk in lote] for lote in rodada]
+                    for lote, texts, embeddings in zip(
+                        rodada,
+                        textos_rodada,
+                        executor.map(self._generate_embeddings, textos_rodada)
+                    ):
+                        # Adicionar ao ChromaDB
+                        self.collection.add(
+                            documents=texts,
+                            embeddings=embeddings,
+                            metadatas=[
+                                {
+                                    "chunk_id": chunk["id"],
+                                    "seq": chunk["seq"],
+                                    "start": chunk["start"],
+                                    "end": chunk["end"],
+                                    "length": chunk["length"],
+                                    "created_at": chunk["created_at"]
+                                }
+                                for chunk in lote
+                            ],
+                            ids=[chunk["id"] for chunk in lote]
+                        )
             
-            # Adicionar ao ChromaDB
-            self.collection.add(
-                documents=documents,
-                embeddings=embeddings,
-                metadatas=metadatas,
-                ids=ids
-            )
-            
-            logger.info(f"Texto adicionado com sucesso: {len(chunks)} chunks")
+            # De novo ao final: descarta um índice montado durante a gravação
+            self._invalidar_indice()
+            logger.info("Texto adicionado com sucesso: %s chunks", len(chunks))
             
             return {
                 "success": True,
@@ -183,20 +349,35 @@ class RAGCustomService:
             }
             
         except Exception as e:
-            logger.error(f"Erro ao adicionar texto: {str(e)}", exc_info=True)
+            logger.error("Erro ao adicionar texto: %s", e, exc_info=True)
             return {
                 "success": False,
                 "error": str(e)
             }
     
     def search(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
-        """Realiza busca semântica."""
-        logger.info(f"Buscando: '{query}' (top_k={top_k})")
+        """
+        Realiza busca semântica.
+        Bases pequenas são buscadas em memória (NumPy, busca exata); as demais no ChromaDB.
+        """
+        logger.info("Buscando: '%s' (top_k=%s)", query, top_k)
         
         try:
             # Gerar embedding da query
             query_embedding = self._generate_embedding(query)
             
+            em_cache = self._buscar_cache_semantico(query_embedding, top_k)
+            if em_cache is not None:
+                logger.info("Busca (cache semântico) retornou %s resultados", len(em_cache))
+                return em_cache
+            
+            indice = self._carregar_indice()
+            if indice is not None:
+                formatted_results = self._buscar_no_indice(indice, query_embedding, top_k)
+                self._guardar_cache_semantico(query_embedding, top_k, formatted_results)
+                logger.info("Busca (índice local) retornou %s resultados", len(formatted_results))
+                return formatted_results
+            
             # Buscar no ChromaDB
             results = self.collection.query(
                 query_embeddings=[query_embedding],
@@ -205,47 +386,269 @@ class RAGCustomService:
             )
             
             # Formatar resultados
-            formatted_results = []
-            for i, (doc, metadata, distance) in enumerate(zip(
-                results["documents"][0],
-                results["metadatas"][0],
-                results["distances"][0]
-            )):
-                # Converter distância para score de similaridade
-                score = 1 - distance  # ChromaDB usa distância, queremos similaridade
-                
-                result = {
-                    "context": doc,
-                    "metadata": {
-                        "chunk_id": metadata["chunk_id"],
-                        "start": metadata["start"],
-                        "end": metadata["end"],
-                        "length": metadata["length"],
-                        "created_at": metadata["created_at"],
-                        "score": score
-                    },
-                    "score": score
-                }
-                formatted_results.append(result)
+            formatted_results = [
+                self._formatar_resultado(doc, metadata, distance)
+                for doc, metadata, distance in zip(
+                    results["documents"][0],
+                    results["metadatas"][0],
+                    results["distances"][0]
+                )
+            ]
             
-            logger.info(f"Busca retornou {len(formatted_results)} resultados")
+            self._guardar_cache_semantico(query_embedding, top_k, formatted_results)
+            logger.info("Busca retornou %s resultados", len(formatted_results))
             return formatted_results
             
         except Exception as e:
-            logger.error(f"Erro na busca: {str(e)}", exc_info=True)
+            logger.error("Erro na busca: %s", e, exc_info=True)
+            return []
+    
+    @staticmethod
+    def _formatar_resultado(doc: str, metadata: Dict[str, Any], distance: float) -> Dict[str, Any]:
+        """Monta um resultado de busca a partir do documento, metadados e distância."""
+        # Converter distância para score de similaridade
+        score = 1 - distance  # ChromaDB usa distância, queremos similaridade
+        
+        return {
+            "context": doc,
+            "metadata": {
+                "chunk_id": metadata["chunk_id"],
+                "start": metadata["start"],
+                "end": metadata["end"],
+                "length": metadata["length"],
+                "created_at": metadata["created_at"],
+                "score": score
+            },
+            "score": score
+        }
+    
+    def _buscar_no_indice(self, indice, query_embedding: List[float], top_k: int) -> List[Dict[str, Any]]:
+        """
+        Busca exata no índice local: distância L2 ao quadrado (a mesma métrica da coleção
+        no ChromaDB) calculada com uma multiplicação matriz-vetor. Documentos e metadados
+        são buscados no ChromaDB apenas para o top-k.
+        """
+        emb, ids, normas = indice
+        k = min(top_k, len(ids))
+        if k <= 0:
             return []
+        
+        q = np.asarray(query_embedding, dtype=np.float32)
+        distancias = normas - 2 * self._produto_em_blocos(emb, q) + q @ q
+        top = np.argpartition(distancias, k - 1)[:k]
+        top = top[np.argsort(distancias[top])]
+        
+        top_ids = [ids[i] for i in top]
+        dados = self.collection.get(ids=top_ids, include=["documents", "metadatas"])
+        por_id = {
+            chunk_id: (doc, metadata)
+            for chunk_id, doc, metadata in zip(dados["ids"], dados["documents"], dados["metadatas"])
+        }
+        
+        return [
+            self._formatar_resultado(*por_id[ids[i]], float(distancias[i]))
+            for i in top
+            if ids[i] in por_id
+        ]
     
-    def get_chunks(self, limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
-        """Obtém chunks armazenados."""
-        logger.info(f"Obtendo chunks: limit={limit}, offset={offset}")
+    def _carregar_indice(self):
+        """
+        Retorna (embeddings, ids, normas²) do índice local, montando-o a partir do
+        ChromaDB se estiver ausente ou desatualizado. None quando a base é grande demais
+        (ou sem NumPy). O índice fica na instância: as buscas seguintes não releem os
+        arquivos nem recalculam as normas.
+        """
+        if not NUMPY_AVAILABLE:
+            return None
+        
+        versao = self._versao_atual()
+        indice = self._indice
+        if indice is not None and self._indice_versao == versao:
+            return indice
+        
+        total = self.collection.count()
+        if total > BUSCA_LOCAL_MAX_CHUNKS:
+            return None
         
         try:
-            # Buscar todos os documentos
-            results = self.collection.get(
-                limit=limit,
-                offset=offset,
-                include=["documents", "metadatas"]
-            )
+            with open(self._indice_ids_path, "r") as f:
+                salvo = json.load(f)
+            if salvo["versao"] == versao:
+                ids = salvo["ids"]
+                emb = np.load(self._indice_emb_path, mmap_mode="r")
+                if len(ids) == emb.shape[0]:
+                    return self._guardar_indice(emb, ids, versao)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        
+        # Montar o índice paginando a coleção
+        ids = []
+        linhas = []
+        for offset in range(0, total, BUSCA_LOCAL_PAGINA):
+            pagina = self.collection.get(limit=BUSCA_LOCAL_PAGINA, offset=offset, include=["embeddings"])
+            ids.extend(pagina["ids"])
+            linhas.append(np.asarray(pagina["embeddings"], dtype=np.float32))
+        if not ids:
+            return None
+        emb = np.concatenate(linhas) if len(linhas) > 1 else linhas[0]
+        # Armazenado na mesma precisão do cache de embeddings (float16 = metade da memória)
+        emb = emb.astype(EMBEDDING_DTYPE, copy=False)
+        
+        # Gravado com a versão lida antes da leitura: uma escrita concorrente troca a
+        # versão e o índice é remontado na busca seguinte
+        self._salvar_indice(emb, ids, versao)
+        logger.info("Índice local montado para RAG %s: %s chunks", self.rag_id, len(ids))
+        return self._guardar_indice(emb, ids, versao)
+    
+    def _versao_atual(self) -> str:
+        """Versão atual da base ("" se nenhuma escrita a registrou ainda)."""
+        try:
+            with open(self._versao_path, "r") as f:
+                return f.read()
+        except OSError:
+            return ""
+    
+    def _nova_versao(self):
+        """Troca a versão da base (arquivo temporário + os.replace)."""
+        try:
+            tmp = self._versao_path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(uuid.uuid4().hex)
+            os.replace(tmp, self._versao_path)
+        except OSError as e:
+            logger.warning("Erro ao gravar versão do RAG %s: %s", self.rag_id, e)
+    
+    def _guardar_indice(self, emb, ids: List[str], versao: str):
+        """Mantém o índice em memória com as normas² dos embeddings pré-calculadas."""
+        normas = np.empty(emb.shape[0], dtype=np.float32)
+        for i in range(0, emb.shape[0], BUSCA_LOCAL_PAGINA):
+            bloco = np.asarray(emb[i:i + BUSCA_LOCAL_PAGINA], dtype=np.float32)
+            normas[i:i + BUSCA_LOCAL_PAGINA] = np.einsum("ij,ij->i", bloco, bloco)
+        self._indice = (emb, ids, normas)
+        self._indice_versao = versao
+        return self._indice
+    
+    @staticmethod
+    def _produto_em_blocos(emb, q):
+        """
+        emb @ q em float32. Índices em float16 são convertidos por blocos de
+        BUSCA_LOCAL_PAGINA linhas, sem uma cópia float32 da matriz inteira.
+        """
+        if emb.dtype == np.float32:
+            return emb @ q
+        produtos = np.empty(emb.shape[0], dtype=np.float32)
+        for i in range(0, emb.shape[0], BUSCA_LOCAL_PAGINA):
+            produtos[i:i + BUSCA_LOCAL_PAGINA] = np.asarray(emb[i:i + BUSCA_LOCAL_PAGINA], dtype=np.float32) @ q
+        return produtos
+    
+    def _salvar_indice(self, emb, ids: List[str], versao: str):
+        """Grava o índice local (arquivos temporários + os.replace, sem leituras parciais)."""
+        try:
+            tmp_emb = self._indice_emb_path + ".tmp"
+            with open(tmp_emb, "wb") as f:
+                np.save(f, emb)
+            tmp_ids = self._indice_ids_path + ".tmp"
+            with open(tmp_ids, "w") as f:
+                json.dump({"versao": versao, "ids": ids}, f)
+            os.replace(tmp_emb, self._indice_emb_path)
+            os.replace(tmp_ids, self._indice_ids_path)
+        except OSError as e:
+            logger.warning("Erro ao gravar índice local: %s", e)
+    
+    def _limpar_cache_semantico(self):
+        """Esvazia o cache semântico (a base mudou)."""
+        with self._cache_semantico_lock:
+            self._cache_vetores = None
+            self._cache_resultados = []
+            self._cache_posicao = 0
+    
+    def _buscar_cache_semantico(self, query_embedding: List[float], top_k: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Resultados de uma query recente com similaridade >= CACHE_SEMANTICO_LIMIAR
+        (e top_k suficiente), ou None.
+        """
+        if not NUMPY_AVAILABLE or CACHE_SEMANTICO_LIMIAR > 1:
+            return None
+        
+        q = np.asarray(query_embedding, dtype=np.float32)
+        norma = float(np.linalg.norm(q))
+        if norma == 0:
+            return None
+        
+        with self._cache_semantico_lock:
+            n = len(self._cache_resultados)
+            if not n or self._cache_vetores.shape[1] != q.shape[0]:
+                return None
+            similaridades = self._cache_vetores[:n] @ (q / norma)
+            i = int(np.argmax(similaridades))
+            k, resultados = self._cache_resultados[i]
+        
+        if similaridades[i] >= CACHE_SEMANTICO_LIMIAR and k >= top_k:
+            return resultados[:top_k]
+        return None
+    
+    def _guardar_cache_semantico(self, query_embedding: List[float], top_k: int, resultados: List[Dict[str, Any]]):
+        """Guarda os resultados da query no cache semântico (buscas vazias não são guardadas)."""
+        if not NUMPY_AVAILABLE or CACHE_SEMANTICO_LIMIAR > 1 or not resultados:
+            return
+        
+        q = np.asarray(query_embedding, dtype=np.float32)
+        norma = float(np.linalg.norm(q))
+        if norma == 0:
+            return
+        
+        with self._cache_semantico_lock:
+            if self._cache_vetores is None or self._cache_vetores.shape[1] != q.shape[0]:
+                self._cache_vetores = np.empty((CACHE_SEMANTICO_MAX, q.shape[0]), dtype=np.float32)
+                self._cache_resultados = []
+                self._cache_posicao = 0
+            
+            posicao = self._cache_posicao
+            self._cache_vetores[posicao] = q / norma
+            if posicao < len(self._cache_resultados):
+                self._cache_resultados[posicao] = (top_k, resultados)
+            else:
+                self._cache_resultados.append((top_k, resultados))
+            self._cache_posicao = (posicao + 1) % CACHE_SEMANTICO_MAX
+    
+    def _invalidar_indice(self):
+        """
+        Troca a versão da base e remove o índice local (ele é remontado na próxima
+        busca) e o cache semântico.
+        """
+        self._nova_versao()
+        self._indice = None
+        self._limpar_cache_semantico()
+        for path in (self._indice_emb_path, self._indice_ids_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    
+    def get_chunks(self, limit: int = 50, offset: int = 0, after_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Obtém chunks armazenados. Com `after_id` a paginação é por chave (metadado
+        numérico "seq" > o do chunk informado), sem o custo crescente do OFFSET.
+        Chunks gravados antes do metadado "seq" só são alcançados via `offset`.
+        """
+        logger.info("Obtendo chunks: limit=%s, offset=%s, after_id=%s", limit, offset, after_id)
+        
+        try:
+            if after_id is not None:
+                seq = self._seq_do_chunk(after_id)
+                if seq is None:
+                    return []
+                results = self.collection.get(
+                    where={"seq": {"$gt": seq}},
+                    limit=limit,
+                    include=["documents", "metadatas"]
+                )
+            else:
+                results = self.collection.get(
+                    limit=limit,
+                    offset=offset,
+                    include=["documents", "metadatas"]
+                )
             
             chunks = []
             for doc, metadata in zip(results["documents"], results["metadatas"]):
@@ -259,33 +662,61 @@ class RAGCustomService:
                 }
                 chunks.append(chunk)
             
-            logger.info(f"Retornados {len(chunks)} chunks")
+            logger.info("Retornados %s chunks", len(chunks))
             return chunks
             
         except Exception as e:
-            logger.error(f"Erro ao obter chunks: {str(e)}", exc_info=True)
+            logger.error("Erro ao obter chunks: %s", e, exc_info=True)
             return []
     
+    @staticmethod
+    def _seq_do_chunk(chunk_id: str) -> Optional[int]:
+        """Número sequencial de um ID "chunk_<n>" (None se o formato for outro)."""
+        prefixo, _, numero = chunk_id.rpartition("_")
+        return int(numero) if prefixo == "chunk" and numero.isdigit() else None
+    
+    def get_chunk(self, chunk_id: str) -> Optional[Dict[str, Any]]:
+        """Obtém um chunk pelo ID (busca direta no ChromaDB)."""
+        try:
+            results = self.collection.get(ids=[chunk_id], include=["documents", "metadatas"])
+            
+            for doc, metadata in zip(results["documents"], results["metadatas"]):
+                return {
+                    "id": metadata["chunk_id"],
+                    "text": doc,
+                    "start": metadata["start"],
+                    "end": metadata["end"],
+                    "length": metadata["length"],
+                    "created_at": metadata["created_at"]
+                }
+            return None
+            
+        except Exception as e:
+            logger.error("Erro ao obter chunk: %s", e, exc_info=True)
+            return None
+    
     def delete_chunk(self, chunk_id: str) -> bool:
         """Deleta um chunk específico."""
-        logger.info(f"Deletando chunk: {chunk_id}")
+        logger.info("Deletando chunk: %s", chunk_id)
         
         try:
             self.collection.delete(ids=[chunk_id])
-            logger.info(f"Chunk {chunk_id} deletado com sucesso")
+            self._invalidar_indice()
+            logger.info("Chunk %s deletado com sucesso", chunk_id)
             return True
             
         except Exception as e:
-            logger.error(f"Erro ao deletar chunk: {str(e)}", exc_info=True)
+            logger.error("Erro ao deletar chunk: %s", e, exc_info=True)
             return False
     
     def reset(self) -> bool:
         """Reseta a base de conhecimento."""
-        logger.info(f"Resetando RAG {self.rag_id}")
+        logger.info("Resetando RAG %s", self.rag_id)
         
         try:
             # Deletar coleção
             self.client.delete_collection(self.collection.name)
+            self._invalidar_indice()
             
             # Recriar coleção
             collection_name = f"rag_{self.rag_id}"
@@ -298,7 +729,7 @@ class RAGCustomService:
             return True
             
         except Exception as e:
-            logger.error(f"Erro ao resetar RAG: {str(e)}", exc_info=True)
+            logger.error("Erro ao resetar RAG: %s", e, exc_info=True)
             return False
     
     def get_stats(self) -> Dict[str, Any]:
@@ -314,7 +745,7 @@ class RAGCustomService:
             }
             
         except Exception as e:
-            logger.error(f"Erro ao obter estatísticas: {str(e)}", exc_info=True)
+            logger.error("Erro ao obter estatísticas: %s", e, exc_info=True)
             return {
                 "total_chunks": 0,
                 "rag_id": self.rag_id,
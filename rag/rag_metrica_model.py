@@ -1,7 +1,7 @@
 """
 Modelo de dados para métricas de uso do RAG.
 """
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, Float
+from sqlalchemy import Column, Integer, SmallInteger, BigInteger, String, Boolean, Date, DateTime, Text, ForeignKey, Float, Index, desc
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
@@ -13,21 +13,28 @@ class RAGMetrica(Base):
     Registra cada busca realizada na base de conhecimento.
     """
     __tablename__ = "rag_metricas"
+    __table_args__ = (
+        # Listagens e estatísticas filtram pela referência e ordenam/filtram por criado_em
+        Index("ix_rag_metricas_rag_criado", "rag_id", desc("criado_em")),
+        Index("ix_rag_metricas_agente_criado", "agente_id", desc("criado_em")),
+        Index("ix_rag_metricas_sessao_criado", "sessao_id", desc("criado_em")),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     
-    # Referências
-    rag_id = Column(Integer, ForeignKey("rags.id", ondelete='CASCADE'), nullable=False, index=True)
-    agente_id = Column(Integer, ForeignKey("agentes.id", ondelete='SET NULL'), nullable=True, index=True)
-    sessao_id = Column(Integer, ForeignKey("sessoes.id", ondelete='SET NULL'), nullable=True, index=True)
+    # Referências (indexadas pelos índices compostos)
+    rag_id = Column(Integer, ForeignKey("rags.id", ondelete='CASCADE'), nullable=False)
+    agente_id = Column(Integer, ForeignKey("agentes.id", ondelete='SET NULL'), nullable=True)
+    sessao_id = Column(Integer, ForeignKey("sessoes.id", ondelete='SET NULL'), nullable=True)
     
     # Dados da busca
     query = Column(Text, nullable=False)
+    query_hash = Column(BigInteger, nullable=False)  # Digest de 8 bytes da query, chave de agrupamento
     telefone_cliente = Column(String(50), nullable=True, index=True)
     
-    # Resultados
-    num_resultados_solicitados = Column(Integer, nullable=False)
-    num_resultados_retornados = Column(Integer, nullable=False)
+    # Resultados (top_k: poucas dezenas no máximo)
+    num_resultados_solicitados = Column(SmallInteger, nullable=False)
+    num_resultados_retornados = Column(SmallInteger, nullable=False)
     
     # Performance
     tempo_ms = Column(Integer, nullable=False)  # Tempo de resposta em milissegundos
@@ -38,11 +45,44 @@ class RAGMetrica(Base):
     # Timestamps
     criado_em = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     
-    # Relacionamentos
-    rag = relationship("RAG", foreign_keys=[rag_id])
-    agente = relationship("Agente", foreign_keys=[agente_id])
-    sessao = relationship("Sessao", foreign_keys=[sessao_id])
+    # Relacionamentos (lazy="raise": as métricas são agregadas por id; carregar
+    # o objeto relacionado exige selectinload/joinedload explícito)
+    rag = relationship("RAG", foreign_keys=[rag_id], lazy="raise")
+    agente = relationship("Agente", foreign_keys=[agente_id], lazy="raise")
+    sessao = relationship("Sessao", foreign_keys=[sessao_id], lazy="raise")
 
     def __repr__(self):
         return f"<RAGMetrica(rag_id={self.rag_id}, query='{self.query[:50]}...', tempo_ms={self.tempo_ms})>"
 
+
+
+class RAGMetricaDia(Base):
+    """
+    Roll-up diário das buscas (dias já encerrados), no grão
+    (rag, dia, query_hash, agente, sessão): permite somas, mín/máx e contagens distintas
+    exatas para qualquer período sem varrer rag_metricas.
+    Consolidada periodicamente (só os dias novos) por RAGMetricaService.consolidar_por_dia.
+    """
+    __tablename__ = "rag_metricas_dia"
+    __table_args__ = (
+        Index("ix_rag_metricas_dia_rag_dia", "rag_id", "dia"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    
+    rag_id = Column(Integer, ForeignKey("rags.id", ondelete='CASCADE'), nullable=False)
+    dia = Column(Date, nullable=False)
+    query = Column(Text, nullable=False)
+    query_hash = Column(BigInteger, nullable=False)
+    agente_id = Column(Integer, nullable=True)
+    sessao_id = Column(Integer, nullable=True)
+    
+    # Agregados do grupo
+    buscas = Column(Integer, nullable=False)
+    tempo_total_ms = Column(Integer, nullable=False)
+    tempo_minimo_ms = Column(Integer, nullable=False)
+    tempo_maximo_ms = Column(Integer, nullable=False)
+    resultados_total = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<RAGMetricaDia(rag_id={self.rag_id}, dia={self.dia}, buscas={self.buscas})>"
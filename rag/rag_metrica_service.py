@@ -2,21 +2,164 @@
 Serviço para gerenciar métricas de uso do RAG.
 """
 from sqlalchemy.orm import Session
+from sqlalchemy import func, insert, delete, update, select, union_all, literal, lambda_stmt, inspect, text
 from typing import List, Dict, Any, Optional
 from datetime import datetime, timedelta
+import atexit
+import hashlib
 import logging
+import queue
+import threading
+import time
 
-from rag.rag_metrica_model import RAGMetrica
+from rag.rag_metrica_model import RAGMetrica, RAGMetricaDia
 
 logger = logging.getLogger(__name__)
 
+# Gravação em lote das métricas: registrar_busca só enfileira; uma thread grava
+# até LOTE_METRICAS linhas por INSERT (executemany), ou o que houver a cada INTERVALO_METRICAS
+LOTE_METRICAS = 500
+INTERVALO_METRICAS = 1.0  # segundos
+_fila_metricas: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=10_000)
+_gravador_metricas: Optional[threading.Thread] = None
+_gravador_lock = threading.Lock()
+
+# Limite das colunas num_resultados_* (SMALLINT)
+SMALLINT_MAX = 32767
+
+# Limpeza de métricas antigas: linhas removidas por transação
+LOTE_EXCLUSAO = 10_000
+
+# Cache das estatísticas (polling de dashboard): chave (método, rag_id, argumentos)
+# -> (expira_em, resultado). Entradas de um RAG saem quando um lote dele é gravado.
+CACHE_TTL = 30  # segundos
+_CACHE_MAX = 512
+_cache: Dict[tuple, tuple] = {}
+_cache_lock = threading.Lock()
+
+
+def _em_cache(chave: tuple, calcular):
+    """Retorna o resultado em cache para a chave ou calcula e guarda por CACHE_TTL segundos."""
+    agora = time.monotonic()
+    with _cache_lock:
+        item = _cache.get(chave)
+    if item and item[0] > agora:
+        return item[1]
+    
+    resultado = calcular()
+    with _cache_lock:
+        if len(_cache) >= _CACHE_MAX:
+            for k in [k for k, v in _cache.items() if v[0] <= agora] or list(_cache):
+                del _cache[k]
+        _cache[chave] = (agora + CACHE_TTL, resultado)
+    return resultado
+
+
+def _invalidar_cache(rag_ids):
+    """Remove do cache as estatísticas dos RAGs informados."""
+    with _cache_lock:
+        for chave in [k for k in _cache if k[1] in rag_ids]:
+            del _cache[chave]
+
+
+def _hash_query(query: str) -> int:
+    """Digest de 8 bytes da query como inteiro com sinal (cabe em BIGINT)."""
+    return int.from_bytes(hashlib.blake2b(query.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+def _gravar_lote(lote: List[Dict[str, Any]]):
+    """Insere um lote de métricas em uma única transação."""
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        RAGMetricaService.registrar_em_lote(db, lote)
+    except Exception as e:
+        logger.error("Erro ao gravar %s métricas: %s", len(lote), e, exc_info=True)
+    finally:
+        db.close()
+
+
+def _drenar_fila(bloquear: bool = True) -> int:
+    """Retira até LOTE_METRICAS métricas da fila e grava. Retorna quantas foram gravadas."""
+    lote = []
+    try:
+        lote.append(_fila_metricas.get(timeout=INTERVALO_METRICAS) if bloquear else _fila_metricas.get_nowait())
+        while len(lote) < LOTE_METRICAS:
+            lote.append(_fila_metricas.get_nowait())
+    except queue.Empty:
+        pass
+    if lote:
+        _gravar_lote(lote)
+    return len(lote)
+
+
+def _loop_gravador():
+    while True:
+        _drenar_fila()
+
+
+def _iniciar_gravador():
+    """Inicia (uma vez) a thread que grava as métricas enfileiradas."""
+    global _gravador_metricas
+    with _gravador_lock:
+        if _gravador_metricas is None:
+            _gravador_metricas = threading.Thread(target=_loop_gravador, name="gravador-metricas-rag", daemon=True)
+            _gravador_metricas.start()
+
+
+@atexit.register
+def _descarregar_metricas():
+    """Grava o que ainda estiver na fila ao encerrar o processo."""
+    while _drenar_fila(bloquear=False):
+        pass
+
 
 class RAGMetricaService:
     """Serviço para registrar e consultar métricas de uso do RAG."""
 
+    @staticmethod
+    def migrar_query_hash():
+        """
+        Adiciona a coluna query_hash em rag_metricas/rag_metricas_dia criadas antes
+        dela (create_all não altera tabelas existentes) e preenche as linhas antigas
+        em lotes de LOTE_EXCLUSAO. Nada a fazer quando a coluna já existe.
+        """
+        from database import engine, SessionLocal
+        inspetor = inspect(engine)
+        for modelo in (RAGMetrica, RAGMetricaDia):
+            tabela = modelo.__tablename__
+            if not inspetor.has_table(tabela):
+                continue
+            if "query_hash" in {coluna["name"] for coluna in inspetor.get_columns(tabela)}:
+                continue
+            
+            # Nula no ALTER (o SQLite exige default para NOT NULL); o backfill preenche todas
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {tabela} ADD COLUMN query_hash BIGINT"))
+            
+            db = SessionLocal()
+            try:
+                total = 0
+                while True:
+                    linhas = db.execute(
+                        select(modelo.id, modelo.query)
+                        .where(modelo.query_hash.is_(None))
+                        .limit(LOTE_EXCLUSAO)
+                    ).all()
+                    if not linhas:
+                        break
+                    # UPDATE em lote pela chave primária (executemany)
+                    db.execute(update(modelo), [
+                        {"id": id_, "query_hash": _hash_query(query)} for id_, query in linhas
+                    ])
+                    db.commit()
+                    total += len(linhas)
+            finally:
+                db.close()
+            logger.info("Coluna query_hash adicionada em %s (%s linhas preenchidas)", tabela, total)
+
     @staticmethod
     def registrar_busca(
-        db: Session,
         rag_id: int,
         query: str,
         resultados: List[Dict[str, Any]],
@@ -25,12 +168,13 @@ class RAGMetricaService:
         agente_id: Optional[int] = None,
         sessao_id: Optional[int] = None,
         telefone_cliente: Optional[str] = None
-    ) -> RAGMetrica:
+    ) -> None:
         """
         Registra uma busca realizada no RAG.
+        A métrica é enfileirada e gravada em lote por uma thread (com sessão própria),
+        sem INSERT/commit no caminho da busca.
         
         Args:
-            db: Sessão do banco de dados
             rag_id: ID do RAG utilizado
             query: Texto da consulta
             resultados: Lista de resultados retornados
@@ -39,34 +183,58 @@ class RAGMetricaService:
             agente_id: ID do agente que realizou a busca
             sessao_id: ID da sessão
             telefone_cliente: Telefone do cliente que fez a pergunta
+        """
+        metrica = {
+            "rag_id": rag_id,
+            "agente_id": agente_id,
+            "sessao_id": sessao_id,
+            "query": query,
+            "query_hash": _hash_query(query),
+            "telefone_cliente": telefone_cliente,
+            # Um valor fora da faixa do SMALLINT derrubaria o lote inteiro
+            "num_resultados_solicitados": min(num_solicitados, SMALLINT_MAX),
+            "num_resultados_retornados": min(len(resultados), SMALLINT_MAX),
+            "tempo_ms": tempo_ms
+        }
+        
+        try:
+            _iniciar_gravador()
+            _fila_metricas.put_nowait(metrica)
+            logger.info("Métrica registrada: RAG %s, query='%.50s...', %s resultados, %sms", rag_id, query, len(resultados), tempo_ms)
+        except queue.Full:
+            # Não falhar a busca se não conseguir registrar métrica
+            logger.warning("Fila de métricas cheia; métrica descartada (RAG %s)", rag_id)
+
+    @staticmethod
+    def registrar_em_lote(db: Session, metricas: List[Dict[str, Any]]) -> int:
+        """
+        Insere várias métricas de uma vez (importação, reprocessamento e a fila de
+        registrar_busca). Um INSERT executemany (insertmanyvalues) e um único commit;
+        depois, as estatísticas em cache dos RAGs afetados são descartadas.
+        
+        Args:
+            db: Sessão do banco
+            metricas: Lista de dicts com as colunas de RAGMetrica
+                (query_hash é calculado quando ausente)
             
         Returns:
-            RAGMetrica criada
+            Número de métricas inseridas
         """
+        if not metricas:
+            return 0
+        
+        for metrica in metricas:
+            if "query_hash" not in metrica:
+                metrica["query_hash"] = _hash_query(metrica["query"])
+        
         try:
-            metrica = RAGMetrica(
-                rag_id=rag_id,
-                agente_id=agente_id,
-                sessao_id=sessao_id,
-                query=query,
-                telefone_cliente=telefone_cliente,
-                num_resultados_solicitados=num_solicitados,
-                num_resultados_retornados=len(resultados),
-                tempo_ms=tempo_ms
-            )
-            
-            db.add(metrica)
+            db.execute(insert(RAGMetrica), metricas)
             db.commit()
-            db.refresh(metrica)
-            
-            logger.info(f"Métrica registrada: RAG {rag_id}, query='{query[:50]}...', {len(resultados)} resultados, {tempo_ms}ms")
-            return metrica
-            
-        except Exception as e:
-            logger.error(f"Erro ao registrar métrica: {str(e)}", exc_info=True)
+        except Exception:
             db.rollback()
-            # Não falhar se não conseguir registrar métrica
-            return None
+            raise
+        _invalidar_cache({m["rag_id"] for m in metricas})
+        return len(metricas)
 
     @staticmethod
     def listar_por_rag(
@@ -76,9 +244,9 @@ class RAGMetricaService:
         offset: int = 0
     ) -> List[RAGMetrica]:
         """Lista métricas de um RAG específico."""
-        return db.query(RAGMetrica).filter(
-            RAGMetrica.rag_id == rag_id
-        ).order_by(RAGMetrica.criado_em.desc()).limit(limit).offset(offset).all()
+        stmt = lambda_stmt(lambda: select(RAGMetrica).where(RAGMetrica.rag_id == rag_id))
+        stmt += lambda s: s.order_by(RAGMetrica.criado_em.desc()).limit(limit).offset(offset)
+        return db.execute(stmt).scalars().all()
 
     @staticmethod
     def listar_por_agente(
@@ -88,9 +256,9 @@ class RAGMetricaService:
         offset: int = 0
     ) -> List[RAGMetrica]:
         """Lista métricas de um agente específico."""
-        return db.query(RAGMetrica).filter(
-            RAGMetrica.agente_id == agente_id
-        ).order_by(RAGMetrica.criado_em.desc()).limit(limit).offset(offset).all()
+        stmt = lambda_stmt(lambda: select(RAGMetrica).where(RAGMetrica.agente_id == agente_id))
+        stmt += lambda s: s.order_by(RAGMetrica.criado_em.desc()).limit(limit).offset(offset)
+        return db.execute(stmt).scalars().all()
 
     @staticmethod
     def listar_por_sessao(
@@ -100,9 +268,9 @@ class RAGMetricaService:
         offset: int = 0
     ) -> List[RAGMetrica]:
         """Lista métricas de uma sessão específica."""
-        return db.query(RAGMetrica).filter(
-            RAGMetrica.sessao_id == sessao_id
-        ).order_by(RAGMetrica.criado_em.desc()).limit(limit).offset(offset).all()
+        stmt = lambda_stmt(lambda: select(RAGMetrica).where(RAGMetrica.sessao_id == sessao_id))
+        stmt += lambda s: s.order_by(RAGMetrica.criado_em.desc()).limit(limit).offset(offset)
+        return db.execute(stmt).scalars().all()
 
     @staticmethod
     def obter_estatisticas_rag(db: Session, rag_id: int, dias: int = 30) -> Dict[str, Any]:
@@ -115,16 +283,39 @@ class RAGMetricaService:
             dias: Quantidade de dias para análise
             
         Returns:
-            Dicionário com estatísticas
+            Dicionário com estatísticas (em cache por CACHE_TTL segundos)
         """
-        data_inicio = datetime.now() - timedelta(days=dias)
+        return _em_cache(
+            ("estatisticas", rag_id, dias),
+            lambda: RAGMetricaService._calcular_estatisticas_rag(db, rag_id, dias)
+        )
+
+    @staticmethod
+    def _calcular_estatisticas_rag(db: Session, rag_id: int, dias: int) -> Dict[str, Any]:
+        periodo = RAGMetricaService._metricas_periodo(db, rag_id, dias)
         
-        metricas = db.query(RAGMetrica).filter(
-            RAGMetrica.rag_id == rag_id,
-            RAGMetrica.criado_em >= data_inicio
-        ).all()
+        # Agregação no banco: apenas os números, sem carregar as métricas (e o texto das queries)
+        (
+            total_buscas,
+            tempo_total,
+            tempo_minimo,
+            tempo_maximo,
+            resultados_total,
+            queries_unicas,
+            agentes_distintos,
+            sessoes_distintas
+        ) = db.execute(select(
+            func.sum(periodo.c.buscas),
+            func.sum(periodo.c.tempo_total_ms),
+            func.min(periodo.c.tempo_minimo_ms),
+            func.max(periodo.c.tempo_maximo_ms),
+            func.sum(periodo.c.resultados_total),
+            func.count(func.distinct(periodo.c.query_hash)),
+            func.count(func.distinct(periodo.c.agente_id)),
+            func.count(func.distinct(periodo.c.sessao_id))
+        )).one()
         
-        if not metricas:
+        if not total_buscas:
             return {
                 "total_buscas": 0,
                 "tempo_medio_ms": 0,
@@ -137,18 +328,12 @@ class RAGMetricaService:
                 "periodo_dias": dias
             }
         
-        tempos = [m.tempo_ms for m in metricas]
-        resultados = [m.num_resultados_retornados for m in metricas]
-        queries_unicas = len(set(m.query for m in metricas))
-        agentes_distintos = len(set(m.agente_id for m in metricas if m.agente_id))
-        sessoes_distintas = len(set(m.sessao_id for m in metricas if m.sessao_id))
-        
         return {
-            "total_buscas": len(metricas),
-            "tempo_medio_ms": int(sum(tempos) / len(tempos)),
-            "tempo_minimo_ms": min(tempos),
-            "tempo_maximo_ms": max(tempos),
-            "media_resultados": round(sum(resultados) / len(resultados), 2),
+            "total_buscas": int(total_buscas),
+            "tempo_medio_ms": int(tempo_total / total_buscas),
+            "tempo_minimo_ms": tempo_minimo,
+            "tempo_maximo_ms": tempo_maximo,
+            "media_resultados": round(resultados_total / total_buscas, 2),
             "queries_unicas": queries_unicas,
             "agentes_distintos": agentes_distintos,
             "sessoes_distintas": sessoes_distintas,
@@ -172,40 +357,133 @@ class RAGMetricaService:
             dias: Período em dias
             
         Returns:
-            Lista com queries e suas frequências
+            Lista com queries e suas frequências (em cache por CACHE_TTL segundos)
         """
-        data_inicio = datetime.now() - timedelta(days=dias)
-        
-        from sqlalchemy import func
+        return _em_cache(
+            ("queries_frequentes", rag_id, limit, dias),
+            lambda: RAGMetricaService._calcular_queries_mais_frequentes(db, rag_id, limit, dias)
+        )
+
+    @staticmethod
+    def _calcular_queries_mais_frequentes(db: Session, rag_id: int, limit: int, dias: int) -> List[Dict[str, Any]]:
+        periodo = RAGMetricaService._metricas_periodo(db, rag_id, dias)
+        frequencia = func.sum(periodo.c.buscas)
         
-        resultados = db.query(
-            RAGMetrica.query,
-            func.count(RAGMetrica.id).label('frequencia'),
-            func.avg(RAGMetrica.tempo_ms).label('tempo_medio_ms'),
-            func.avg(RAGMetrica.num_resultados_retornados).label('media_resultados')
-        ).filter(
-            RAGMetrica.rag_id == rag_id,
-            RAGMetrica.criado_em >= data_inicio
-        ).group_by(
-            RAGMetrica.query
-        ).order_by(
-            func.count(RAGMetrica.id).desc()
-        ).limit(limit).all()
+        resultados = db.execute(
+            select(
+                func.min(periodo.c.query).label('query'),
+                frequencia.label('frequencia'),
+                func.sum(periodo.c.tempo_total_ms).label('tempo_total_ms'),
+                func.sum(periodo.c.resultados_total).label('resultados_total')
+            )
+            .group_by(periodo.c.query_hash)
+            .order_by(frequencia.desc())
+            .limit(limit)
+        ).all()
         
         return [
             {
                 "query": r.query,
-                "frequencia": r.frequencia,
-                "tempo_medio_ms": int(r.tempo_medio_ms),
-                "media_resultados": round(r.media_resultados, 2)
+                "frequencia": int(r.frequencia),
+                "tempo_medio_ms": int(r.tempo_total_ms / r.frequencia),
+                "media_resultados": round(r.resultados_total / r.frequencia, 2)
             }
             for r in resultados
         ]
 
+    @staticmethod
+    def _metricas_periodo(db: Session, rag_id: int, dias: int):
+        """
+        Subquery com as buscas do período no grão de rag_metricas_dia: dias já
+        consolidados vêm do roll-up; o restante (hoje e o que ainda não passou pela
+        consolidação) vem de rag_metricas, uma linha por busca.
+        """
+        dia_inicio = (datetime.now() - timedelta(days=dias)).date()
+        consolidado_ate = db.scalar(select(func.max(RAGMetricaDia.dia)))
+        
+        consolidadas = select(
+            RAGMetricaDia.query,
+            RAGMetricaDia.query_hash,
+            RAGMetricaDia.agente_id,
+            RAGMetricaDia.sessao_id,
+            RAGMetricaDia.buscas,
+            RAGMetricaDia.tempo_total_ms,
+            RAGMetricaDia.tempo_minimo_ms,
+            RAGMetricaDia.tempo_maximo_ms,
+            RAGMetricaDia.resultados_total
+        ).where(
+            RAGMetricaDia.rag_id == rag_id,
+            RAGMetricaDia.dia >= dia_inicio
+        )
+        
+        inicio_vivo = dia_inicio
+        if consolidado_ate and consolidado_ate >= dia_inicio:
+            inicio_vivo = consolidado_ate + timedelta(days=1)
+        vivas = select(
+            RAGMetrica.query,
+            RAGMetrica.query_hash,
+            RAGMetrica.agente_id,
+            RAGMetrica.sessao_id,
+            literal(1),
+            RAGMetrica.tempo_ms,
+            RAGMetrica.tempo_ms,
+            RAGMetrica.tempo_ms,
+            RAGMetrica.num_resultados_retornados
+        ).where(
+            RAGMetrica.rag_id == rag_id,
+            RAGMetrica.criado_em >= datetime.combine(inicio_vivo, datetime.min.time())
+        )
+        
+        return union_all(consolidadas, vivas).subquery()
+
+    @staticmethod
+    def consolidar_por_dia(db: Session) -> int:
+        """
+        Consolida em rag_metricas_dia os dias encerrados (anteriores a hoje) ainda não
+        consolidados, refazendo o último dia já consolidado (mesmo critério de
+        MetricaService.consolidar_mensagens_por_dia). Retorna o número de linhas geradas.
+        """
+        dia = func.date(RAGMetrica.criado_em)
+        agregado = select(
+            RAGMetrica.rag_id,
+            dia,
+            func.min(RAGMetrica.query),
+            RAGMetrica.query_hash,
+            RAGMetrica.agente_id,
+            RAGMetrica.sessao_id,
+            func.count(RAGMetrica.id),
+            func.sum(RAGMetrica.tempo_ms),
+            func.min(RAGMetrica.tempo_ms),
+            func.max(RAGMetrica.tempo_ms),
+            func.sum(RAGMetrica.num_resultados_retornados)
+        ).where(dia < func.current_date()).group_by(
+            RAGMetrica.rag_id, dia, RAGMetrica.query_hash, RAGMetrica.agente_id, RAGMetrica.sessao_id
+        )
+        
+        consolidado_ate = db.scalar(select(func.max(RAGMetricaDia.dia)))
+        if consolidado_ate:
+            agregado = agregado.where(
+                RAGMetrica.criado_em >= datetime.combine(consolidado_ate, datetime.min.time())
+            )
+            db.execute(delete(RAGMetricaDia).where(RAGMetricaDia.dia >= consolidado_ate))
+        resultado = db.execute(
+            insert(RAGMetricaDia).from_select(
+                [
+                    "rag_id", "dia", "query", "query_hash", "agente_id", "sessao_id", "buscas",
+                    "tempo_total_ms", "tempo_minimo_ms", "tempo_maximo_ms", "resultados_total"
+                ],
+                agregado
+            )
+        )
+        db.commit()
+        
+        return resultado.rowcount
+
     @staticmethod
     def deletar_metricas_antigas(db: Session, dias: int = 90) -> int:
         """
-        Deleta métricas mais antigas que X dias.
+        Deleta métricas mais antigas que X dias, em transações de até
+        LOTE_EXCLUSAO linhas (sem um DELETE longo travando rag_metricas).
         
         Args:
             db: Sessão do banco
@@ -216,11 +494,25 @@ class RAGMetricaService:
         """
         data_limite = datetime.now() - timedelta(days=dias)
         
-        count = db.query(RAGMetrica).filter(
-            RAGMetrica.criado_em < data_limite
-        ).delete()
+        count = 0
+        while True:
+            lote = select(RAGMetrica.id).where(
+                RAGMetrica.criado_em < data_limite
+            ).limit(LOTE_EXCLUSAO)
+            deletadas = db.execute(
+                delete(RAGMetrica).where(RAGMetrica.id.in_(lote))
+            ).rowcount
+            db.commit()
+            count += deletadas
+            if deletadas < LOTE_EXCLUSAO:
+                break
         
+        db.query(RAGMetricaDia).filter(
+            RAGMetricaDia.dia < data_limite.date()
+        ).delete(synchronize_session=False)
         db.commit()
-        logger.info(f"Deletadas {count} métricas com mais de {dias} dias")
+        with _cache_lock:
+            _cache.clear()
+        logger.info("Deletadas %s métricas com mais de %s dias", count, dias)
         return count
 
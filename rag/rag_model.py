@@ -36,7 +36,7 @@ class RAG(Base):
     api_key_embed = Column(Text, nullable=True)
     
     # Status
-    ativo = Column(Boolean, default=True)
+    ativo = Column(Boolean, default=True, index=True)  # listar_ativos
     treinado = Column(Boolean, default=False)
     
     # Metadados
@@ -1,7 +1,8 @@
 """
 Rotas da API para RAG.
 """
-from fastapi import APIRouter, Depends, HTTPException, Form
+from fastapi import APIRouter, Depends, HTTPException, Form, Response
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
 import logging
@@ -13,22 +14,31 @@ from rag.rag_schema import (
     RAGBuscaRequest,
     RAGTextoRequest
 )
-from rag.rag_service import RAGService
+from rag.rag_service import RAGService, CACHE_ATIVOS_TTL
 
 # Configurar logger
 logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/api/rags", tags=["RAG"])
+router = APIRouter(
+    prefix="/api/rags",
+    tags=["RAG"],
+    default_response_class=ORJSONResponse  # chunks e resultados de busca são payloads grandes
+)
+
+# A lista de RAGs ativos fica em cache no serviço; o cliente/proxy também pode reaproveitar
+_CACHE_CONTROL = f"public, max-age={CACHE_ATIVOS_TTL}"
 
 
 @router.get("/", response_model=List[RAGResposta])
 def listar_rags(
+    response: Response,
     apenas_ativos: bool = False,
     db: Session = Depends(get_db)
 ):
-    """Lista todos os RAGs."""
+    """Lista todos os RAGs (apenas_ativos=true usa cache de 30s)."""
     if apenas_ativos:
-        return RAGService.listar_ativos(db)
+        response.headers["Cache-Control"] = _CACHE_CONTROL
+        return RAGService.listar_ativos_em_cache(db)
     return RAGService.listar_todos(db)
 
 
@@ -85,7 +95,7 @@ def adicionar_texto(
     db: Session = Depends(get_db)
 ):
     """Adiciona texto direto ao RAG."""
-    logger.info(f"API: Adicionando texto '{titulo}' ao RAG {rag_id}")
+    logger.info("API: Adicionando texto '%s' ao RAG %s", titulo, rag_id)
     
     try:
         resultado = RAGService.adicionar_texto(
@@ -104,7 +114,7 @@ def adicionar_texto(
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"API: Erro ao adicionar texto: {str(e)}", exc_info=True)
+        logger.error("API: Erro ao adicionar texto: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro ao adicionar texto: {str(e)}")
 
 
@@ -123,25 +133,35 @@ def buscar(
             busca.top_k,
             busca.session_id
         )
-        return {
+        # Dicts simples (texto + metadados): serializados direto pelo orjson
+        return ORJSONResponse({
             "query": busca.query,
             "total_resultados": len(resultados),
             "resultados": resultados
-        }
+        })
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.get("/{rag_id}/chunks")
-def listar_chunks(rag_id: int, limit: int = 50, offset: int = 0, db: Session = Depends(get_db)):
-    """Lista chunks do RAG."""
+def listar_chunks(
+    rag_id: int,
+    limit: int = 50,
+    offset: int = 0,
+    after_id: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """Lista chunks do RAG. Para paginar, prefira after_id=proximo_after_id a offset."""
     try:
-        chunks = RAGService.obter_chunks(db, rag_id, limit, offset)
-        return {"chunks": chunks}
+        chunks = RAGService.obter_chunks(db, rag_id, limit, offset, after_id)
+        return ORJSONResponse({
+            "chunks": chunks,
+            "proximo_after_id": chunks[-1]["id"] if len(chunks) == limit else None
+        })
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"API: Erro ao listar chunks: {str(e)}", exc_info=True)
+        logger.error("API: Erro ao listar chunks: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro ao listar chunks: {str(e)}")
 
 
@@ -149,18 +169,16 @@ def listar_chunks(rag_id: int, limit: int = 50, offset: int = 0, db: Session = D
 def obter_chunk(rag_id: int, chunk_id: str, db: Session = Depends(get_db)):
     """Obtém um chunk específico."""
     try:
-        chunks = RAGService.obter_chunks(db, rag_id, limit=1000)
-        
-        for chunk in chunks:
-            if chunk["id"] == chunk_id:
-                return chunk
-        
-        raise HTTPException(status_code=404, detail="Chunk não encontrado")
+        chunk = RAGService.obter_chunk_por_id(db, rag_id, chunk_id)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"API: Erro ao obter chunk: {str(e)}", exc_info=True)
+        logger.error("API: Erro ao obter chunk: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro ao obter chunk: {str(e)}")
+    
+    if chunk is None:
+        raise HTTPException(status_code=404, detail="Chunk não encontrado")
+    return chunk
 
 
 @router.delete("/{rag_id}/chunks/{chunk_id}")
@@ -176,7 +194,7 @@ def deletar_chunk(rag_id: int, chunk_id: str, db: Session = Depends(get_db)):
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"API: Erro ao deletar chunk: {str(e)}", exc_info=True)
+        logger.error("API: Erro ao deletar chunk: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro ao deletar chunk: {str(e)}")
 
 
@@ -196,5 +214,5 @@ def obter_estatisticas(rag_id: int, db: Session = Depends(get_db)):
         stats = RAGService.obter_estatisticas(db, rag_id)
         return stats
     except Exception as e:
-        logger.error(f"API: Erro ao obter estatísticas: {str(e)}", exc_info=True)
+        logger.error("API: Erro ao obter estatísticas: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro ao obter estatísticas: {str(e)}")
\ No newline at end of file
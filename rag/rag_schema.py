@@ -1,7 +1,7 @@
 """
 Schemas Pydantic para validação de dados RAG.
 """
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, Dict, Any
 from datetime import datetime
 
@@ -53,8 +53,7 @@ class RAGResposta(BaseModel):
     atualizado_em: Optional[datetime]
     treinado_em: Optional[datetime]
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class RAGBuscaRequest(BaseModel):
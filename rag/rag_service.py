@@ -1,33 +1,67 @@
 """
 Serviço de lógica de negócio para RAG customizado.
 """
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, raiseload
 from typing import Optional, List, Dict, Any
-import os
 import logging
+import threading
+import time
 from datetime import datetime
 
 from rag.rag_model import RAG
 from rag.rag_metrica_model import RAGMetrica  # Importar para registrar no ORM
-from rag.rag_schema import RAGCriar, RAGAtualizar
+from rag.rag_schema import RAGCriar, RAGAtualizar, RAGResposta
+from rag.rag_custom_service import RAGCustomService
 from config.rag_config import RAGConfig
 
 # Configurar logger
 logger = logging.getLogger(__name__)
 
+# Lista de RAGs ativos já serializada (polling do painel): (expira_em, lista).
+# Descartada a cada alteração de RAG feita por este serviço.
+CACHE_ATIVOS_TTL = 30  # segundos
+_cache_ativos: Optional[tuple] = None
+
+# Instâncias de RAGCustomService reaproveitadas entre chamadas (abrir o ChromaDB
+# a cada busca é caro). Chave: (id, storage_path, modelo_embed, provider, api_key)
+_instancias: Dict[tuple, RAGCustomService] = {}
+_instancias_lock = threading.Lock()
+# Para buscar: rag_id -> (instância, top_k). Campos que só mudam em atualizar(),
+# que descarta a entrada; assim a busca só consulta treinado/nome no banco.
+_buscas: Dict[int, tuple] = {}
+
 
 class RAGService:
     """Serviço para gerenciar RAG customizado."""
 
     @staticmethod
     def listar_todos(db: Session) -> List[RAG]:
-        """Lista todos os RAGs."""
-        return db.query(RAG).all()
+        """Lista todos os RAGs (sem relacionamentos: acesso a eles falha em vez de gerar N+1)."""
+        return db.query(RAG).options(raiseload("*")).all()
 
     @staticmethod
     def listar_ativos(db: Session) -> List[RAG]:
-        """Lista RAGs ativos."""
-        return db.query(RAG).filter(RAG.ativo == True).all()
+        """Lista RAGs ativos (sem relacionamentos, como listar_todos)."""
+        return db.query(RAG).options(raiseload("*")).filter(RAG.ativo == True).all()
+
+    @staticmethod
+    def listar_ativos_em_cache(db: Session) -> List[RAGResposta]:
+        """Lista RAGs ativos já como RAGResposta, em cache por CACHE_ATIVOS_TTL segundos."""
+        global _cache_ativos
+        item = _cache_ativos
+        agora = time.monotonic()
+        if item and item[0] > agora:
+            return item[1]
+        
+        rags = [RAGResposta.model_validate(rag) for rag in RAGService.listar_ativos(db)]
+        _cache_ativos = (agora + CACHE_ATIVOS_TTL, rags)
+        return rags
+
+    @staticmethod
+    def invalidar_cache():
+        """Descarta a lista de RAGs ativos em cache."""
+        global _cache_ativos
+        _cache_ativos = None
 
     @staticmethod
     def obter_por_id(db: Session, rag_id: int) -> Optional[RAG]:
@@ -39,17 +73,20 @@ class RAGService:
         """Obtém um RAG pelo nome."""
         return db.query(RAG).filter(RAG.nome == nome).first()
 
+    @staticmethod
+    def nome_existe(db: Session, nome: str) -> bool:
+        """Verifica se há RAG com o nome (SELECT EXISTS, sem carregar a linha)."""
+        return db.query(db.query(RAG.id).filter(RAG.nome == nome).exists()).scalar()
+
     @staticmethod
     def criar(db: Session, rag: RAGCriar) -> RAG:
         """Cria um novo RAG."""
         # Verificar se já existe RAG com mesmo nome
-        existe = RAGService.obter_por_nome(db, rag.nome)
-        if existe:
+        if RAGService.nome_existe(db, rag.nome):
             raise ValueError(f"Já existe um RAG com o nome '{rag.nome}'")
         
-        # Criar diretório de storage
+        # O diretório de storage só é criado quando o RAG é usado (RAGCustomService)
         storage_path = f"rags/{rag.nome.replace(' ', '_').lower()}"
-        os.makedirs(storage_path, exist_ok=True)
         
         # Criar RAG
         db_rag = RAG(
@@ -68,6 +105,7 @@ class RAGService:
         
         db.add(db_rag)
         db.commit()
+        RAGService.invalidar_cache()
         db.refresh(db_rag)
         return db_rag
 
@@ -82,8 +120,7 @@ class RAGService:
         
         # Verificar se está mudando o nome e se já existe outro com esse nome
         if "nome" in update_data and update_data["nome"] != db_rag.nome:
-            existe = RAGService.obter_por_nome(db, update_data["nome"])
-            if existe:
+            if RAGService.nome_existe(db, update_data["nome"]):
                 raise ValueError(f"Já existe um RAG com o nome '{update_data['nome']}'")
         
         for campo, valor in update_data.items():
@@ -94,6 +131,8 @@ class RAGService:
             db_rag.api_key_embed = rag.api_key_embed
 
         db.commit()
+        RAGService.invalidar_cache()
+        RAGService.descartar_instancia(rag_id)
         db.refresh(db_rag)
         return db_rag
 
@@ -106,39 +145,52 @@ class RAGService:
 
         db.delete(db_rag)
         db.commit()
+        RAGService.invalidar_cache()
+        RAGService.descartar_instancia(rag_id)
         return True
 
     @staticmethod
-    def inicializar_rag_service(rag: RAG) -> Any:
+    def inicializar_rag_service(rag: RAG) -> RAGCustomService:
         """
-        Inicializa instância do RAG customizado.
+        Retorna a instância do RAG customizado, criando-a na primeira chamada.
+        A instância é reaproveitada enquanto o RAG não for alterado (ver descartar_instancia).
         """
-        logger.info(f"Inicializando RAG customizado para '{rag.nome}' (Provider: {rag.provider})")
+        chave = (rag.id, rag.storage_path, rag.modelo_embed, rag.provider, rag.api_key_embed)
+        with _instancias_lock:
+            rag_service = _instancias.get(chave)
+        if rag_service is not None:
+            return rag_service
+        
+        logger.info("Inicializando RAG customizado para '%s' (Provider: %s)", rag.nome, rag.provider)
         
         try:
-            from rag.rag_custom_service import RAGCustomService
-            logger.info("RAG customizado importado com sucesso")
-            
             # Verificar API key
             if not rag.api_key_embed:
                 raise ValueError("API key é obrigatória para o RAG customizado")
             
             # Criar instância do RAG customizado
-            logger.info("Criando instância do RAG customizado...")
             rag_service = RAGCustomService(
                 rag_id=rag.id,
                 storage_path=rag.storage_path,
                 api_key=rag.api_key_embed
             )
             logger.info("RAG customizado criado com sucesso")
-            return rag_service
             
-        except ImportError as e:
-            logger.error("Dependências do RAG customizado não estão instaladas")
-            raise ValueError("Dependências não instaladas. Execute: pip install openai chromadb numpy")
         except Exception as e:
-            logger.error(f"Erro ao inicializar RAG customizado: {str(e)}", exc_info=True)
+            logger.error("Erro ao inicializar RAG customizado: %s", e, exc_info=True)
             raise ValueError(f"Erro ao inicializar RAG customizado: {str(e)}")
+        
+        with _instancias_lock:
+            # Outra thread pode ter criado a instância enquanto esta inicializava
+            return _instancias.setdefault(chave, rag_service)
+
+    @staticmethod
+    def descartar_instancia(rag_id: int):
+        """Descarta as instâncias em cache do RAG (após alterá-lo, resetá-lo ou deletá-lo)."""
+        with _instancias_lock:
+            for chave in [k for k in _instancias if k[0] == rag_id]:
+                del _instancias[chave]
+            _buscas.pop(rag_id, None)
 
     @staticmethod
     def adicionar_texto(
@@ -150,7 +202,7 @@ class RAGService:
         chunk_overlap: Optional[int] = None
     ) -> Dict[str, Any]:
         """Adiciona texto à base de conhecimento."""
-        logger.info(f"Adicionando texto '{titulo}' ao RAG {rag_id}")
+        logger.info("Adicionando texto '%s' ao RAG %s", titulo, rag_id)
         
         rag = RAGService.obter_por_id(db, rag_id)
         if not rag:
@@ -177,8 +229,9 @@ class RAGService:
                 rag.treinado_em = datetime.now()
                 rag.total_chunks = result["total_chunks"]
                 db.commit()
+                RAGService.invalidar_cache()
                 
-                logger.info(f"Texto adicionado com sucesso: {result['chunks_created']} chunks")
+                logger.info("Texto adicionado com sucesso: %s chunks", result['chunks_created'])
                 return {
                     "sucesso": True,
                     "chunks_criados": result["chunks_created"],
@@ -188,7 +241,7 @@ class RAGService:
                 raise ValueError(f"Erro ao adicionar texto: {result.get('error', 'Erro desconhecido')}")
             
         except Exception as e:
-            logger.error(f"Erro ao adicionar texto: {str(e)}", exc_info=True)
+            logger.error("Erro ao adicionar texto: %s", e, exc_info=True)
             return {
                 "sucesso": False,
                 "erro": str(e)
@@ -205,45 +258,72 @@ class RAGService:
         """
         Realiza busca semântica no RAG customizado.
         """
-        rag = RAGService.obter_por_id(db, rag_id)
-        if not rag:
+        estado = db.query(RAG.treinado, RAG.nome).filter(RAG.id == rag_id).first()
+        if not estado:
             raise ValueError(f"RAG {rag_id} não encontrado")
         
-        if not rag.treinado:
-            raise ValueError(f"RAG '{rag.nome}' ainda não foi treinado")
+        if not estado.treinado:
+            raise ValueError(f"RAG '{estado.nome}' ainda não foi treinado")
         
         try:
-            # Inicializar RAG customizado
-            rag_service = RAGService.inicializar_rag_service(rag)
+            # Inicializar RAG customizado (linha completa só na primeira busca)
+            with _instancias_lock:
+                em_cache = _buscas.get(rag_id)
+            if em_cache is None:
+                rag = RAGService.obter_por_id(db, rag_id)
+                em_cache = (RAGService.inicializar_rag_service(rag), rag.top_k)
+                with _instancias_lock:
+                    _buscas[rag_id] = em_cache
+            rag_service, top_k_padrao = em_cache
             
             # Usar top_k configurado ou padrão do RAG
-            num_results = top_k if top_k else rag.top_k
+            num_results = top_k if top_k else top_k_padrao
             
             # Realizar busca
-            logger.info(f"Realizando busca: '{query}' (top_k={num_results})")
+            logger.info("Realizando busca: '%s' (top_k=%s)", query, num_results)
             resultados = rag_service.search(query, top_k=num_results)
             
-            logger.info(f"Busca retornou {len(resultados)} resultados")
+            logger.info("Busca retornou %s resultados", len(resultados))
             return resultados
             
         except Exception as e:
-            logger.error(f"Erro ao buscar no RAG: {str(e)}", exc_info=True)
+            logger.error("Erro ao buscar no RAG: %s", e, exc_info=True)
             raise ValueError(f"Erro ao buscar no RAG: {str(e)}")
 
     @staticmethod
-    def obter_chunks(db: Session, rag_id: int, limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
-        """Obtém chunks do RAG."""
+    def obter_chunks(
+        db: Session,
+        rag_id: int,
+        limit: int = 50,
+        offset: int = 0,
+        after_id: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Obtém chunks do RAG (after_id: paginação por chave, a partir do chunk informado)."""
         rag = RAGService.obter_por_id(db, rag_id)
         if not rag:
             raise ValueError(f"RAG {rag_id} não encontrado")
         
         try:
             rag_service = RAGService.inicializar_rag_service(rag)
-            return rag_service.get_chunks(limit=limit, offset=offset)
+            return rag_service.get_chunks(limit=limit, offset=offset, after_id=after_id)
         except Exception as e:
-            logger.error(f"Erro ao obter chunks: {str(e)}", exc_info=True)
+            logger.error("Erro ao obter chunks: %s", e, exc_info=True)
             return []
 
+    @staticmethod
+    def obter_chunk_por_id(db: Session, rag_id: int, chunk_id: str) -> Optional[Dict[str, Any]]:
+        """Obtém um chunk do RAG pelo ID (None se não existir)."""
+        rag = RAGService.obter_por_id(db, rag_id)
+        if not rag:
+            raise ValueError(f"RAG {rag_id} não encontrado")
+        
+        try:
+            rag_service = RAGService.inicializar_rag_service(rag)
+            return rag_service.get_chunk(chunk_id)
+        except Exception as e:
+            logger.error("Erro ao obter chunk: %s", e, exc_info=True)
+            return None
+
     @staticmethod
     def deletar_chunk(db: Session, rag_id: int, chunk_id: str) -> bool:
         """Deleta um chunk específico."""
@@ -259,10 +339,11 @@ class RAGService:
                 # Atualizar contador de chunks
                 rag.total_chunks = max(0, rag.total_chunks - 1)
                 db.commit()
+                RAGService.invalidar_cache()
             
             return sucesso
         except Exception as e:
-            logger.error(f"Erro ao deletar chunk: {str(e)}", exc_info=True)
+            logger.error("Erro ao deletar chunk: %s", e, exc_info=True)
             return False
 
     @staticmethod
@@ -283,10 +364,12 @@ class RAGService:
             rag.total_chunks = 0
             
             db.commit()
+            RAGService.invalidar_cache()
+            RAGService.descartar_instancia(rag_id)
             return True
             
         except Exception as e:
-            logger.error(f"Erro ao resetar RAG: {str(e)}", exc_info=True)
+            logger.error("Erro ao resetar RAG: %s", e, exc_info=True)
             return False
 
     @staticmethod
@@ -313,5 +396,5 @@ class RAGService:
                 }
             }
         except Exception as e:
-            logger.error(f"Erro ao obter estatísticas: {str(e)}", exc_info=True)
+            logger.error("Erro ao obter estatísticas: %s", e, exc_info=True)
             return {}
\ No newline at end of file
@@ -5,11 +5,15 @@ from fastapi import APIRouter, Depends, Request, Form
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
+import logging
 from database import get_db
 from sessao.sessao_service import SessaoService
 from sessao.sessao_schema import SessaoCriar, SessaoAtualizar
 from config.config_service import ConfiguracaoService
 
+# Configurar logger
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/sessoes", tags=["Frontend - Sessões"])
 templates = Jinja2Templates(directory="templates")
 
@@ -29,22 +33,35 @@ def pagina_sessoes(request: Request, db: Session = Depends(get_db)):
 @router.get("/nova", response_class=HTMLResponse)
 def pagina_nova_sessao(request: Request, db: Session = Depends(get_db)):
     """Página para criar nova sessão."""
-    # Buscar configurações padrão do agente
+    # Buscar configurações padrão do agente e do LLM (uma consulta)
+    valores = ConfiguracaoService.obter_valores(db, {
+        "agente_papel_padrao": "assistente pessoal",
+        "agente_objetivo_padrao": "ajudar o usuário",
+        "agente_politicas_padrao": "ser educado e respeitoso",
+        "agente_tarefa_padrao": "responder perguntas",
+        "agente_objetivo_explicito_padrao": "fornecer informações úteis",
+        "agente_publico_padrao": "usuários em geral",
+        "agente_restricoes_padrao": "responder em português",
+        "openrouter_modelo_padrao": "google/gemini-2.0-flash-001",
+        "openrouter_temperatura": "0.7",
+        "openrouter_max_tokens": "2000",
+        "openrouter_top_p": "1.0"
+    })
     config_agente = {
-        "papel": ConfiguracaoService.obter_valor(db, "agente_papel_padrao", "assistente pessoal"),
-        "objetivo": ConfiguracaoService.obter_valor(db, "agente_objetivo_padrao", "ajudar o usuário"),
-        "politicas": ConfiguracaoService.obter_valor(db, "agente_politicas_padrao", "ser educado e respeitoso"),
-        "tarefa": ConfiguracaoService.obter_valor(db, "agente_tarefa_padrao", "responder perguntas"),
-        "objetivo_explicito": ConfiguracaoService.obter_valor(db, "agente_objetivo_explicito_padrao", "fornecer informações úteis"),
-        "publico": ConfiguracaoService.obter_valor(db, "agente_publico_padrao", "usuários em geral"),
-        "restricoes": ConfiguracaoService.obter_valor(db, "agente_restricoes_padrao", "responder em português")
+        "papel": valores["agente_papel_padrao"],
+        "objetivo": valores["agente_objetivo_padrao"],
+        "politicas": valores["agente_politicas_padrao"],
+        "tarefa": valores["agente_tarefa_padrao"],
+        "objetivo_explicito": valores["agente_objetivo_explicito_padrao"],
+        "publico": valores["agente_publico_padrao"],
+        "restricoes": valores["agente_restricoes_padrao"]
     }
     
-    # Buscar configurações LLM
-    modelo_padrao = ConfiguracaoService.obter_valor(db, "openrouter_modelo_padrao", "google/gemini-2.0-flash-001")
-    temperatura_padrao = ConfiguracaoService.obter_valor(db, "openrouter_temperatura", "0.7")
-    max_tokens_padrao = ConfiguracaoService.obter_valor(db, "openrouter_max_tokens", "2000")
-    top_p_padrao = ConfiguracaoService.obter_valor(db, "openrouter_top_p", "1.0")
+    # Configurações LLM
+    modelo_padrao = valores["openrouter_modelo_padrao"]
+    temperatura_padrao = valores["openrouter_temperatura"]
+    max_tokens_padrao = valores["openrouter_max_tokens"]
+    top_p_padrao = valores["openrouter_top_p"]
     
     return templates.TemplateResponse("sessao/form.html", {
         "request": request,
@@ -80,7 +97,7 @@ def pagina_editar_sessao(sessao_id: int, request: Request, db: Session = Depends
 @router.get("/{sessao_id}/detalhes", response_class=HTMLResponse)
 def pagina_detalhes_sessao(sessao_id: int, request: Request, db: Session = Depends(get_db)):
     """Página de detalhes da sessão."""
-    sessao = SessaoService.obter_por_id(db, sessao_id)
+    sessao = SessaoService.obter_por_id(db, sessao_id, com_agente_ativo=True)
     if not sessao:
         return templates.TemplateResponse("shared/erro.html", {
             "request": request,
@@ -98,7 +115,8 @@ def pagina_detalhes_sessao(sessao_id: int, request: Request, db: Session = Depen
 @router.get("/{sessao_id}/conectar", response_class=HTMLResponse)
 def pagina_conectar_sessao(sessao_id: int, request: Request, db: Session = Depends(get_db)):
     """Página para conectar sessão via QR Code."""
-    from datetime import datetime, timedelta
+    from datetime import datetime
+    from sessao.sessao_service import QR_CODE_VALIDADE, gerenciador_sessoes
     
     sessao = SessaoService.obter_por_id(db, sessao_id)
     if not sessao:
@@ -108,25 +126,23 @@ def pagina_conectar_sessao(sessao_id: int, request: Request, db: Session = Depen
             "titulo": "Erro"
         })
     
-    # Verificar se QR Code expirou (60 segundos)
+    # Os ajustes abaixo são só para exibição: com o objeto fora da Session, nada é
+    # gravado (a limpeza no banco é feita por SessaoService.expirar_qr_codes)
+    db.expunge(sessao)
+    
+    # QR Code do gerenciador é sempre o mais recente; sua validade é controlada
+    # com time.monotonic() pelo próprio cache
     qr_code_expirado = False
-    if sessao.qr_code and sessao.qr_code_gerado_em:
-        tempo_decorrido = datetime.now() - sessao.qr_code_gerado_em
-        if tempo_decorrido > timedelta(seconds=60):
+    qr_code_gerenciador = gerenciador_sessoes.qr_codes.get(sessao_id)
+    if qr_code_gerenciador:
+        sessao.qr_code = qr_code_gerenciador
+    elif sessao.qr_code and sessao.qr_code_gerado_em:
+        # Só o QR Code do banco (ainda não limpo pela tarefa periódica) usa o relógio
+        if datetime.now() - sessao.qr_code_gerado_em > QR_CODE_VALIDADE:
             qr_code_expirado = True
-            print(f"⏰ QR Code expirado para sessão {sessao_id} ({tempo_decorrido.seconds}s)")
-            # Limpar QR Code expirado
             sessao.qr_code = None
             sessao.status = "desconectado"
     
-    # Verificar se há QR Code no gerenciador (sempre prioritário)
-    from sessao.sessao_service import gerenciador_sessoes
-    qr_code_gerenciador = gerenciador_sessoes.qr_codes.get(sessao_id)
-    if qr_code_gerenciador and not qr_code_expirado:
-        # Sempre usar QR Code do gerenciador (mais recente)
-        sessao.qr_code = qr_code_gerenciador
-        print(f"🔄 QR Code do gerenciador aplicado à sessão {sessao_id} ({len(qr_code_gerenciador)} chars)")
-    
     return templates.TemplateResponse("sessao/paircode.html", {
         "request": request,
         "sessao": sessao,
@@ -148,11 +164,11 @@ def conectar_sessao_post(
             sessao.qr_code = None
             sessao.qr_code_gerado_em = None
             db.commit()
-            print(f"🧹 QR Code antigo limpo para sessão {sessao_id}")
+            logger.debug("QR Code antigo limpo para sessão %s", sessao_id)
         
         SessaoService.conectar(db, sessao_id, usar_paircode=False)
     except Exception as e:
-        print(f"Erro ao conectar: {e}")
+        logger.error("Erro ao conectar: %s", e)
     return RedirectResponse(url=f"/sessoes/{sessao_id}/conectar", status_code=303)
 
 
@@ -162,7 +178,7 @@ def desconectar_sessao_post(sessao_id: int, db: Session = Depends(get_db)):
     try:
         SessaoService.desconectar(db, sessao_id)
     except Exception as e:
-        print(f"Erro ao desconectar: {e}")
+        logger.error("Erro ao desconectar: %s", e)
     return RedirectResponse(url="/sessoes", status_code=303)
 
 
@@ -171,9 +187,9 @@ def deletar_sessao_post(sessao_id: int, db: Session = Depends(get_db)):
     """Deleta uma sessão WhatsApp."""
     try:
         SessaoService.deletar(db, sessao_id)
-        print(f"✅ Sessão {sessao_id} deletada com sucesso")
+        logger.debug("Sessão %s deletada com sucesso", sessao_id)
     except Exception as e:
-        print(f"Erro ao deletar: {e}")
+        logger.error("Erro ao deletar: %s", e)
     return RedirectResponse(url="/sessoes", status_code=303)
 
 
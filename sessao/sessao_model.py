@@ -1,7 +1,7 @@
 """
 Modelo de dados para sessões WhatsApp.
 """
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, JSON, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, JSON, ForeignKey, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
@@ -13,6 +13,10 @@ class Sessao(Base):
     Cada sessão representa uma conta WhatsApp conectada e pode ter múltiplos agentes.
     """
     __tablename__ = "sessoes"
+    __table_args__ = (
+        # Listagem de sessões ativas (filtro por ativa) e contagens por ativa/status
+        Index("ix_sessoes_ativa_status", "ativa", "status"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     nome = Column(String(100), nullable=False, unique=True, index=True)
@@ -27,7 +31,7 @@ class Sessao(Base):
     agente_ativo_id = Column(Integer, ForeignKey("agentes.id"), nullable=True, index=True)
     
     # QR Code
-    qr_code = Column(Text, nullable=True)
+    qr_code = Column(Text, nullable=True)  # SVG em base64 (data:image/svg+xml)
     qr_code_gerado_em = Column(DateTime, nullable=True)  # Timestamp do QR Code
     
     # Metadados
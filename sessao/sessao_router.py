@@ -1,7 +1,8 @@
 """
 Rotas da API para sessões WhatsApp.
 """
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
+from pydantic import TypeAdapter
 from sqlalchemy.orm import Session
 from typing import List
 from database import get_db
@@ -15,11 +16,19 @@ from sessao.sessao_service import SessaoService
 
 router = APIRouter(prefix="/api/sessoes", tags=["Sessões"])
 
+# Validação/serialização da lista inteira em uma chamada (pydantic-core),
+# em vez de item a item pelo FastAPI
+_LISTA_SESSOES = TypeAdapter(List[SessaoResposta])
+
 
 @router.get("/", response_model=List[SessaoResposta])
 def listar_sessoes(apenas_ativas: bool = False, db: Session = Depends(get_db)):
     """Lista todas as sessões."""
-    return SessaoService.listar_todas(db, apenas_ativas)
+    sessoes = SessaoService.listar_todas(db, apenas_ativas, com_qr_code=True)
+    return Response(
+        content=_LISTA_SESSOES.dump_json(_LISTA_SESSOES.validate_python(sessoes, from_attributes=True)),
+        media_type="application/json"
+    )
 
 
 @router.get("/{sessao_id}", response_model=SessaoResposta)
@@ -87,3 +96,16 @@ def obter_status_sessao(sessao_id: int, db: Session = Depends(get_db)):
         return SessaoService.obter_status(db, sessao_id)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.get("/{sessao_id}/qr.svg")
+def obter_qr_code_sessao(sessao_id: int, db: Session = Depends(get_db)):
+    """Imagem do QR Code atual da sessão (SVG, sem base64 no JSON do status)."""
+    svg = SessaoService.obter_qr_code_svg(db, sessao_id)
+    if svg is None:
+        raise HTTPException(status_code=404, detail="QR Code não disponível")
+    return Response(
+        content=svg,
+        media_type="image/svg+xml",
+        headers={"Cache-Control": "private, max-age=5"}  # o QR Code muda a cada ~20s
+    )
@@ -1,7 +1,7 @@
 """
 Schemas Pydantic para validação de sessões.
 """
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional
 from datetime import datetime
 
@@ -39,8 +39,7 @@ class SessaoResposta(SessaoBase):
     atualizado_em: Optional[datetime] = None
     ultima_conexao: Optional[datetime] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class SessaoConectar(BaseModel):
@@ -59,5 +58,5 @@ class SessaoStatusResposta(BaseModel):
     nome: str
     status: str
     telefone: Optional[str] = None
-    qr_code: Optional[str] = None
+    qr_code_url: Optional[str] = None  # imagem do QR Code (GET /api/sessoes/{id}/qr.svg)
     mensagem: str
@@ -1,45 +1,186 @@
 """
 Serviço de lógica de negócio para sessões WhatsApp.
 """
-from sqlalchemy.orm import Session
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, defer, joinedload, selectinload
 from typing import Optional, List, Dict
-from datetime import datetime
+from datetime import datetime, timedelta
 import asyncio
+import os
 import threading
+import time
+import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import segno
 import io
 import base64
 from neonize.client import NewClient
 from neonize.events import MessageEv, ConnectedEv, QREv, PairStatusEv
-from neonize.utils import build_jid
+from database import session_scope, iniciar_tarefa_periodica
+from mensagem.mensagem_service import MensagemService, build_jid
 from sessao.sessao_model import Sessao
 from sessao.sessao_schema import SessaoCriar, SessaoAtualizar, SessaoStatusResposta
 
+logger = logging.getLogger(__name__)
+
+# Bancos do neonize (um por sessão); o diretório é criado uma vez, na importação
+SESSOES_DIR = "./sessoes"
+os.makedirs(SESSOES_DIR, exist_ok=True)
+
+# QR Codes valem 60 segundos; os expirados são limpos em lote a cada 15 segundos
+QR_CODE_VALIDADE = timedelta(seconds=60)
+QR_CODE_INTERVALO_EXPIRACAO = 15
+QR_CODES_MAX = 1024
+
+
+@lru_cache(maxsize=256)
+def _qr_code_svg_base64(qr_string: str) -> str:
+    """
+    Renderiza o QR Code como SVG em base64 (exibido como data:image/svg+xml).
+    SVG não passa pelo deflate do PNG e fica bem menor. Memoizado: o mesmo QR
+    não é redesenhado.
+    """
+    buffer = io.BytesIO()
+    segno.make(qr_string, error='l').save(buffer, kind='svg', scale=8, xmldecl=False, nl=False)
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+# Mensagens recebidas nos primeiros segundos após conectar são do history sync
+HISTORY_SYNC_SEGUNDOS = 5.0
+
+# Mensagens recebidas são processadas por um pool fixo de threads (rajadas de grupos
+# não criam uma thread por mensagem); cada worker mantém o próprio event loop
+MENSAGENS_WORKERS = 16
+_executor_mensagens = ThreadPoolExecutor(max_workers=MENSAGENS_WORKERS, thread_name_prefix="mensagens")
+_loop_local = threading.local()
+
+# cliente.connect() bloqueia pela vida toda da sessão, então cada sessão ocupa uma
+# thread daemon. Pilha reduzida opcional (FLUXI_SESSAO_STACK_KB); sem a variável, vale
+# o padrão do SO (callbacks do neonize, PIL e protobuf rodam nessas threads)
+_stack_kb = os.getenv("FLUXI_SESSAO_STACK_KB")
+SESSAO_THREAD_STACK = int(_stack_kb) * 1024 if _stack_kb else 0
+_stack_lock = threading.Lock()
+
+
+def _loop_da_thread() -> asyncio.AbstractEventLoop:
+    """Event loop persistente da thread atual (criado no primeiro uso)."""
+    loop = getattr(_loop_local, "loop", None)
+    if loop is None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        _loop_local.loop = loop
+    return loop
+
+
+def _processar_mensagem(sessao_id: int, event: MessageEv):
+    """Processa uma mensagem recebida em um worker do pool, com sessão de banco própria."""
+    try:
+        with session_scope() as db_thread:
+            _loop_da_thread().run_until_complete(
+                MensagemService.processar_mensagem_recebida(db_thread, sessao_id, event)
+            )
+    except Exception as e:
+        logger.exception("Erro ao processar mensagem: %s", e)
+
+
+def _status_resposta(db_sessao, status: str, telefone: Optional[str], mensagem: str,
+                     qr_code_url: Optional[str] = None) -> SessaoStatusResposta:
+    """Monta o status da sessão sem validação (model_construct): os dados vêm do banco."""
+    return SessaoStatusResposta.model_construct(
+        id=db_sessao.id,
+        nome=db_sessao.nome,
+        status=status,
+        telefone=telefone,
+        qr_code_url=qr_code_url,
+        mensagem=mensagem
+    )
+
+
+class CacheQRCodes:
+    """
+    QR Codes em memória por sessão, com expiração automática após QR_CODE_VALIDADE.
+    Escrito pelas threads do neonize e lido pelas rotas, por isso protegido por lock.
+    """
+    
+    def __init__(self, ttl: float = QR_CODE_VALIDADE.total_seconds(), maxsize: int = QR_CODES_MAX):
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._itens: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, sessao_id: int, padrao: Optional[str] = None) -> Optional[str]:
+        """Retorna o QR Code da sessão, ou `padrao` se ausente ou expirado."""
+        item = self._itens.get(sessao_id)
+        if item is None or item[0] <= time.monotonic():
+            return padrao
+        return item[1]
+    
+    def __setitem__(self, sessao_id: int, qr_code: str):
+        agora = time.monotonic()
+        with self._lock:
+            if len(self._itens) >= self._maxsize:
+                # Descarta os expirados; se ainda estiver cheio, o mais antigo
+                for chave in [c for c, (expira, _) in self._itens.items() if expira <= agora]:
+                    del self._itens[chave]
+                if len(self._itens) >= self._maxsize:
+                    del self._itens[next(iter(self._itens))]
+            self._itens.pop(sessao_id, None)
+            self._itens[sessao_id] = (agora + self._ttl, qr_code)
+    
+    def __contains__(self, sessao_id: int) -> bool:
+        return self.get(sessao_id) is not None
+    
+    def pop(self, sessao_id: int, padrao: Optional[str] = None) -> Optional[str]:
+        """Remove e retorna o QR Code da sessão (ou `padrao`)."""
+        with self._lock:
+            item = self._itens.pop(sessao_id, None)
+        if item is None or item[0] <= time.monotonic():
+            return padrao
+        return item[1]
+
 
 class GerenciadorSessoes:
     """Gerenciador global de sessões WhatsApp."""
     
     def __init__(self):
+        # Acessado pelas threads do neonize (eventos) e pelas requisições
+        self._lock = threading.RLock()
         self.clientes: Dict[int, NewClient] = {}
         self.threads: Dict[int, threading.Thread] = {}
-        self.qr_codes: Dict[int, str] = {}
+        # False desde a conexão até o fim da janela de history sync (HISTORY_SYNC_SEGUNDOS)
+        self.aceitando_mensagens: Dict[int, bool] = {}
+        self.qr_codes = CacheQRCodes()
+        self.ultimo_qr: Dict[int, bytes] = {}  # bytes crus do último QR Code gravado
     
     def obter_cliente(self, sessao_id: int) -> Optional[NewClient]:
         """Obtém o cliente WhatsApp de uma sessão."""
-        return self.clientes.get(sessao_id)
+        with self._lock:
+            return self.clientes.get(sessao_id)
     
     def adicionar_cliente(self, sessao_id: int, cliente: NewClient):
         """Adiciona um cliente ao gerenciador."""
-        self.clientes[sessao_id] = cliente
+        with self._lock:
+            self.clientes[sessao_id] = cliente
+    
+    def liberar_mensagens(self, sessao_id: int, cliente: NewClient):
+        """
+        Passa a aceitar mensagens da sessão (fim do history sync), se o cliente ainda
+        for o registrado: uma reconexão no meio da janela não é liberada antes da hora.
+        """
+        with self._lock:
+            if self.clientes.get(sessao_id) is cliente:
+                self.aceitando_mensagens[sessao_id] = True
     
     def remover_cliente(self, sessao_id: int):
         """Remove um cliente do gerenciador."""
-        if sessao_id in self.clientes:
-            del self.clientes[sessao_id]
-        if sessao_id in self.threads:
-            del self.threads[sessao_id]
-        if sessao_id in self.qr_codes:
-            del self.qr_codes[sessao_id]
+        with self._lock:
+            self.clientes.pop(sessao_id, None)
+            self.threads.pop(sessao_id, None)
+            self.aceitando_mensagens.pop(sessao_id, None)
+            self.ultimo_qr.pop(sessao_id, None)
+        self.qr_codes.pop(sessao_id)
 
 
 # Instância global do gerenciador
@@ -50,17 +191,42 @@ class SessaoService:
     """Serviço para gerenciar sessões WhatsApp."""
 
     @staticmethod
-    def listar_todas(db: Session, apenas_ativas: bool = False) -> List[Sessao]:
-        """Lista todas as sessões."""
+    def listar_todas(
+        db: Session,
+        apenas_ativas: bool = False,
+        com_agentes: bool = False,
+        com_qr_code: bool = False
+    ) -> List[Sessao]:
+        """
+        Lista todas as sessões. Com com_agentes, carrega os agentes e seus clientes MCP
+        em duas consultas (selectinload) em vez de uma por sessão/agente.
+        O QR Code (base64, vários KB) só é carregado com com_qr_code.
+        """
         query = db.query(Sessao)
+        if not com_qr_code:
+            query = query.options(defer(Sessao.qr_code))
+        if com_agentes:
+            from agente.agente_model import Agente
+            query = query.options(selectinload(Sessao.agentes).selectinload(Agente.mcp_clients))
         if apenas_ativas:
             query = query.filter(Sessao.ativa == True)
         return query.all()
 
     @staticmethod
-    def obter_por_id(db: Session, sessao_id: int) -> Optional[Sessao]:
-        """Obtém uma sessão pelo ID."""
-        return db.query(Sessao).filter(Sessao.id == sessao_id).first()
+    def obter_por_id(db: Session, sessao_id: int, com_agente_ativo: bool = False) -> Optional[Sessao]:
+        """Obtém uma sessão pelo ID (com_agente_ativo: agente ativo no mesmo SELECT)."""
+        query = db.query(Sessao)
+        if com_agente_ativo:
+            query = query.options(joinedload(Sessao.agente_ativo))
+        return query.filter(Sessao.id == sessao_id).first()
+
+    @staticmethod
+    def obter_nome(db: Session, sessao_id: int):
+        """
+        Obtém apenas (id, nome) de uma sessão, sem carregar o objeto completo.
+        Retorna uma Row com atributos .id e .nome, ou None.
+        """
+        return db.query(Sessao.id, Sessao.nome).filter(Sessao.id == sessao_id).first()
 
     @staticmethod
     def obter_por_nome(db: Session, nome: str) -> Optional[Sessao]:
@@ -75,15 +241,18 @@ class SessaoService:
     @staticmethod
     def criar(db: Session, sessao: SessaoCriar) -> Sessao:
         """Cria uma nova sessão e um agente padrão."""
-        # Verificar se já existe sessão com mesmo nome
-        existe = SessaoService.obter_por_nome(db, sessao.nome)
-        if existe:
-            raise ValueError(f"Já existe uma sessão com o nome '{sessao.nome}'")
-        
         db_sessao = Sessao(**sessao.model_dump())
         db_sessao.status = "desconectado"
         db.add(db_sessao)
-        db.commit()
+        try:
+            db.commit()
+        except IntegrityError:
+            # nome é UNIQUE: o banco garante a unicidade, sem SELECT prévio. Só depois
+            # da falha confere se foi o nome; outras violações são repassadas
+            db.rollback()
+            if db.query(Sessao.id).filter(Sessao.nome == sessao.nome).first() is not None:
+                raise ValueError(f"Já existe uma sessão com o nome '{sessao.nome}'")
+            raise
         db.refresh(db_sessao)
         
         # Criar agente padrão para a sessão
@@ -94,26 +263,30 @@ class SessaoService:
             db_sessao.agente_ativo_id = agente_padrao.id
             db.commit()
             db.refresh(db_sessao)
-            print(f"✅ Agente padrão criado para sessão {db_sessao.nome}")
+            logger.info("Agente padrão criado para sessão %s", db_sessao.nome)
         except Exception as e:
-            print(f"⚠️ Erro ao criar agente padrão: {e}")
+            logger.warning("Erro ao criar agente padrão: %s", e)
         
         return db_sessao
 
     @staticmethod
     def atualizar(db: Session, sessao_id: int, sessao: SessaoAtualizar) -> Optional[Sessao]:
-        """Atualiza uma sessão existente."""
-        db_sessao = SessaoService.obter_por_id(db, sessao_id)
-        if not db_sessao:
-            return None
-
+        """Atualiza uma sessão existente (um único UPDATE só com os campos enviados)."""
         update_data = sessao.model_dump(exclude_unset=True)
-        for campo, valor in update_data.items():
-            setattr(db_sessao, campo, valor)
+        if not update_data:
+            return SessaoService.obter_por_id(db, sessao_id)
 
+        resultado = db.execute(
+            update(Sessao).where(Sessao.id == sessao_id).values(**update_data),
+            execution_options={"synchronize_session": False}
+        )
+        if not resultado.rowcount:
+            db.rollback()
+            return None
+
+        # O commit expira a instância eventualmente carregada; a releitura traz os novos valores
         db.commit()
-        db.refresh(db_sessao)
-        return db_sessao
+        return SessaoService.obter_por_id(db, sessao_id)
 
     @staticmethod
     def deletar(db: Session, sessao_id: int) -> bool:
@@ -126,6 +299,10 @@ class SessaoService:
         if db_sessao.status == "conectado":
             SessaoService.desconectar(db, sessao_id)
 
+        # Agregados de métricas da sessão (não há relacionamento ORM para o cascade)
+        from metrica.metrica_service import MetricaService
+        MetricaService.remover_sessao(db, sessao_id)
+        
         db.delete(db_sessao)
         db.commit()
         return True
@@ -133,9 +310,7 @@ class SessaoService:
     @staticmethod
     def conectar(db: Session, sessao_id: int, usar_paircode: bool = False) -> SessaoStatusResposta:
         """Conecta uma sessão WhatsApp usando QR Code."""
-        print(f"\n{'='*60}")
-        print(f"🔌 CONECTAR SESSÃO {sessao_id}")
-        print(f"{'='*60}")
+        logger.info("CONECTAR SESSÃO %s", sessao_id)
         
         db_sessao = SessaoService.obter_por_id(db, sessao_id)
         if not db_sessao:
@@ -147,276 +322,50 @@ class SessaoService:
         # Verificar se já existe cliente ativo
         cliente_existente = gerenciador_sessoes.obter_cliente(sessao_id)
         if cliente_existente:
-            print(f"⚠️  Cliente já existe para sessão {sessao_id}. Usando cliente existente.")
+            logger.warning("Cliente já existe para sessão %s. Usando cliente existente.", sessao_id)
             # Verificar se há QR Code no gerenciador
             qr_code_existente = gerenciador_sessoes.qr_codes.get(sessao_id)
             if qr_code_existente:
-                print(f"✅ QR Code já existe no gerenciador")
-                return SessaoStatusResposta(
-                    id=db_sessao.id,
-                    nome=db_sessao.nome,
-                    status=db_sessao.status,
-                    telefone=db_sessao.telefone,
-                    qr_code=qr_code_existente,
-                    mensagem="Cliente já está conectando. Use o QR Code existente."
+                logger.debug("QR Code já existe no gerenciador")
+                return _status_resposta(
+                    db_sessao,
+                    db_sessao.status,
+                    db_sessao.telefone,
+                    "Cliente já está conectando. Use o QR Code existente.",
+                    qr_code_url=f"/api/sessoes/{sessao_id}/qr.svg"
                 )
             else:
-                print(f"⚠️  Cliente existe mas sem QR Code. Removendo para gerar novo...")
+                logger.warning("Cliente existe mas sem QR Code. Removendo para gerar novo...")
                 gerenciador_sessoes.remover_cliente(sessao_id)
 
         if db_sessao.status == "conectado":
-            return SessaoStatusResposta(
-                id=db_sessao.id,
-                nome=db_sessao.nome,
-                status="conectado",
-                telefone=db_sessao.telefone,
-                qr_code=None,
-                mensagem="Sessão já está conectada"
+            return _status_resposta(
+                db_sessao,
+                "conectado",
+                db_sessao.telefone,
+                "Sessão já está conectada"
             )
 
         try:
-            print(f"📦 Criando novo cliente Neonize...")
-            
-            # Criar diretório se não existir
-            import os
-            os.makedirs("./sessoes", exist_ok=True)
+            logger.debug("Criando novo cliente Neonize...")
             
             # Usar banco de dados persistente (permite reconexão)
-            db_path = f"./sessoes/sessao_{sessao_id}.db"
-            print(f"💾 Usando banco de dados: {db_path}")
-            
-            # Criar cliente Neonize (conforme examples/basic.py)
-            cliente = NewClient(db_path)
-            print(f"✅ Cliente criado")
-
-            print(f"🎯 Registrando callback de QR Code...")
-            # Configurar callback customizado para QR Code
-            @cliente.qr
-            def custom_qr_handler(cli: NewClient, qr_data: bytes):
-                """Captura QR Code e converte para PNG base64."""
-                try:
-                    qr_string = qr_data.decode('utf-8')
-                    print(f"🔍 QR String recebida: {qr_string[:50]}...")
-                    
-                    # Gerar QR Code como PNG
-                    qr = segno.make(qr_string)
-                    buffer = io.BytesIO()
-                    qr.save(buffer, kind='png', scale=8)
-                    buffer.seek(0)
-                    
-                    # Converter para base64
-                    png_data = buffer.read()
-                    base64_png = base64.b64encode(png_data).decode('utf-8')
-                    print(f"🖼️  PNG gerado: {len(base64_png)} chars")
-                    
-                    # Salvar no gerenciador
-                    gerenciador_sessoes.qr_codes[sessao_id] = base64_png
-                    print(f"💾 Salvo no gerenciador: {sessao_id}")
-                    
-                    # Atualizar banco em nova sessão (thread-safe)
-                    from database import SessionLocal
-                    db_thread = SessionLocal()
-                    try:
-                        sessao_db = db_thread.query(Sessao).filter(Sessao.id == sessao_id).first()
-                        if sessao_db:
-                            sessao_db.qr_code = base64_png
-                            sessao_db.qr_code_gerado_em = datetime.now()  # Timestamp
-                            sessao_db.status = "conectando_qr"
-                            db_thread.commit()
-                            print(f"✅ Banco atualizado para sessão {sessao_id}")
-                        else:
-                            print(f"⚠️  Sessão {sessao_id} não encontrada no banco")
-                    finally:
-                        db_thread.close()
-                    
-                    print(f"📱 QR Code gerado para sessão {sessao_id} (PNG base64, {len(base64_png)} chars)")
-                except Exception as e:
-                    print(f"❌ Erro ao processar QR Code: {e}")
-                    import traceback
-                    traceback.print_exc()
-
-            # Variável para armazenar telefone do PairStatus
-            telefone_pareado = None
-            
-            @cliente.event(PairStatusEv)
-            def on_pair_status(client: NewClient, event: PairStatusEv):
-                """Evento de pareamento bem-sucedido."""
-                nonlocal telefone_pareado
-                print(f"🔗 EVENTO PAIR STATUS DISPARADO!")
-                
-                # Extrair telefone do JID
-                if hasattr(event, 'ID') and hasattr(event.ID, 'User'):
-                    telefone_pareado = event.ID.User
-                    print(f"📱 Telefone pareado: {telefone_pareado}")
-                else:
-                    print(f"⚠️  Não foi possível extrair telefone do PairStatus")
+            db_path = f"{SESSOES_DIR}/sessao_{sessao_id}.db"
+            logger.debug("Usando banco de dados: %s", db_path)
             
-            @cliente.event(ConnectedEv)
-            def on_connected(client: NewClient, event: ConnectedEv):
-                """Evento de conexão bem-sucedida."""
-                nonlocal telefone_pareado
-                print(f"🎉 EVENTO CONNECTED DISPARADO!")
-                print(f"📊 Status: {event.status if hasattr(event, 'status') else 'N/A'}")
-                
-                # IMPORTANTE: Atualizar timestamp de conexão AQUI
-                import time
-                gerenciador_sessoes.clientes[f"{sessao_id}_connected_at"] = time.time()
-                print(f"⏰ Timestamp de conexão atualizado")
-                
-                # Tentar obter telefone de várias fontes
-                telefone = telefone_pareado
-                
-                # Se não temos telefone do PairStatus, tentar do cliente
-                if not telefone:
-                    try:
-                        # Tentar obter do Store.ID do cliente
-                        if hasattr(client, 'me') and client.me:
-                            if hasattr(client.me, 'User'):
-                                telefone = client.me.User
-                                print(f"📱 Telefone obtido de client.me: {telefone}")
-                        
-                        # Tentar obter via get_me()
-                        if not telefone:
-                            try:
-                                me_info = client.get_me()
-                                if hasattr(me_info, 'User'):
-                                    telefone = me_info.User
-                                    print(f"📱 Telefone obtido de get_me(): {telefone}")
-                            except Exception as e2:
-                                print(f"⚠️  get_me() falhou: {e2}")
-                    except Exception as e:
-                        print(f"⚠️  Erro ao obter telefone do cliente: {e}")
-                
-                print(f"📱 Telefone final: {telefone}")
-                
-                # Atualizar banco em nova sessão (thread-safe)
-                from database import SessionLocal
-                db_thread = SessionLocal()
-                try:
-                    sessao_db = db_thread.query(Sessao).filter(Sessao.id == sessao_id).first()
-                    if sessao_db:
-                        sessao_db.telefone = telefone
-                        sessao_db.status = "conectado"
-                        sessao_db.qr_code = None
-                        sessao_db.qr_code_gerado_em = None
-                        sessao_db.ultima_conexao = datetime.now()
-                        db_thread.commit()
-                        print(f"✅ Sessão {sessao_db.nome} conectada com sucesso! Telefone: {telefone}")
-                    else:
-                        print(f"⚠️  Sessão {sessao_id} não encontrada no banco")
-                finally:
-                    db_thread.close()
-                
-                # Limpar QR Code do gerenciador
-                if sessao_id in gerenciador_sessoes.qr_codes:
-                    del gerenciador_sessoes.qr_codes[sessao_id]
-                    print(f"🧹 QR Code removido do gerenciador")
-
-            @cliente.event(MessageEv)
-            def on_message(client: NewClient, event: MessageEv):
-                """Evento de mensagem recebida."""
-                try:
-                    # Ignorar mensagens enviadas por mim
-                    if hasattr(event.Info, 'IsFromMe') and event.Info.IsFromMe:
-                        return
-                    
-                    # Ignorar mensagens dos primeiros 30 segundos (history sync)
-                    import time
-                    connected_at = gerenciador_sessoes.clientes.get(f"{sessao_id}_connected_at", 0)
-                    if time.time() - connected_at < 5:
-                        print(f"⏭️  Ignorando mensagem (history sync - primeiros 5s)")
-                        return
-                    
-                    sender_jid = event.Info.MessageSource.Sender
-                    print(f"📨 Mensagem NOVA recebida de {sender_jid}")
-                    
-                    # Processar mensagem em thread separada (síncrona)
-                    def processar_thread():
-                        from database import SessionLocal
-                        from mensagem.mensagem_service import MensagemService
-                        
-                        # Criar nova sessão do banco (thread-safe)
-                        db_thread = SessionLocal()
-                        try:
-                            # Processar mensagem de forma síncrona
-                            import asyncio
-                            
-                            # Criar event loop para esta thread
-                            loop = asyncio.new_event_loop()
-                            asyncio.set_event_loop(loop)
-                            
-                            try:
-                                loop.run_until_complete(
-                                    MensagemService.processar_mensagem_recebida(
-                                        db_thread, sessao_id, event
-                                    )
-                                )
-                            finally:
-                                loop.close()
-                                
-                        except Exception as e:
-                            print(f"❌ Erro ao processar mensagem: {e}")
-                            import traceback
-                            traceback.print_exc()
-                        finally:
-                            db_thread.close()
-                    
-                    # Executar em thread separada
-                    thread = threading.Thread(target=processar_thread, daemon=True)
-                    thread.start()
-                    
-                except Exception as e:
-                    print(f"❌ Erro no handler de mensagem: {e}")
-                    import traceback
-                    traceback.print_exc()
-
-            # Adicionar cliente ao gerenciador
-            gerenciador_sessoes.adicionar_cliente(sessao_id, cliente)
-            
-            # Timestamp de quando conectou (para ignorar history sync)
-            import time
-            gerenciador_sessoes.clientes[f"{sessao_id}_connected_at"] = time.time()
-
-            # Conectar em thread separada
-            def conectar_thread():
-                try:
-                    print(f"🔌 Thread de conexão iniciada para sessão {sessao_id}")
-                    print(f"📱 Chamando cliente.connect()...")
-                    cliente.connect()
-                    print(f"✅ cliente.connect() finalizado")
-                except Exception as e:
-                    print(f"❌ Erro ao conectar sessão {sessao_id}: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    
-                    # Atualizar banco em nova sessão
-                    from database import SessionLocal
-                    db_thread = SessionLocal()
-                    try:
-                        sessao_db = db_thread.query(Sessao).filter(Sessao.id == sessao_id).first()
-                        if sessao_db:
-                            sessao_db.status = "erro"
-                            db_thread.commit()
-                    finally:
-                        db_thread.close()
-
-            print(f"🚀 Criando thread de conexão para sessão {sessao_id}")
-            thread = threading.Thread(target=conectar_thread, daemon=True)
-            thread.start()
-            gerenciador_sessoes.threads[sessao_id] = thread
-            print(f"✅ Thread iniciada: {thread.is_alive()}")
+            # Criar cliente Neonize com os handlers de evento e conectar em thread separada
+            cliente = SessaoService._criar_cliente(sessao_id, db_path, gerar_qr=True)
+            SessaoService._iniciar_conexao(sessao_id, cliente, gerar_qr=True)
 
             # Atualizar status inicial
             db_sessao.status = "iniciando"
             db.commit()
 
-            return SessaoStatusResposta(
-                id=db_sessao.id,
-                nome=db_sessao.nome,
-                status="iniciando",
-                telefone=None,
-                qr_code=None,
-                mensagem="Iniciando conexão via QR Code..."
+            return _status_resposta(
+                db_sessao,
+                "iniciando",
+                None,
+                "Iniciando conexão via QR Code..."
             )
 
         except Exception as e:
@@ -434,164 +383,230 @@ class SessaoService:
         # Verificar se já existe cliente ativo
         cliente_existente = gerenciador_sessoes.obter_cliente(sessao_id)
         if cliente_existente:
-            print(f"✅ Sessão {sessao_id} já está conectada")
+            logger.debug("Sessão %s já está conectada", sessao_id)
             return
         
         try:
-            import os
-            import threading
-            
             # Criar cliente Neonize com banco de dados (mantém sessão)
-            db_path = f"./sessoes/sessao_{sessao_id}.db"
+            db_path = f"{SESSOES_DIR}/sessao_{sessao_id}.db"
             
             # Verificar se existe banco de dados salvo
             if not os.path.exists(db_path):
-                print(f"⚠️  Sem banco de dados salvo para sessão {sessao_id}")
+                logger.warning("Sem banco de dados salvo para sessão %s", sessao_id)
                 db_sessao.status = "desconectado"
                 db.commit()
                 return
             
-            print(f"📦 Criando cliente com banco salvo: {db_path}")
-            # Criar cliente Neonize (conforme examples/basic.py)
-            cliente = NewClient(db_path)
+            logger.debug("Criando cliente com banco salvo: %s", db_path)
+            cliente = SessaoService._criar_cliente(sessao_id, db_path, gerar_qr=False)
+            SessaoService._iniciar_conexao(sessao_id, cliente, gerar_qr=False)
             
-            # Configurar eventos (mesmo código do conectar)
+        except Exception as e:
+            logger.error("Erro ao reconectar: %s", e)
+            db_sessao.status = "erro"
+            db.commit()
+
+    @staticmethod
+    def _criar_cliente(sessao_id: int, db_path: str, gerar_qr: bool) -> NewClient:
+        """
+        Cria o cliente Neonize da sessão com os handlers de evento (QR Code, pareamento,
+        conexão e mensagens) e o registra no gerenciador. Usado por conectar
+        (gerar_qr=True) e reconectar_sessao (gerar_qr=False: sessão já pareada).
+        """
+        # Criar cliente Neonize (conforme examples/basic.py)
+        cliente = NewClient(db_path)
+        logger.debug("Cliente criado")
+
+        if gerar_qr:
+            logger.debug("Registrando callback de QR Code...")
+            # Configurar callback customizado para QR Code
             @cliente.qr
             def custom_qr_handler(cli: NewClient, qr_data: bytes):
-                """Captura QR Code (não deve ser chamado na reconexão)."""
-                print(f"⚠️  QR Code gerado durante reconexão (não esperado)")
-            
-            # Variável para armazenar telefone do PairStatus
-            telefone_pareado = None
-            
-            @cliente.event(PairStatusEv)
-            def on_pair_status(client: NewClient, event: PairStatusEv):
-                nonlocal telefone_pareado
-                if hasattr(event, 'ID') and hasattr(event.ID, 'User'):
-                    telefone_pareado = event.ID.User
-            
-            @cliente.event(ConnectedEv)
-            def on_connected(client: NewClient, event: ConnectedEv):
-                nonlocal telefone_pareado
-                print(f"🎉 Sessão {sessao_id} reconectada!")
-                
-                # IMPORTANTE: Atualizar timestamp de conexão AQUI
-                import time
-                gerenciador_sessoes.clientes[f"{sessao_id}_connected_at"] = time.time()
-                print(f"⏰ Timestamp de conexão atualizado")
-                
-                telefone = telefone_pareado
-                if not telefone:
-                    try:
-                        if hasattr(client, 'me') and client.me:
-                            if hasattr(client.me, 'User'):
-                                telefone = client.me.User
-                        if not telefone:
-                            try:
-                                me_info = client.get_me()
-                                if hasattr(me_info, 'User'):
-                                    telefone = me_info.User
-                            except:
-                                pass
-                    except:
-                        pass
-                
-                # Atualizar banco
-                from database import SessionLocal
-                db_thread = SessionLocal()
+                """Captura QR Code e converte para SVG base64."""
                 try:
-                    sessao_db = db_thread.query(Sessao).filter(Sessao.id == sessao_id).first()
-                    if sessao_db:
-                        sessao_db.telefone = telefone
-                        sessao_db.status = "conectado"
-                        sessao_db.ultima_conexao = datetime.now()
-                        db_thread.commit()
-                finally:
-                    db_thread.close()
-            
-            @cliente.event(MessageEv)
-            def on_message(client: NewClient, event: MessageEv):
-                """Evento de mensagem recebida."""
-                try:
-                    print(f"🔔 EVENTO MessageEv DISPARADO para sessão {sessao_id}")
-                    
-                    # Verificar se é mensagem própria
-                    if hasattr(event.Info, 'IsFromMe') and event.Info.IsFromMe:
-                        print(f"⏭️  Mensagem ignorada: IsFromMe=True")
+                    # Mesmo QR Code ainda válido (eventos repetidos): compara os bytes crus,
+                    # antes de decodificar, e não faz nada
+                    if gerenciador_sessoes.ultimo_qr.get(sessao_id) == qr_data and sessao_id in gerenciador_sessoes.qr_codes:
                         return
+                    qr_string = qr_data.decode('utf-8')
+                    logger.debug("QR String recebida: %s...", qr_string[:50])
                     
-                    # Verificar filtro de tempo
-                    import time
-                    connected_at = gerenciador_sessoes.clientes.get(f"{sessao_id}_connected_at", 0)
-                    tempo_desde_conexao = time.time() - connected_at
-                    print(f"⏱️  Tempo desde conexão: {tempo_desde_conexao:.1f}s (limite: 5s)")
+                    # Gerar QR Code como SVG base64
+                    base64_svg = _qr_code_svg_base64(qr_string)
+                    logger.debug("SVG gerado: %s chars", len(base64_svg))
                     
-                    if tempo_desde_conexao < 5:
-                        print(f"⏭️  Mensagem ignorada: history sync ({tempo_desde_conexao:.1f}s < 5s)")
-                        return
-                    
-                    sender_jid = event.Info.MessageSource.Sender
-                    print(f"📨 Mensagem NOVA recebida de {sender_jid}")
+                    # Salvar no gerenciador
+                    gerenciador_sessoes.qr_codes[sessao_id] = base64_svg
+                    logger.debug("Salvo no gerenciador: %s", sessao_id)
                     
-                    def processar_thread():
-                        from database import SessionLocal
-                        from mensagem.mensagem_service import MensagemService
-                        
-                        db_thread = SessionLocal()
-                        try:
-                            import asyncio
-                            loop = asyncio.new_event_loop()
-                            asyncio.set_event_loop(loop)
-                            try:
-                                loop.run_until_complete(
-                                    MensagemService.processar_mensagem_recebida(
-                                        db_thread, sessao_id, event
-                                    )
-                                )
-                            finally:
-                                loop.close()
-                        except Exception as e:
-                            print(f"❌ Erro ao processar mensagem: {e}")
-                            import traceback
-                            traceback.print_exc()
-                        finally:
-                            db_thread.close()
+                    # Atualizar banco em nova sessão (thread-safe)
+                    with session_scope() as db_thread:
+                        resultado = db_thread.execute(
+                            update(Sessao)
+                            .where(Sessao.id == sessao_id)
+                            .values(
+                                qr_code=base64_svg,
+                                qr_code_gerado_em=datetime.now(),  # Timestamp
+                                status="conectando_qr"
+                            )
+                        )
+                    gerenciador_sessoes.ultimo_qr[sessao_id] = qr_data
+                    if resultado.rowcount:
+                        logger.debug("Banco atualizado para sessão %s", sessao_id)
+                    else:
+                        logger.warning("Sessão %s não encontrada no banco", sessao_id)
                     
-                    thread = threading.Thread(target=processar_thread, daemon=True)
-                    thread.start()
+                    logger.debug("QR Code gerado para sessão %s (SVG base64, %s chars)", sessao_id, len(base64_svg))
                 except Exception as e:
-                    print(f"❌ Erro no handler de mensagem: {e}")
+                    logger.exception("Erro ao processar QR Code: %s", e)
+        else:
+            @cliente.qr
+            def custom_qr_handler(cli: NewClient, qr_data: bytes):
+                """Captura QR Code (não deve ser chamado na reconexão)."""
+                logger.warning("QR Code gerado durante reconexão (não esperado)")
+
+        # Variável para armazenar telefone do PairStatus
+        telefone_pareado = None
+        
+        @cliente.event(PairStatusEv)
+        def on_pair_status(client: NewClient, event: PairStatusEv):
+            """Evento de pareamento bem-sucedido."""
+            nonlocal telefone_pareado
+            logger.debug("EVENTO PAIR STATUS DISPARADO!")
             
-            # Adicionar cliente ao gerenciador
-            gerenciador_sessoes.adicionar_cliente(sessao_id, cliente)
+            # Extrair telefone do JID
+            if hasattr(event, 'ID') and hasattr(event.ID, 'User'):
+                telefone_pareado = event.ID.User
+                logger.debug("Telefone pareado: %s", telefone_pareado)
+            else:
+                logger.warning("Não foi possível extrair telefone do PairStatus")
+        
+        @cliente.event(ConnectedEv)
+        def on_connected(client: NewClient, event: ConnectedEv):
+            """Evento de conexão bem-sucedida."""
+            logger.debug("EVENTO CONNECTED DISPARADO!")
+            logger.debug("Status: %s", event.status if hasattr(event, 'status') else 'N/A')
             
-            import time
-            gerenciador_sessoes.clientes[f"{sessao_id}_connected_at"] = time.time()
+            # IMPORTANTE: Ignorar o history sync a partir DAQUI
+            with gerenciador_sessoes._lock:
+                gerenciador_sessoes.aceitando_mensagens[sessao_id] = False
+            timer = threading.Timer(
+                HISTORY_SYNC_SEGUNDOS,
+                gerenciador_sessoes.liberar_mensagens,
+                (sessao_id, cliente)
+            )
+            timer.daemon = True
+            timer.start()
+            logger.debug("Mensagens aceitas em %.0fs (history sync)", HISTORY_SYNC_SEGUNDOS)
             
-            # Conectar em thread separada
-            def conectar_thread():
+            # Tentar obter telefone de várias fontes
+            telefone = telefone_pareado
+            
+            # Se não temos telefone do PairStatus, tentar do cliente
+            if not telefone:
                 try:
-                    cliente.connect()
+                    # Tentar obter do Store.ID do cliente
+                    if hasattr(client, 'me') and client.me:
+                        if hasattr(client.me, 'User'):
+                            telefone = client.me.User
+                            logger.debug("Telefone obtido de client.me: %s", telefone)
+                    
+                    # Tentar obter via get_me()
+                    if not telefone:
+                        try:
+                            me_info = client.get_me()
+                            if hasattr(me_info, 'User'):
+                                telefone = me_info.User
+                                logger.debug("Telefone obtido de get_me(): %s", telefone)
+                        except Exception as e2:
+                            logger.warning("get_me() falhou: %s", e2)
                 except Exception as e:
-                    print(f"❌ Erro ao reconectar sessão {sessao_id}: {e}")
-                    from database import SessionLocal
-                    db_thread = SessionLocal()
-                    try:
-                        sessao_db = db_thread.query(Sessao).filter(Sessao.id == sessao_id).first()
-                        if sessao_db:
-                            sessao_db.status = "erro"
-                            db_thread.commit()
-                    finally:
-                        db_thread.close()
+                    logger.warning("Erro ao obter telefone do cliente: %s", e)
+            
+            logger.debug("Telefone final: %s", telefone)
             
-            thread = threading.Thread(target=conectar_thread, daemon=True)
+            # Atualizar banco em nova sessão (thread-safe)
+            with session_scope() as db_thread:
+                resultado = db_thread.execute(
+                    update(Sessao)
+                    .where(Sessao.id == sessao_id)
+                    .values(
+                        telefone=telefone,
+                        status="conectado",
+                        qr_code=None,
+                        qr_code_gerado_em=None,
+                        ultima_conexao=datetime.now()
+                    )
+                )
+            if resultado.rowcount:
+                logger.info("Sessão %s conectada com sucesso! Telefone: %s", sessao_id, telefone)
+            else:
+                logger.warning("Sessão %s não encontrada no banco", sessao_id)
+            
+            # Limpar QR Code do gerenciador
+            if gerenciador_sessoes.qr_codes.pop(sessao_id):
+                logger.debug("QR Code removido do gerenciador")
+
+        @cliente.event(MessageEv)
+        def on_message(client: NewClient, event: MessageEv):
+            """Evento de mensagem recebida."""
+            try:
+                # Ignorar mensagens enviadas por mim
+                if hasattr(event.Info, 'IsFromMe') and event.Info.IsFromMe:
+                    return
+                
+                # Ignorar mensagens da janela de history sync após a conexão
+                if not gerenciador_sessoes.aceitando_mensagens.get(sessao_id):
+                    return
+                
+                sender_jid = event.Info.MessageSource.Sender
+                logger.debug("Mensagem NOVA recebida de %s", sender_jid)
+                
+                # Processar mensagem no pool de threads compartilhado
+                _executor_mensagens.submit(_processar_mensagem, sessao_id, event)
+                
+            except Exception as e:
+                logger.exception("Erro no handler de mensagem: %s", e)
+
+        # Adicionar cliente ao gerenciador
+        gerenciador_sessoes.adicionar_cliente(sessao_id, cliente)
+        
+        # Só aceitar mensagens depois do history sync (liberado pelo on_connected)
+        with gerenciador_sessoes._lock:
+            gerenciador_sessoes.aceitando_mensagens[sessao_id] = False
+        return cliente
+
+    @staticmethod
+    def _iniciar_conexao(sessao_id: int, cliente: NewClient, gerar_qr: bool):
+        """Executa cliente.connect() em thread separada (status "erro" se falhar)."""
+        acao = "conectar" if gerar_qr else "reconectar"
+        
+        def conectar_thread():
+            try:
+                logger.debug("Thread de conexão iniciada para sessão %s", sessao_id)
+                cliente.connect()
+                logger.debug("cliente.connect() finalizado")
+            except Exception as e:
+                logger.exception("Erro ao %s sessão %s: %s", acao, sessao_id, e)
+                
+                # Atualizar banco em nova sessão
+                with session_scope() as db_thread:
+                    db_thread.execute(update(Sessao).where(Sessao.id == sessao_id).values(status="erro"))
+
+        thread = threading.Thread(target=conectar_thread, name=f"sessao-{sessao_id}", daemon=True)
+        if SESSAO_THREAD_STACK:
+            # stack_size é global ao processo: ajustado só durante este start()
+            with _stack_lock:
+                anterior = threading.stack_size(SESSAO_THREAD_STACK)
+                try:
+                    thread.start()
+                finally:
+                    threading.stack_size(anterior)
+        else:
             thread.start()
+        with gerenciador_sessoes._lock:
             gerenciador_sessoes.threads[sessao_id] = thread
-            
-        except Exception as e:
-            print(f"❌ Erro ao reconectar: {e}")
-            db_sessao.status = "erro"
-            db.commit()
+        logger.debug("Thread iniciada: %s", thread.name)
 
     @staticmethod
     def desconectar(db: Session, sessao_id: int) -> SessaoStatusResposta:
@@ -609,7 +624,7 @@ class SessaoService:
                 # O cliente será desconectado quando a thread terminar
                 pass
             except Exception as e:
-                print(f"Erro ao desconectar: {e}")
+                logger.error("Erro ao desconectar: %s", e)
 
         gerenciador_sessoes.remover_cliente(sessao_id)
 
@@ -618,34 +633,42 @@ class SessaoService:
         db_sessao.qr_code = None
         db.commit()
 
-        return SessaoStatusResposta(
-            id=db_sessao.id,
-            nome=db_sessao.nome,
-            status="desconectado",
-            telefone=db_sessao.telefone,
-            qr_code=None,
-            mensagem="Sessão desconectada com sucesso"
+        return _status_resposta(
+            db_sessao,
+            "desconectado",
+            db_sessao.telefone,
+            "Sessão desconectada com sucesso"
         )
 
     @staticmethod
     def obter_status(db: Session, sessao_id: int) -> SessaoStatusResposta:
         """Obtém o status atual de uma sessão."""
-        db_sessao = SessaoService.obter_por_id(db, sessao_id)
+        # Sem carregar o QR Code: o polling recebe só a URL da imagem
+        db_sessao = db.query(
+            Sessao.id, Sessao.nome, Sessao.status, Sessao.telefone,
+            Sessao.qr_code.isnot(None).label("tem_qr_code")
+        ).filter(Sessao.id == sessao_id).first()
         if not db_sessao:
             raise ValueError("Sessão não encontrada")
 
-        # Verificar se há QR Code disponível
-        qr_code = gerenciador_sessoes.qr_codes.get(sessao_id)
+        tem_qr_code = sessao_id in gerenciador_sessoes.qr_codes or db_sessao.tem_qr_code
 
-        return SessaoStatusResposta(
-            id=db_sessao.id,
-            nome=db_sessao.nome,
-            status=db_sessao.status,
-            telefone=db_sessao.telefone,
-            qr_code=qr_code or db_sessao.qr_code,
-            mensagem=f"Status: {db_sessao.status}"
+        return _status_resposta(
+            db_sessao,
+            db_sessao.status,
+            db_sessao.telefone,
+            f"Status: {db_sessao.status}",
+            qr_code_url=f"/api/sessoes/{sessao_id}/qr.svg" if tem_qr_code else None
         )
 
+    @staticmethod
+    def obter_qr_code_svg(db: Session, sessao_id: int) -> Optional[bytes]:
+        """SVG do QR Code atual da sessão (gerenciador, ou o gravado no banco), ou None."""
+        qr_code = gerenciador_sessoes.qr_codes.get(sessao_id)
+        if qr_code is None:
+            qr_code = db.query(Sessao.qr_code).filter(Sessao.id == sessao_id).scalar()
+        return base64.b64decode(qr_code) if qr_code else None
+
     @staticmethod
     def enviar_mensagem(
         db: Session,
@@ -675,3 +698,28 @@ class SessaoService:
             return True
         except Exception as e:
             raise ValueError(f"Erro ao enviar mensagem: {str(e)}")
+
+    @staticmethod
+    def expirar_qr_codes(db: Session) -> int:
+        """
+        Limpa, em um único UPDATE, os QR Codes gerados há mais de QR_CODE_VALIDADE
+        (sessões não conectadas). Retorna o número de sessões afetadas.
+        """
+        resultado = db.execute(
+            update(Sessao)
+            .where(
+                Sessao.qr_code.isnot(None),
+                Sessao.qr_code_gerado_em < datetime.now() - QR_CODE_VALIDADE,
+                Sessao.status != "conectado"
+            )
+            .values(qr_code=None, status="desconectado")
+        )
+        db.commit()
+        if resultado.rowcount:
+            logger.info("%s QR Code(s) expirado(s) removido(s)", resultado.rowcount)
+        return resultado.rowcount
+
+    @staticmethod
+    def iniciar_expiracao_qr_codes(intervalo: int = QR_CODE_INTERVALO_EXPIRACAO) -> threading.Thread:
+        """Inicia uma thread daemon que executa expirar_qr_codes a cada `intervalo` segundos."""
+        return iniciar_tarefa_periodica("expiracao-qr-codes", intervalo, SessaoService.expirar_qr_codes)
@@ -0,0 +1,25 @@
+"""
+Ambiente Jinja2 compartilhado pelos routers de frontend.
+"""
+import os
+import jinja2
+from fastapi.templating import Jinja2Templates
+
+
+def criar_templates(*precarregar: str) -> Jinja2Templates:
+    """
+    Cria o Jinja2Templates de um router de frontend. O bytecode compilado é
+    persistido entre reinícios e, fora do modo DEBUG, os arquivos não são verificados
+    a cada requisição. Os templates em `precarregar` são compilados na importação
+    (ficam no cache do ambiente); os que não existirem são ignorados.
+    """
+    templates = Jinja2Templates(directory="templates")
+    templates.env.bytecode_cache = jinja2.FileSystemBytecodeCache()
+    templates.env.auto_reload = os.getenv("DEBUG", "True").lower() == "true"
+    
+    for nome in precarregar:
+        try:
+            templates.get_template(nome)
+        except jinja2.TemplateNotFound:
+            pass
+    return templates